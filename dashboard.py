@@ -2,9 +2,19 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from sqlalchemy import create_engine
+import atexit
 import os
+from pathlib import Path
 from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from src.ingestor import document_from_path
+from src.validator import DEFAULT_ENGINE, validate_invoice
+from src.duplicates import flag_duplicate
+from src.supplier_registry import get_supplier_registry
+from src.worker import close_worker_context, get_worker_context
+from src.storage import DEFAULT_DB_URL, Storage, filter_options, get_engine, invoice_filter_query
+
+load_dotenv()
 
 # =============================================================================
 # CONFIGURACIÓN DE PÁGINA - TEMA PREMIUM
@@ -178,21 +188,29 @@ st.markdown("---")
 # FUNCIÓN DE CARGA DE DATOS
 # =============================================================================
 
+def _engine():
+    # Mismo engine (WAL) que el resto del proceso: leer no bloquea al watcher mientras escribe
+    return get_engine(os.getenv("DATABASE_URL", DEFAULT_DB_URL))
+
+@st.cache_resource
+def _storage() -> Storage:
+    """Storage para editar facturas: solo la DB, sin el contexto de extracción (OpenAI, caché...)."""
+    return Storage(os.getenv("DATABASE_URL", DEFAULT_DB_URL))
+
 @st.cache_data(ttl=60)
-def load_data():
-    """Carga datos de la base de datos con caché."""
-    db_path = "sqlite:///data/facturas.db"
-    
-    if "sqlite:///" in db_path:
-        file_path = db_path.replace("sqlite:///", "")
-        if not os.path.isabs(file_path):
-            file_path = os.path.join(os.getcwd(), file_path)
-        db_path = f"sqlite:///{file_path}"
+def load_filter_options():
+    """Fechas, estados y proveedores para los filtros (consultas sobre índices, sin leer facturas)."""
+    try:
+        return filter_options(_engine())
+    except Exception as e:
+        st.error(f"Error al conectar con la base de datos: {e}")
+        return {"desde": None, "hasta": None, "estados": [], "proveedores": []}
 
-    engine = create_engine(db_path)
-    
+@st.cache_data(ttl=60)
+def load_data(desde=None, hasta=None, estados=None, proveedores=None):
+    """Carga las facturas que pasan los filtros (el filtrado lo hace la DB con sus índices)."""
     try:
-        df_facturas = pd.read_sql("SELECT * FROM facturas", engine)
+        df_facturas = pd.read_sql(invoice_filter_query(desde, hasta, estados, proveedores), _engine())
         
         if not df_facturas.empty:
             df_facturas['fecha_emision'] = pd.to_datetime(df_facturas['fecha_emision'])
@@ -203,7 +221,59 @@ def load_data():
         st.error(f"Error al conectar con la base de datos: {e}")
         return pd.DataFrame()
 
-df = load_data()
+opciones = load_filter_options()
+
+# =============================================================================
+# PROCESAMIENTO DE SUBIDAS (STREAMING)
+# =============================================================================
+# La extracción por visión tarda varios segundos: en lugar de un spinner, se
+# muestran la cabecera y las líneas según las genera el modelo (`extract_stream`).
+# Las subidas se guardan en data/subidas (fuera de la carpeta que vigila el watcher).
+
+UPLOAD_DIR = Path("data/subidas")
+
+@st.cache_resource
+def _register_cleanup():
+    """Al parar Streamlit: vuelca la exportación pendiente y cierra el pool HTTP y la DB."""
+    # cache_resource: el script se re-ejecuta en cada interacción, el registro solo una vez
+    atexit.register(close_worker_context)
+
+_register_cleanup()
+
+def procesar_subida(uploaded_file) -> str:
+    """Extrae, valida y guarda una factura subida. Devuelve el estado (OK/REVIEW/ERROR/DUPLICADA)."""
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    path = UPLOAD_DIR / Path(uploaded_file.name).name
+    path.write_bytes(uploaded_file.getvalue())
+
+    ctx = get_worker_context()
+    doc = document_from_path(str(path), source="dashboard")
+    if doc.id in ctx.seen_index:
+        st.info(f"⏭️ {doc.filename} ya fue procesada (mismo contenido)")
+        return "DUPLICADA"
+
+    cabecera = st.empty()
+    lineas = st.empty()
+    factura = None
+    for update in ctx.extractor.extract_stream(doc):
+        cabecera.markdown(
+            f"**Proveedor:** {update.header.get('nombre_proveedor', '…')}  \n"
+            f"**Fecha:** {update.header.get('fecha_emision', '…')}  \n"
+            f"**Total:** {update.header.get('total_factura', '…')}"
+        )
+        if update.items:
+            lineas.dataframe(pd.DataFrame([item.model_dump() for item in update.items]), hide_index=True)
+        factura = update.factura
+
+    factura = get_supplier_registry().canonicalise(factura)
+    validation = validate_invoice(factura)
+    status, notes, duplicate = ctx.storage.check_duplicate(factura, validation.status, validation.notes)
+    if ctx.storage.save_invoice(doc.id, factura, status, notes, metrics=doc.metrics, duplicate=duplicate):
+        ctx.seen_index.add(doc.id, doc.filename)
+        ctx.export.add(doc.id, factura)
+    if notes:
+        st.warning(notes)
+    return status
 
 # =============================================================================
 # SIDEBAR - FILTROS Y ACCIONES
@@ -215,10 +285,11 @@ with st.sidebar:
     # Filtros
     st.subheader("🔍 Filtros")
     
-    if not df.empty:
+    fecha_rango, estados, proveedores = (), opciones['estados'], opciones['proveedores']
+    if opciones['desde'] is not None:
         # Filtro por fecha
-        fecha_min = df['fecha_emision'].min().date()
-        fecha_max = df['fecha_emision'].max().date()
+        fecha_min = opciones['desde']
+        fecha_max = opciones['hasta']
         
         fecha_rango = st.date_input(
             "Rango de fechas",
@@ -230,15 +301,15 @@ with st.sidebar:
         # Filtro por estado
         estados = st.multiselect(
             "Estado",
-            options=df['status'].unique(),
-            default=df['status'].unique()
+            options=opciones['estados'],
+            default=opciones['estados']
         )
         
         # Filtro por proveedor
         proveedores = st.multiselect(
             "Proveedor",
-            options=df['nombre_proveedor'].unique(),
-            default=df['nombre_proveedor'].unique()
+            options=opciones['proveedores'],
+            default=opciones['proveedores']
         )
     
     st.markdown("---")
@@ -247,17 +318,26 @@ with st.sidebar:
     st.subheader("📤 Subir Factura")
     uploaded_files = st.file_uploader(
         "Arrastra archivos aquí",
-        type=['pdf', 'jpg', 'jpeg', 'png'],
+        type=['pdf', 'jpg', 'jpeg', 'png', 'tif', 'tiff'],
         accept_multiple_files=True,
         help="Sube facturas en formato PDF o imagen"
     )
     
     if uploaded_files:
         if st.button("🚀 Procesar Facturas", use_container_width=True):
-            with st.spinner("Procesando..."):
-                # Aquí iría la lógica de procesamiento
-                st.success(f"✅ {len(uploaded_files)} factura(s) procesadas correctamente")
-                st.balloons()
+            procesadas = 0
+            for uploaded_file in uploaded_files:
+                with st.status(f"🤖 {uploaded_file.name}", expanded=True) as estado:
+                    try:
+                        resultado = procesar_subida(uploaded_file)
+                        procesadas += resultado != "DUPLICADA"
+                        estado.update(label=f"{'✅' if resultado == 'OK' else '⚠️'} {uploaded_file.name}: {resultado}",
+                                      state="complete", expanded=resultado in ("REVIEW", "ERROR"))
+                    except Exception as e:
+                        estado.update(label=f"❌ {uploaded_file.name}: {e}", state="error")
+            if procesadas:
+                st.success(f"✅ {procesadas} factura(s) procesadas correctamente")
+                st.cache_data.clear()
     
     st.markdown("---")
     
@@ -274,22 +354,21 @@ with st.sidebar:
 # CONTENIDO PRINCIPAL
 # =============================================================================
 
-if df.empty:
+# Los filtros van a la consulta. Con todo seleccionado no se filtra: un IN con miles de
+# proveedores, o recorrer el índice de fechas entero, es más lento que leer la tabla
+completo = len(fecha_rango) != 2 or tuple(fecha_rango) == (opciones['desde'], opciones['hasta'])
+df = load_data(
+    *((None, None) if completo else fecha_rango),
+    estados=None if set(estados) == set(opciones['estados']) else tuple(estados),
+    proveedores=None if set(proveedores) == set(opciones['proveedores']) else tuple(proveedores),
+)
+
+if opciones['desde'] is None and df.empty:
     st.warning("📭 No hay datos todavía. Procesa algunas facturas para verlas aquí.")
+elif df.empty:
+    st.info("🔍 Ninguna factura cumple los filtros seleccionados.")
 else:
-    # Aplicar filtros
-    if len(fecha_rango) == 2:
-        df_filtered = df[
-            (df['fecha_emision'].dt.date >= fecha_rango[0]) &
-            (df['fecha_emision'].dt.date <= fecha_rango[1]) &
-            (df['status'].isin(estados)) &
-            (df['nombre_proveedor'].isin(proveedores))
-        ]
-    else:
-        df_filtered = df[
-            (df['status'].isin(estados)) &
-            (df['nombre_proveedor'].isin(proveedores))
-        ]
+    df_filtered = df
     
     # =============================================================================
     # MÉTRICAS PRINCIPALES - KPIs
@@ -451,24 +530,71 @@ else:
             format_func=lambda x: f"#{x} - {df_filtered[df_filtered['id']==x]['numero_factura'].iloc[0]}"
         )
         
+        original = None
         if factura_id:
-            factura = df_filtered[df_filtered['id'] == factura_id].iloc[0]
+            try:
+                storage = _storage()
+                original = storage.load_invoice(int(factura_id))
+                if original is None:
+                    st.error(f"❌ La factura #{factura_id} ya no existe en la base de datos")
+            except Exception as e:
+                st.error(f"❌ No se pudo cargar la factura #{factura_id}: {e}")
+        
+        if original is not None:
+            # Estado de partida: todas las reglas sobre lo guardado
+            previa = DEFAULT_ENGINE.validate(original)
             
             col1, col2 = st.columns(2)
             
             with col1:
-                nuevo_numero = st.text_input("Número de Factura", factura['numero_factura'])
-                nuevo_proveedor = st.text_input("Proveedor", factura['nombre_proveedor'])
-                nuevo_cif = st.text_input("CIF", factura['cif_proveedor'] or "")
+                nuevo_numero = st.text_input("Número de Factura", original.numero_factura or "")
+                nuevo_proveedor = st.text_input("Proveedor", original.nombre_proveedor)
+                nuevo_cif = st.text_input("CIF", original.cif_proveedor or "")
+                nueva_fecha = st.date_input("Fecha Emisión", original.fecha_emision)
             
             with col2:
-                nueva_fecha = st.date_input("Fecha Emisión", factura['fecha_emision'])
-                nuevo_total = st.number_input("Total", value=float(factura['total_factura']))
-                nuevo_status = st.selectbox("Estado", ['OK', 'REVIEW', 'ERROR'], index=0 if factura['status']=='OK' else 1)
+                nueva_base = st.number_input("Base Imponible", value=float(original.base_imponible))
+                nuevos_impuestos = st.number_input("Impuestos", value=float(original.total_impuestos))
+                nuevo_total = st.number_input("Total", value=float(original.total_factura))
+            
+            editada = original.model_copy(update={
+                "numero_factura": nuevo_numero or None,
+                "nombre_proveedor": nuevo_proveedor,
+                "cif_proveedor": nuevo_cif or None,
+                "fecha_emision": nueva_fecha,
+                "base_imponible": nueva_base,
+                "total_impuestos": nuevos_impuestos,
+                "total_factura": nuevo_total,
+            })
+            # Solo se repiten las reglas que leen los campos editados
+            cambiados = [name for name in ("numero_factura", "nombre_proveedor", "cif_proveedor", "fecha_emision",
+                                           "base_imponible", "total_impuestos", "total_factura")
+                         if getattr(editada, name) != getattr(original, name)]
+            validacion = DEFAULT_ENGINE.revalidate(editada, previa, cambiados)
+            
+            if cambiados:
+                st.caption(f"🔁 Reglas revalidadas: {', '.join(validacion.evaluated) or 'ninguna'} "
+                           f"(campos editados: {', '.join(cambiados)})")
+            # Un posible duplicado sigue marcado como tal aunque se corrijan otros campos
+            original_id = df_filtered[df_filtered['id'] == factura_id].iloc[0].get('duplicate_of')
+            estado, notas = flag_duplicate(validacion.status, validacion.notes,
+                                           None if pd.isna(original_id) else int(original_id))
+            if notas:
+                st.warning(notas)
+            estados = ['OK', 'REVIEW', 'ERROR']
+            nuevo_status = st.selectbox("Estado", estados, index=estados.index(estado))
+            
+            with st.expander("⏱️ Tiempo por regla"):
+                st.dataframe(pd.DataFrame(DEFAULT_ENGINE.timings()), hide_index=True, use_container_width=True)
             
             if st.button("💾 Guardar Cambios", use_container_width=True):
-                st.success("✅ Cambios guardados correctamente")
-                st.balloons()
+                # update_invoice hace rollback e imprime el motivo si falla: aquí basta con avisar
+                if storage.update_invoice(int(factura_id), editada, nuevo_status, notas):
+                    load_data.clear()
+                    st.success("✅ Cambios guardados correctamente")
+                    st.balloons()
+                else:
+                    st.error("❌ No se pudieron guardar los cambios")
 
 # Footer
 st.markdown("---")
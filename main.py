@@ -1,5 +1,8 @@
 import os
 import sys
+import time
+import asyncio
+from typing import Callable, List, Optional
 import typer
 from rich.console import Console
 from rich.table import Table
@@ -7,9 +10,21 @@ from dotenv import load_dotenv
 
 # Importamos nuestros módulos (la arquitectura modular)
 from src.ingestor import LocalFileIngestor
-from src.llm_extractor import LLMExtractor
-from src.validator import validate_invoice
-from src.storage import Storage
+from src.llm_extractor import LLMExtractor, AsyncLLMExtractor, parse_models
+from src.validator import DEFAULT_ENGINE, validate_invoice
+from src.supplier_registry import get_supplier_registry
+from src.storage import Storage, InvoiceRow
+from src.export_sink import ExportSink
+from src.duplicates import TOLERANCIA_DUPLICADO, normalise_cif, normalise_numero, normalise_proveedor
+from src.seen_index import SeenIndex
+from src.extraction_cache import ExtractionCache
+from src.image_preprocessing import PreprocessConfig
+from src.batch_processor import BatchRunner, FINAL_STATES
+from src.rate_limiter import RateLimiter
+from src.supplier_templates import SupplierTemplateEngine
+from src.extraction_metrics import RunMetrics
+from src.replay import ExtractionBackend, BACKENDS
+from openai import OpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 
 # Cargar variables de entorno (.env)
 load_dotenv()
@@ -49,83 +64,584 @@ console = Console()
 #    se puede envolver en una API (FastAPI) fácilmente porque los módulos son independientes.
 # -----------------------------------------------------------------------------
 
+# Con carpetas de 100k+ archivos no queremos una tabla de 100k filas en memoria:
+# mostramos las primeras y el resto solo cuenta para el resumen.
+MAX_TABLE_ROWS = 200
+
+def _pending_documents(docs, seen_index: SeenIndex, stats: dict):
+    """Filtra los documentos ya procesados ANTES de que lleguen al extractor."""
+    seen_this_run = set()
+    for doc in docs:
+        stats["found"] += 1
+        # Deduplicación por contenido (antes de pagar al LLM)
+        if doc.id in seen_index or doc.id in seen_this_run:
+            stats["skipped"] += 1
+            console.print(f"⏭️ Ya procesado (mismo contenido): [italic]{doc.filename}[/italic]")
+            continue
+        seen_this_run.add(doc.id)
+        yield doc
+
+class _PendingSaves:
+    """Facturas ya validadas que esperan a guardarse en lote (una transacción por bloque)."""
+
+    def __init__(self, storage: Storage, seen_index: SeenIndex, export: ExportSink, batch_size: int = 200,
+                 on_flushed: Optional[Callable[[List[str]], None]] = None):
+        self.storage = storage
+        self.seen_index = seen_index
+        self.export = export
+        self.batch_size = batch_size
+        self.on_flushed = on_flushed  # Recibe los document_id ya resueltos en la DB (guardados o duplicados)
+        self.queued = 0      # Facturas recibidas por `add` desde el principio
+        self.rows = []       # (nombre de archivo, InvoiceRow)
+        self._keys = set()   # Claves de duplicado de las pendientes (aún no están en la DB)
+        self._near = {}
+
+    def might_duplicate(self, factura) -> bool:
+        """¿Podría duplicar a una factura pendiente? (la DB todavía no la ve)"""
+        key = (normalise_cif(factura.cif_proveedor), normalise_numero(factura.numero_factura))
+        if all(key) and key in self._keys:
+            return True
+        totals = self._near.get((normalise_proveedor(factura.nombre_proveedor), factura.fecha_emision), [])
+        return any(abs(total - factura.total_factura) <= TOLERANCIA_DUPLICADO for total in totals)
+
+    def add(self, filename: str, row: InvoiceRow):
+        factura = row.factura
+        self.rows.append((filename, row))
+        self.queued += 1
+        self._keys.add((normalise_cif(factura.cif_proveedor), normalise_numero(factura.numero_factura)))
+        near_key = (normalise_proveedor(factura.nombre_proveedor), factura.fecha_emision)
+        self._near.setdefault(near_key, []).append(factura.total_factura)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        report = self.storage.save_invoices([row for _, row in self.rows], batch_size=self.batch_size)
+        saved = set(report.saved)
+        self.seen_index.add_many((row.document_id, filename) for filename, row in self.rows if row.document_id in saved)
+        for _, row in self.rows:
+            if row.document_id in saved:
+                self.export.add(row.document_id, row.factura)
+        for document_id, reason in report.conflicts:
+            console.print(f"⚠️ DUPLICADO: La factura {document_id} no se guardó ({reason})")
+        console.print(f"💾 Guardadas {len(report.saved)} facturas en DB en {report.seconds * 1000:.0f} ms")
+        self.rows, self._keys, self._near = [], set(), {}
+        if self.on_flushed is not None:
+            self.on_flushed(report.saved + [document_id for document_id, _ in report.conflicts])
+
+    def close(self):
+        """Guarda lo pendiente y cierra la exportación (CSV y Parquet)."""
+        self.flush()
+        self.export.close()
+
+def _finish_document(doc, factura, pending: _PendingSaves, table: Table):
+    """Valida, deja lista para guardar y añade a la tabla resumen una factura ya extraída."""
+    # B. Validación (Lógica), con el nombre oficial del proveedor si está en el maestro
+    factura = get_supplier_registry().canonicalise(factura)
+    val_result = validate_invoice(factura)
+    status, notes = val_result.status, val_result.notes
+    # ¿La misma factura ya llegó en otro archivo? (reenvío, escaneo de una copia)
+    if pending.might_duplicate(factura):
+        pending.flush()  # La original aún no está en la DB: se guarda antes de buscarla
+    status, notes, duplicate = pending.storage.check_duplicate(factura, status, notes)
+
+    # C. Persistencia (DB + CSV), en lote
+    pending.add(doc.filename, InvoiceRow(doc.id, factura, status, notes, metrics=doc.metrics, duplicate=duplicate))
+
+    # UI Update
+    status_style = "green" if status == "OK" else "yellow" if status == "REVIEW" else "red"
+    if table.row_count < MAX_TABLE_ROWS:
+        table.add_row(
+            doc.filename, 
+            factura.nombre_proveedor, 
+            f"{factura.total_factura:.2f} {factura.moneda}", 
+            f"[{status_style}]{status}[/{status_style}]",
+            notes
+        )
+
+def _record_outcome(doc, outcome, pending: _PendingSaves, table: Table, run_metrics: RunMetrics = None):
+    """Procesa el resultado de una extracción (Factura o excepción) sin romper el lote."""
+    if run_metrics is not None:
+        # Una extracción fallida también ha costado tokens y tiempo
+        supplier = "" if isinstance(outcome, Exception) else outcome.nombre_proveedor
+        run_metrics.add(doc.metrics, supplier)
+    try:
+        if isinstance(outcome, Exception):
+            raise outcome
+        _finish_document(doc, outcome, pending, table)
+    except Exception as e:
+        console.print(f"[bold red]💥 Fallo crítico en {doc.filename}: {e}[/bold red]")
+        if table.row_count < MAX_TABLE_ROWS:
+            table.add_row(doc.filename, "ERROR", "0.00", "[red]CRASH[/red]", str(e))
+
+def _summary_table() -> Table:
+    table = Table(title="Resumen de Procesamiento")
+    table.add_column("Archivo", style="cyan")
+    table.add_column("Proveedor", style="magenta")
+    table.add_column("Total", justify="right", style="green")
+    table.add_column("Estado", justify="center")
+    table.add_column("Notas", style="red")
+    return table
+
+async def _consume(results, handle):
+    """Recorre el flujo asíncrono de resultados aplicando `handle` en orden."""
+    async for doc, outcome in results:
+        # Validar y guardar (SQL, lote de save_invoices) en un hilo: mientras, el event
+        # loop sigue atendiendo las extracciones en vuelo. Se espera a cada uno: mismo orden
+        await asyncio.to_thread(handle, doc, outcome)
+
+def _http_client(backend: ExtractionBackend):
+    """Cliente httpx del backend (None = el cliente por defecto del SDK)."""
+    transport = backend.transport()
+    return DefaultHttpxClient(transport=transport) if transport else None
+
+def _async_http_client(backend: ExtractionBackend):
+    transport = backend.async_transport()
+    return DefaultAsyncHttpxClient(transport=transport) if transport else None
+
+def _print_run_metrics(run_metrics: RunMetrics):
+    """Resumen de tokens, coste y latencia de la ejecución."""
+    if not run_metrics.documents:
+        return
+    sources = ", ".join(f"{count} {source}" for source, count in sorted(run_metrics.by_source.items()))
+    console.print(
+        f"📈 Coste: {run_metrics.prompt_tokens + run_metrics.completion_tokens:,} tokens "
+        f"({run_metrics.prompt_tokens:,} entrada / {run_metrics.completion_tokens:,} salida), "
+        f"~${run_metrics.cost_usd:.4f} en {run_metrics.documents} documentos ({sources})"
+    )
+    console.print(
+        f"⏱️ Latencia por documento: p50 {run_metrics.percentile(50):.1f}s, p95 {run_metrics.percentile(95):.1f}s, "
+        f"máx {run_metrics.percentile(100):.1f}s; {run_metrics.payload_bytes / 1024 / 1024:.1f} MB enviados; "
+        f"reintentos: {run_metrics.validation_retries} de validación, {run_metrics.network_retries} de red"
+    )
+    if run_metrics.by_model:
+        tiers = ", ".join(f"{count} con {model}" for model, count in run_metrics.by_model.items())
+        console.print(f"🪜 Cascada de modelos: {tiers}; {run_metrics.escalations} escaladas")
+    top = [(supplier, cost) for supplier, cost in run_metrics.top_suppliers() if cost > 0]
+    if top:
+        console.print("💸 Proveedores más caros: " + ", ".join(f"{supplier} (${cost:.4f})" for supplier, cost in top))
+
 @app.command()
 def process_folder(
     folder_path: str = typer.Argument(..., help="Carpeta con facturas (PDF/Imágenes)"),
-    extensions: str = typer.Option("pdf,jpg,png,jpeg", help="Extensiones a buscar separadas por coma")
+    extensions: str = typer.Option("pdf,jpg,png,jpeg,tif,tiff", help="Extensiones a buscar separadas por coma"),
+    recursive: bool = typer.Option(True, help="Buscar también en subcarpetas"),
+    concurrency: int = typer.Option(1, min=1, help="Extracciones simultáneas contra la API (1 = secuencial)"),
+    timeout: float = typer.Option(120.0, help="Timeout por documento en segundos (modo concurrente)"),
+    cache: bool = typer.Option(True, help="Reutilizar extracciones previas guardadas en data/extraction_cache.db"),
+    cache_max_mb: int = typer.Option(256, help="Tamaño máximo de la caché de extracciones (MB)"),
+    max_edge: int = typer.Option(2048, help="Lado máximo (px) de las imágenes enviadas al LLM"),
+    grayscale: bool = typer.Option(True, help="Convertir las imágenes a escala de grises antes de enviarlas"),
+    jpeg_quality: int = typer.Option(80, min=1, max=95, help="Calidad JPEG de recompresión de imágenes"),
+    rate_limit: bool = typer.Option(True, help="Limitar el ritmo de llamadas según la cuota (RPM/TPM)"),
+    rpm: int = typer.Option(500, envvar="OPENAI_RPM", help="Peticiones por minuto permitidas por la cuota"),
+    tpm: int = typer.Option(30000, envvar="OPENAI_TPM", help="Tokens por minuto permitidos por la cuota"),
+    templates: bool = typer.Option(True, help="Parsear en local los PDFs de proveedores con plantilla aprendida"),
+    page_concurrency: int = typer.Option(4, min=1, help="Páginas de un mismo documento extraídas en paralelo"),
+    models: str = typer.Option("gpt-4o-mini,gpt-4o", envvar="OPENAI_MODELS",
+                               help="Cascada de modelos (del más barato al más capaz), separados por coma"),
+    backend: str = typer.Option("openai", envvar="EXTRACTOR_BACKEND",
+                                help=f"Origen de las respuestas del LLM: {', '.join(BACKENDS)}"),
+    cassette: str = typer.Option("data/cassette.jsonl", envvar="EXTRACTOR_CASSETTE",
+                                 help="Archivo JSONL donde se graban/leen las respuestas (record/replay)"),
+    replay_latency: float = typer.Option(0.0, envvar="REPLAY_LATENCY", help="Latencia simulada por llamada en replay (s)"),
+    replay_error_rate: float = typer.Option(0.0, envvar="REPLAY_ERROR_RATE", help="Proporción de HTTP 500 simulados en replay"),
+    replay_miss: str = typer.Option("error", envvar="REPLAY_MISS",
+                                    help="Petición no grabada en replay: error (404) o synthetic (factura sintética)"),
+    save_batch: int = typer.Option(200, min=1, help="Facturas por transacción al guardar en la DB (1 = una a una)")
 ):
     """
     Procesa todas las facturas de una carpeta.
     """
+    try:
+        extraction_backend = ExtractionBackend(backend, cassette, replay_latency, replay_error_rate, replay_miss)
+    except ValueError as e:
+        console.print(f"[bold red]❌ Error:[/bold red] {e}")
+        raise typer.Exit(code=1)
     api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    if not api_key and extraction_backend.needs_api_key:
         console.print("[bold red]❌ Error:[/bold red] No se encontró OPENAI_API_KEY en .env")
         raise typer.Exit(code=1)
+    api_key = api_key or "replay"  # En replay no hay red: cualquier clave sirve
 
     # 1. Setup
     console.print(f"[bold blue]🚀 Iniciando Agente de Facturas v1.0[/bold blue]")
-    ingestor = LocalFileIngestor(folder_path)
-    extractor = LLMExtractor(api_key)
+    ingestor = LocalFileIngestor(folder_path, recursive=recursive)
     storage = Storage() # Conecta a SQLite data/facturas.db
+    seen_index = SeenIndex() # Hashes de documentos ya procesados
+    extraction_cache = ExtractionCache(max_bytes=cache_max_mb * 1024 * 1024) if cache else None
+    preprocess = PreprocessConfig(max_edge=max_edge, grayscale=grayscale, jpeg_quality=jpeg_quality)
+    limiter = RateLimiter(requests_per_minute=rpm, tokens_per_minute=tpm) if rate_limit else None
+    template_engine = SupplierTemplateEngine() if templates else None
+    model_cascade = parse_models(models)
+    if extraction_backend.kind != "openai":
+        console.print(f"🔌 Backend de extracción: {extraction_backend.describe()}")
 
-    # 2. Ingesta
+    # 2. Ingesta (perezosa: el escaneo avanza a la vez que el procesamiento)
     ext_list = [f".{e.strip()}" for e in extensions.split(",")]
-    docs = ingestor.list_documents(ext_list)
-    
-    if not docs:
+    stats = {"found": 0, "skipped": 0}
+    docs = _pending_documents(ingestor.iter_documents(ext_list), seen_index, stats)
+
+    console.print(f"📂 Escaneando [bold]{folder_path}[/bold]...\n")
+
+    # 3. Bucle de Procesamiento
+    table = _summary_table()
+
+    run_metrics = RunMetrics()
+    started = time.perf_counter()
+
+    pending = _PendingSaves(storage, seen_index, ExportSink.from_env(), batch_size=save_batch)
+
+    def handle(doc, outcome):
+        _record_outcome(doc, outcome, pending, table, run_metrics)
+
+    try:
+        if concurrency > 1:
+            # A. Extracción (IA) concurrente: N peticiones en vuelo, resultados en orden
+            console.print(f"⚡ Modo concurrente: hasta [bold]{concurrency}[/bold] extracciones simultáneas")
+            extractor = AsyncLLMExtractor(api_key, concurrency=concurrency, timeout=timeout,
+                                          cache=extraction_cache, preprocess=preprocess, limiter=limiter,
+                                          templates=template_engine, page_concurrency=page_concurrency,
+                                          models=model_cascade, http_client=_async_http_client(extraction_backend))
+            asyncio.run(_consume(extractor.extract_many(docs), handle))
+        else:
+            extractor = LLMExtractor(api_key, cache=extraction_cache, preprocess=preprocess, limiter=limiter,
+                                     templates=template_engine, page_concurrency=page_concurrency,
+                                     models=model_cascade, http_client=_http_client(extraction_backend))
+            for doc in docs:
+                # A. Extracción (IA)
+                console.print(f"🤖 Extrayendo: [italic]{doc.filename}[/italic]...")
+                try:
+                    outcome = extractor.extract(doc)
+                except Exception as e:
+                    outcome = e
+                handle(doc, outcome)
+    finally:
+        pending.close()  # Lo extraído hasta aquí se guarda aunque se interrumpa el proceso
+    elapsed = time.perf_counter() - started
+
+    found, skipped = stats["found"], stats["skipped"]
+    if not found:
         console.print(f"[yellow]No se encontraron archivos en {folder_path}[/yellow]")
         return
 
-    console.print(f"📂 Encontrados [bold]{len(docs)}[/bold] documentos para procesar.\n")
+    console.print("\n")
+    console.print(table)
+    if table.row_count >= MAX_TABLE_ROWS:
+        console.print(f"(Mostrando las primeras {MAX_TABLE_ROWS} filas de {found - skipped} documentos procesados)")
+    if skipped:
+        console.print(f"⏭️ Omitidos [bold]{skipped}[/bold] documentos ya procesados (sin llamada al LLM).")
+    if extraction_cache:
+        cache_stats = extraction_cache.stats()
+        console.print(
+            f"⚡ Caché de extracción: {cache_stats['hits']} aciertos / {cache_stats['misses']} fallos "
+            f"({cache_stats['hit_rate']:.0%}), {cache_stats['size_bytes'] / 1024:.0f} KB en disco"
+        )
+    _print_run_metrics(run_metrics)
+    processed = found - skipped
+    if processed:
+        console.print(f"🏁 Rendimiento: {processed} documentos en {elapsed:.1f}s ({processed / elapsed:.2f} docs/s)")
+    rule_timings = [row for row in DEFAULT_ENGINE.timings() if row["calls"]]
+    if rule_timings:
+        console.print("🧮 Reglas más lentas: " + ", ".join(
+            f"{row['rule']} ({row['avg_us']:.0f}µs media, máx {row['max_s'] * 1000:.1f}ms)" for row in rule_timings[:3]
+        ))
+    if extraction_backend.responder:
+        responder = extraction_backend.responder
+        console.print(f"📼 Replay: {responder.hits} respuestas grabadas, {responder.misses} no grabadas")
+    if limiter:
+        rl = limiter.metrics()
+        console.print(
+            f"🚦 Límite de ritmo: espera media {rl['avg_wait_s']:.2f}s (máx {rl['max_wait_s']:.1f}s), "
+            f"{rl['rate_limited']} respuestas 429, {rl['retries']} reintentos"
+        )
+    if template_engine and template_engine.hits + template_engine.misses:
+        attempts = template_engine.hits + template_engine.misses
+        console.print(
+            f"📐 Plantillas de proveedor: {template_engine.hits}/{attempts} parseadas en local "
+            f"({template_engine.hits / attempts:.0%}). Detalle por proveedor: python main.py templates-stats"
+        )
+    console.print(f"\n[bold green]✅ Proceso completado.[/bold green] Datos guardados en 'data/facturas.db' y exportados a 'output/' (CSV y Parquet)")
 
-    # 3. Bucle de Procesamiento
-    table = Table(title="Resumen de Procesamiento")
-    table.add_column("Archivo", style="cyan")
+@app.command()
+def templates_stats():
+    """
+    Muestra la tasa de acierto de las plantillas por proveedor.
+    """
+    rows = SupplierTemplateEngine().stats()
+    if not rows:
+        console.print("[yellow]Aún no hay plantillas aprendidas (se crean al extraer PDFs con texto en estado OK).[/yellow]")
+        return
+
+    table = Table(title="Plantillas de Proveedor")
+    table.add_column("CIF", style="cyan")
     table.add_column("Proveedor", style="magenta")
-    table.add_column("Total", justify="right", style="green")
-    table.add_column("Estado", justify="center")
-    table.add_column("Notas", style="red")
+    table.add_column("Muestras", justify="right")
+    table.add_column("Aciertos", justify="right", style="green")
+    table.add_column("Fallos", justify="right", style="red")
+    table.add_column("Tasa", justify="right")
+    for row in rows:
+        table.add_row(row["cif"], row["nombre_proveedor"] or "", str(row["samples"]), str(row["hits"]),
+                      str(row["misses"]), f"{row['hit_rate']:.0%}")
+    console.print(table)
 
-    for doc in docs:
-        try:
-            # A. Extracción (IA)
-            console.print(f"🤖 Extrayendo: [italic]{doc.filename}[/italic]...")
-            factura = extractor.extract(doc)
-            
-            # B. Validación (Lógica)
-            val_result = validate_invoice(factura)
-            
-            status = "OK"
-            notes = ""
-            
-            if not val_result.is_valid:
-                status = "ERROR"
-                notes = "; ".join(val_result.errors)
-            elif val_result.warnings:
-                status = "REVIEW"
-                notes = "; ".join(val_result.warnings)
-
-            # C. Persistencia (DB + CSV)
-            storage.save_invoice(doc.id, factura, status, notes)
-            storage.export_to_csv(factura)
-
-            # UI Update
-            status_style = "green" if status == "OK" else "yellow" if status == "REVIEW" else "red"
-            table.add_row(
-                doc.filename, 
-                factura.nombre_proveedor, 
-                f"{factura.total_factura:.2f} {factura.moneda}", 
-                f"[{status_style}]{status}[/{status_style}]",
-                notes
+@app.command()
+def cost_report(
+    limit: int = typer.Option(20, help="Número de proveedores a mostrar")
+):
+    """
+    Coste, tokens y latencia acumulados por proveedor (tabla extraction_metrics).
+    """
+    from sqlalchemy import func
+    from src.storage import DBFactura, DBExtractionMetrics
+
+    storage = Storage()
+    session = storage.Session()
+    try:
+        rows = (
+            session.query(
+                DBFactura.nombre_proveedor,
+                func.count(DBExtractionMetrics.id),
+                func.sum(DBExtractionMetrics.prompt_tokens + DBExtractionMetrics.completion_tokens),
+                func.sum(DBExtractionMetrics.cost_usd),
+                func.avg(DBExtractionMetrics.wall_time_s),
+                func.max(DBExtractionMetrics.wall_time_s),
+                func.avg(DBExtractionMetrics.payload_bytes),
+                func.sum(DBExtractionMetrics.validation_retries + DBExtractionMetrics.network_retries),
             )
+            .join(DBExtractionMetrics, DBExtractionMetrics.factura_id == DBFactura.id)
+            .group_by(DBFactura.nombre_proveedor)
+            .order_by(func.sum(DBExtractionMetrics.cost_usd).desc())
+            .limit(limit)
+            .all()
+        )
+    finally:
+        session.close()
 
-        except Exception as e:
-            console.print(f"[bold red]💥 Fallo crítico en {doc.filename}: {e}[/bold red]")
-            table.add_row(doc.filename, "ERROR", "0.00", "[red]CRASH[/red]", str(e))
+    if not rows:
+        console.print("[yellow]Aún no hay métricas de extracción guardadas.[/yellow]")
+        return
+
+    table = Table(title="Coste por Proveedor")
+    table.add_column("Proveedor", style="magenta")
+    table.add_column("Facturas", justify="right")
+    table.add_column("Tokens", justify="right")
+    table.add_column("Coste (USD)", justify="right", style="green")
+    table.add_column("Latencia media", justify="right")
+    table.add_column("Latencia máx", justify="right")
+    table.add_column("KB medios", justify="right")
+    table.add_column("Reintentos", justify="right", style="red")
+    for proveedor, n, tokens, cost, avg_time, max_time, avg_bytes, retries in rows:
+        table.add_row(proveedor or "?", str(n), f"{tokens or 0:,}", f"{cost or 0:.4f}", f"{avg_time or 0:.1f}s",
+                      f"{max_time or 0:.1f}s", f"{(avg_bytes or 0) / 1024:.0f}", str(retries or 0))
+    console.print(table)
+
+@app.command()
+def revalidate(
+    desde: str = typer.Option(None, help="Primera fecha de emisión a revalidar (YYYY-MM-DD)"),
+    hasta: str = typer.Option(None, help="Última fecha de emisión a revalidar (YYYY-MM-DD)"),
+    dry_run: bool = typer.Option(False, help="Calcular los cambios sin escribirlos"),
+    chunk_size: int = typer.Option(100_000, min=1, help="Facturas por bloque (memoria frente a velocidad)")
+):
+    """
+    Vuelve a aplicar las reglas de validación a las facturas ya guardadas.
+    """
+    from datetime import date
+    from src.bulk_validation import BulkRevalidator
+
+    try:
+        fecha_desde = date.fromisoformat(desde) if desde else None
+        fecha_hasta = date.fromisoformat(hasta) if hasta else None
+    except ValueError as e:
+        console.print(f"[bold red]❌ Fecha no válida:[/bold red] {e}")
+        raise typer.Exit(code=1)
+
+    storage = Storage()
+    report = BulkRevalidator(storage.engine, chunk_size=chunk_size).run(fecha_desde, fecha_hasta, dry_run=dry_run)
+    verb = "cambiarían" if dry_run else "cambiadas"
+    console.print(
+        f"🔁 Revalidadas {report.scanned - report.skipped:,} facturas en {report.seconds:.1f}s: "
+        f"{report.changed:,} {verb} ({report.to_ok:,} → OK, {report.to_review:,} → REVIEW, {report.to_error:,} → ERROR)"
+    )
+    if report.skipped:
+        console.print(f"⏭️ {report.skipped:,} facturas antiguas sin base imponible/impuestos guardados (no revalidables)")
+
+@app.command()
+def reindex(
+    workers: int = typer.Option(0, min=0, help="Procesos en paralelo (0 = uno por CPU)"),
+    chunk_size: int = typer.Option(10_000, min=1, help="Entradas del archivo por bloque")
+):
+    """
+    Reconstruye facturas e invoice_items desde el archivo de extracciones (sin llamar al LLM).
+    """
+    from src.reindex import ArchiveReindexer
+
+    storage = Storage()  # Aplica las migraciones: las columnas nuevas existen antes de rellenarlas
+    report = ArchiveReindexer(storage.engine, workers=workers, chunk_size=chunk_size).run()
+    if not report.entries:
+        console.print("[yellow]El archivo de extracciones está vacío.[/yellow]")
+        return
+    console.print(
+        f"🗃️ {report.entries:,} entradas del archivo en {report.seconds:.1f}s "
+        f"({report.entries / report.seconds:,.0f}/s): {report.updated:,} facturas reescritas, "
+        f"{report.inserted:,} recuperadas, {report.items:,} líneas"
+    )
+    console.print("💡 Estado y notas no cambian: usa [bold]revalidate[/bold] para aplicar las reglas actuales")
+
+@app.command()
+def export(
+    fmt: str = typer.Option("csv", "--format", help="Formato de salida: csv, parquet o xlsx"),
+    name: str = typer.Option("contabilidad", help="Destino de la exportación: cada uno tiene su propia marca"),
+    output: str = typer.Option("output/exports", help="Carpeta de salida (se crea <output>/<name>/)"),
+    full: bool = typer.Option(False, "--full", help="Exportar todo el histórico, no solo lo cambiado"),
+    dry_run: bool = typer.Option(False, help="Contar lo que se exportaría sin escribir ni mover la marca"),
+    chunk_size: int = typer.Option(5_000, min=1, help="Facturas por bloque del cursor"),
+    lag: float = typer.Option(60, min=0, help="Segundos recientes que se dejan para la siguiente exportación")
+):
+    """
+    Exporta las facturas nuevas o modificadas desde la última exportación (marca de agua).
+    """
+    from src.incremental_export import EXPORT_FORMATS, IncrementalExporter
+
+    if fmt not in EXPORT_FORMATS:
+        console.print(f"[bold red]❌ Formato no soportado:[/bold red] {fmt} (usa {', '.join(EXPORT_FORMATS)})")
+        raise typer.Exit(code=1)
+
+    storage = Storage()
+    exporter = IncrementalExporter(storage.engine, name=name, output_dir=output, fmt=fmt,
+                                   chunk_size=chunk_size, lag_seconds=lag)
+    try:
+        report = exporter.run(full=full, dry_run=dry_run)
+    except (RuntimeError, ValueError) as e:
+        console.print(f"[bold red]❌ Exportación cancelada (la marca no se ha movido):[/bold red] {e}")
+        raise typer.Exit(code=1)
+
+    since = f"desde {report.since.updated_at:%Y-%m-%d %H:%M:%S}" if report.since.updated_at else "histórico completo"
+    if not report.facturas:
+        console.print(f"[yellow]Nada nuevo que exportar a '{name}' ({since}).[/yellow]")
+        return
+    verb = "se exportarían" if dry_run else "exportadas"
+    console.print(f"📤 {report.facturas:,} facturas y {report.items:,} líneas {verb} ({since}) en {report.seconds:.1f}s")
+    for path in report.files:
+        console.print(f"   {path}")
+    if not dry_run:
+        console.print(f"🔖 Marca de '{name}': {report.watermark.updated_at:%Y-%m-%d %H:%M:%S} (id {report.watermark.last_id})")
+
+@app.command()
+def check_schema(
+    verbose: bool = typer.Option(False, "--verbose", "-v", help="Mostrar el plan completo de cada consulta")
+):
+    """
+    Versión del esquema y comprobación de que cada consulta importante usa su índice (código 1 si no).
+    """
+    from src.migrations import MIGRATIONS, applied_migrations
+    from src.query_plans import check_query_plans
+
+    storage = Storage()  # Aplica las migraciones pendientes
+    applied = applied_migrations(storage.engine)
+    console.print(f"🗄️ Esquema en la versión {applied[-1]['version'] if applied else 0} "
+                  f"({len(applied)}/{len(MIGRATIONS)} migraciones)")
+    for row in applied:
+        console.print(f"   {row['version']:03d} · {row['applied_at']:%Y-%m-%d %H:%M} · {row['description']}")
+
+    checks = check_query_plans(storage.engine)
+    if not checks:
+        console.print("[yellow]La comprobación de planes solo está disponible con SQLite.[/yellow]")
+        return
+    table = Table(title="Planes de Consulta")
+    table.add_column("Consulta", style="cyan")
+    table.add_column("Índice esperado", style="magenta")
+    table.add_column("", justify="center")
+    table.add_column("Plan")
+    for check in checks:
+        plan = check.plan if verbose or not check.ok else [line for line in check.plan if check.path.index in line]
+        table.add_row(check.path.name, check.path.index, "✅" if check.ok else "❌", "\n".join(plan))
+    console.print(table)
+    failed = [check for check in checks if not check.ok]
+    if failed:
+        console.print(f"[bold red]❌ {len(failed)} consultas no usan su índice[/bold red]")
+        raise typer.Exit(code=1)
+
+# -----------------------------------------------------------------------------
+# MODO BATCH (cierres de mes: más barato, sin latencia interactiva)
+# -----------------------------------------------------------------------------
+
+def _batch_client() -> OpenAI:
+    """Cliente OpenAI para la Batch API (respeta OPENAI_BASE_URL para pruebas locales)."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        console.print("[bold red]❌ Error:[/bold red] No se encontró OPENAI_API_KEY en .env")
+        raise typer.Exit(code=1)
+    return OpenAI(api_key=api_key, base_url=os.getenv("OPENAI_BASE_URL"))
+
+@app.command()
+def batch_submit(
+    folder_path: str = typer.Argument(..., help="Carpeta con facturas (PDF/Imágenes)"),
+    name: str = typer.Option(..., help="Nombre del batch (ej: 2024-01). Reutilízalo para reanudar"),
+    extensions: str = typer.Option("pdf,jpg,png,jpeg,tif,tiff", help="Extensiones a buscar separadas por coma"),
+    model: str = typer.Option("gpt-4o", help="Modelo a usar en el batch")
+):
+    """
+    Genera el JSONL de peticiones de una carpeta y lo envía a la Batch API.
+    """
+    runner = BatchRunner(_batch_client(), name)
+    seen_index = SeenIndex()
+    stats = {"found": 0, "skipped": 0}
+
+    ext_list = [f".{e.strip()}" for e in extensions.split(",")]
+    docs = _pending_documents(LocalFileIngestor(folder_path).iter_documents(ext_list), seen_index, stats)
+
+    n_requests = runner.prepare(docs, model)
+    if not n_requests:
+        console.print(f"[yellow]No hay documentos nuevos en {folder_path}[/yellow]")
+        return
+
+    console.print(f"📦 Batch '{name}': [bold]{n_requests}[/bold] peticiones en {runner.state.requests_file}")
+    batch_id = runner.submit()
+    console.print(f"🚀 Batch enviado: [bold]{batch_id}[/bold]. Recoge los resultados con: python main.py batch-collect --name {name}")
+
+@app.command()
+def batch_collect(
+    name: str = typer.Option(..., help="Nombre del batch usado en batch-submit"),
+    wait: bool = typer.Option(True, help="Esperar (poll) hasta que el batch termine"),
+    poll_interval: float = typer.Option(30.0, help="Segundos entre consultas de estado")
+):
+    """
+    Espera a que termine un batch y concilia sus resultados (validación + DB + CSV).
+    """
+    runner = BatchRunner(_batch_client(), name)
+    status = runner.wait(poll_interval) if wait else runner.poll()
+    if status not in FINAL_STATES:
+        console.print(f"[yellow]⏳ Batch '{name}' en estado '{status}'. Vuelve a intentarlo más tarde.[/yellow]")
+        return
+    if not runner.state.output_file_id and not runner.state.error_file_id:
+        console.print(f"[bold red]❌ Batch '{name}' terminó en estado '{status}' sin resultados.[/bold red]")
+        raise typer.Exit(code=1)
+
+    storage = Storage()
+    seen_index = SeenIndex()
+    table = _summary_table()
+
+    # Solo se marca como conciliado lo que ya está en la DB: si el proceso se corta con
+    # facturas en el búfer, al reanudar se vuelven a procesar en vez de perderse
+    pending = _PendingSaves(storage, seen_index, ExportSink.from_env(),
+                            on_flushed=lambda document_ids: runner.mark_reconciled(*document_ids))
+
+    reconciled = 0
+    try:
+        for doc, outcome in runner.results():
+            queued = pending.queued
+            _record_outcome(doc, outcome, pending, table)
+            if pending.queued == queued:
+                # No llegó a la DB (error del batch o de validación): reintentarlo no lo arregla
+                runner.mark_reconciled(doc.id)
+            reconciled += 1
+    finally:
+        pending.close()
 
-    console.print("\n")
     console.print(table)
-    console.print(f"\n[bold green]✅ Proceso completado.[/bold green] Datos guardados en 'data/facturas.db' y 'output/facturas.csv'")
+    console.print(f"\n[bold green]✅ Batch '{name}' conciliado:[/bold green] {reconciled} resultados nuevos procesados.")
 
 if __name__ == "__main__":
     app()
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
+from instructor import openai_schema
+from openai import OpenAI
+from .models import Factura
+from .ingestor import Document
+from .image_preprocessing import PreprocessConfig
+from .llm_extractor import build_messages
+
+# -----------------------------------------------------------------------------
+# 11. MODO BATCH (Procesamiento diferido para cierres de mes)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la forma "a granel" de procesar facturas: en lugar de una llamada por factura
+# esperando la respuesta, generamos un archivo JSONL con TODAS las peticiones, lo
+# subimos a la Batch API, y recogemos los resultados cuando estén listos (< 24h).
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Coste: La Batch API de OpenAI cuesta la mitad que la API interactiva y tiene
+#    una cuota separada. Para 3.000 facturas a fin de mes no necesitamos latencia.
+# 2. Reanudable: Todo el estado (archivo subido, ID del batch) vive en un JSON en
+#    data/batches/, y las facturas ya guardadas en un log append-only al lado. Si el
+#    proceso muere a mitad, se vuelve a lanzar y continúa donde se quedó.
+# 3. Mismo contrato: Cada petición pide una "tool call" con el JSON Schema de
+#    `Factura` (lo mismo que hace instructor), y la respuesta se valida con Pydantic.
+# 4. Testeable en local: El cliente respeta `base_url` (u OPENAI_BASE_URL), así que
+#    se puede apuntar al servidor de pruebas (src/local_api_server.py) y medir
+#    throughput y conciliación sin internet.
+# -----------------------------------------------------------------------------
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+@dataclass
+class BatchState:
+    """Estado persistente de un batch (se guarda como JSON tras cada paso)."""
+    name: str
+    model: str
+    requests_file: str
+    documents: Dict[str, dict] = field(default_factory=dict)  # custom_id -> {filename, filepath}
+    input_file_id: Optional[str] = None
+    batch_id: Optional[str] = None
+    status: str = "prepared"
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+
+    @classmethod
+    def load(cls, path: Path) -> "BatchState":
+        with open(path, encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def save(self, path: Path):
+        # Escritura atómica: si morimos a mitad, el JSON anterior sigue intacto
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+    def document(self, custom_id: str) -> Document:
+        info = self.documents[custom_id]
+        return Document(
+            id=custom_id,
+            filename=info["filename"],
+            filepath=info["filepath"],
+            source="batch",
+            content_hash=custom_id.replace("sha256_", "", 1)
+        )
+
+# Resultado de una línea del batch: la Factura o el error que impidió obtenerla
+BatchOutcome = Union[Factura, Exception]
+
+def build_request(document: Document, model: str, preprocess: Optional[PreprocessConfig] = None) -> dict:
+    """Convierte un documento en una línea JSONL de la Batch API."""
+    tool = openai_schema(Factura).openai_schema
+    return {
+        "custom_id": document.id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "temperature": 0.0,
+            "messages": build_messages(document, preprocess),
+            "tools": [{"type": "function", "function": tool}],
+            "tool_choice": {"type": "function", "function": {"name": tool["name"]}},
+        },
+    }
+
+def parse_result_line(line: dict) -> BatchOutcome:
+    """Extrae y valida la Factura de una línea del archivo de resultados."""
+    if line.get("error"):
+        return RuntimeError(f"Error en batch: {line['error']}")
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        return RuntimeError(f"HTTP {response.get('status_code')}: {response.get('body')}")
+    try:
+        message = response["body"]["choices"][0]["message"]
+        arguments = message["tool_calls"][0]["function"]["arguments"]
+        return Factura.model_validate_json(arguments)
+    except Exception as e:
+        return e
+
+class BatchRunner:
+    """
+    Prepara, envía, espera y descarga un batch, guardando el estado en cada paso.
+
+    Cada método es idempotente: si el paso ya se hizo (según el estado en disco),
+    no se repite. Por eso basta con volver a llamar a la misma secuencia para
+    reanudar un proceso interrumpido.
+    """
+
+    def __init__(self, client: OpenAI, name: str, state_dir: str = "data/batches"):
+        self.client = client
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.state_path = self.state_dir / f"{name}.json"
+        self.reconciled_path = self.state_dir / f"{name}.reconciled"
+        self.name = name
+        self.state: Optional[BatchState] = BatchState.load(self.state_path) if self.state_path.exists() else None
+
+    def prepare(self, documents: Iterable[Document], model: str,
+                preprocess: Optional[PreprocessConfig] = None) -> int:
+        """Escribe el JSONL de peticiones (en streaming). Devuelve nº de peticiones."""
+        if self.state is not None:
+            return len(self.state.documents)
+
+        requests_file = self.state_dir / f"{self.name}.requests.jsonl"
+        state = BatchState(name=self.name, model=model, requests_file=str(requests_file))
+        with open(requests_file, "w", encoding="utf-8") as f:
+            for doc in documents:
+                if doc.id in state.documents:
+                    continue  # Mismo contenido dos veces en la carpeta
+                try:
+                    request = build_request(doc, model, preprocess)
+                except Exception as e:
+                    print(f"⚠️ {doc.filename} no se incluye en el batch: {e}")
+                    continue
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+                state.documents[doc.id] = {"filename": doc.filename, "filepath": doc.filepath}
+
+        if not state.documents:
+            # Sin estado guardado: el nombre queda libre para cuando haya documentos
+            requests_file.unlink(missing_ok=True)
+            return 0
+        self.state = state
+        self.state.save(self.state_path)
+        return len(state.documents)
+
+    def submit(self) -> str:
+        """Sube el JSONL y crea el batch (si no se hizo ya). Devuelve el batch_id."""
+        state = self._require_state()
+        if not state.input_file_id:
+            with open(state.requests_file, "rb") as f:
+                uploaded = self.client.files.create(file=f, purpose="batch")
+            state.input_file_id = uploaded.id
+            state.save(self.state_path)
+
+        if not state.batch_id:
+            batch = self.client.batches.create(
+                input_file_id=state.input_file_id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window="24h",
+                metadata={"name": state.name},
+            )
+            state.batch_id = batch.id
+            state.status = batch.status
+            state.save(self.state_path)
+
+        return state.batch_id
+
+    def poll(self) -> str:
+        """Consulta el estado del batch una vez y lo guarda."""
+        state = self._require_state()
+        if state.status in FINAL_STATES:
+            return state.status
+        if not state.batch_id:
+            # El envío se cortó tras subir (o antes de subir) el archivo: no hay nada que consultar
+            print(f"⚠️ El batch '{state.name}' aún no se ha enviado. Vuelve a ejecutar: python main.py batch-submit <carpeta> --name {state.name}")
+            return state.status
+
+        batch = self.client.batches.retrieve(state.batch_id)
+        state.status = batch.status
+        state.output_file_id = batch.output_file_id
+        state.error_file_id = batch.error_file_id
+        state.save(self.state_path)
+
+        counts = batch.request_counts
+        if counts is not None:
+            print(f"⏳ Batch {state.batch_id}: {batch.status} ({counts.completed}/{counts.total} completadas, {counts.failed} fallidas)")
+        return state.status
+
+    def wait(self, poll_interval: float = 30.0, max_wait: Optional[float] = None) -> str:
+        """Hace poll hasta que el batch termina (o se agota `max_wait`)."""
+        started = time.monotonic()
+        status = self.poll()
+        while status not in FINAL_STATES:
+            if not self.state.batch_id:
+                # Sin enviar no va a cambiar de estado: esperar sería un bucle infinito
+                break
+            if max_wait is not None and time.monotonic() - started >= max_wait:
+                break
+            time.sleep(poll_interval)
+            status = self.poll()
+        return status
+
+    def results(self) -> Iterator[Tuple[Document, BatchOutcome]]:
+        """Descarga los resultados y devuelve los pares (documento, resultado) pendientes."""
+        state = self._require_state()
+        done = self._load_reconciled()
+
+        for file_id in (state.output_file_id, state.error_file_id):
+            if not file_id:
+                continue
+            content = self.client.files.content(file_id).text
+            for raw in content.splitlines():
+                if not raw.strip():
+                    continue
+                line = json.loads(raw)
+                custom_id = line.get("custom_id")
+                if custom_id in done or custom_id not in state.documents:
+                    continue
+                yield state.document(custom_id), parse_result_line(line)
+
+    def _load_reconciled(self) -> set:
+        if not self.reconciled_path.exists():
+            return set()
+        with open(self.reconciled_path, encoding="utf-8") as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def mark_reconciled(self, *custom_ids: str):
+        """Registra que unos resultados ya se guardaron (para no repetirlos al reanudar)."""
+        if not custom_ids:
+            return
+        # Append de unas líneas: O(1) por factura, sin reescribir el estado entero
+        with open(self.reconciled_path, "a", encoding="utf-8") as f:
+            f.write("".join(custom_id + "\n" for custom_id in custom_ids))
+
+    def _require_state(self) -> BatchState:
+        if self.state is None:
+            raise RuntimeError(f"No existe el batch '{self.name}'. Ejecuta primero batch-submit.")
+        return self.state
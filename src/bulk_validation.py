@@ -0,0 +1,240 @@
+import time
+from dataclasses import dataclass
+from datetime import date
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.engine import Engine
+from .storage import DBFactura, DBItemFactura
+from .duplicates import MSG_DUPLICADO
+from .supplier_registry import get_supplier_registry, is_spanish_tax_id, valid_tax_id
+from .validator import (
+    DEFAULT_ENGINE, RuleEngine,
+    MSG_TOTALES, MSG_SIN_NUMERO, MSG_SIN_FECHA, MSG_SIN_LINEAS, MSG_SUMA_LINEAS,
+    MSG_CIF_INVALIDO, MSG_PROVEEDOR_DESCONOCIDO,
+)
+
+# -----------------------------------------------------------------------------
+# 20. REVALIDACIÓN MASIVA (Reglas vectorizadas sobre todo el histórico)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es `validate_invoice` aplicado a millones de facturas guardadas de una vez.
+# Cuando cambia una regla, las facturas ya guardadas conservan el estado antiguo;
+# este módulo recalcula `status` y `validation_notes` de un rango de fechas.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Vectorizado: Reconstruir un objeto Pydantic por factura y validarlo de uno en
+#    uno tarda horas con 2M de filas. Aquí las cabeceras y la suma de sus líneas
+#    (agregada en la DB) se cargan en columnas (pandas/NumPy) y cada regla es UNA
+#    operación sobre el bloque entero.
+# 2. Por bloques: Se recorren las facturas por id (paginación por clave) de
+#    `chunk_size` en `chunk_size`. La memoria no crece con el histórico y cada
+#    bloque se confirma en su propia transacción.
+# 3. Solo lo que cambia: Se escriben únicamente las filas cuyo estado o notas
+#    difieren, con un UPDATE ejecutado en lote (executemany).
+# 4. Mismo resultado: Tolerancias y mensajes son los de validator.py, así que una
+#    factura revalidada queda igual que si se acabara de procesar.
+# 5. Filas antiguas: Las guardadas antes de existir `base_imponible` y
+#    `total_impuestos` no se pueden revalidar (faltan datos): se cuentan y se dejan igual.
+# 6. Sin reglas olvidadas: Las tolerancias salen del motor de reglas y, si se
+#    declara una regla sin versión vectorizada aquí, `BulkRevalidator` se niega a
+#    arrancar (daría estados distintos de los de la validación fila a fila).
+# 7. Duplicados: Una factura marcada como posible duplicado (`duplicate_of`)
+#    conserva la marca y su nota tras revalidar (src/duplicates.py).
+# -----------------------------------------------------------------------------
+
+# Reglas del motor que `revalidate_frame` sabe aplicar por columnas
+VECTORISED_RULES = ("totales", "numero_factura", "fecha_emision", "lineas", "suma_lineas",
+                    "cif_proveedor", "proveedor_conocido")
+
+@dataclass
+class RevalidationReport:
+    """Resumen de una revalidación."""
+    scanned: int = 0      # Facturas del rango
+    skipped: int = 0      # Sin base/impuestos guardados (no revalidables)
+    changed: int = 0      # Filas cuyo estado o notas cambiaron
+    to_ok: int = 0
+    to_review: int = 0
+    to_error: int = 0
+    seconds: float = 0.0
+
+def _messages(mask: np.ndarray, index: pd.Index, text) -> pd.Series:
+    """Columna con el mensaje de una regla en las filas que la incumplen ('' en el resto)."""
+    column = pd.Series("", index=index, dtype=object)
+    if mask.any():
+        column[mask] = text(mask) if callable(text) else text
+    return column
+
+def _join(parts: List[pd.Series]) -> pd.Series:
+    """Une columnas de mensajes con '; ' saltándose las vacías (como `ValidationResult.notes`)."""
+    joined = parts[0]
+    for part in parts[1:]:
+        separator = np.where((joined != "") & (part != ""), "; ", "")
+        joined = joined + separator + part
+    return joined
+
+def _cif_invalido(cif: str) -> bool:
+    return bool(cif) and is_spanish_tax_id(cif) and not valid_tax_id(cif)
+
+def revalidate_frame(headers: pd.DataFrame, items: pd.DataFrame, rules: RuleEngine = DEFAULT_ENGINE) -> pd.DataFrame:
+    """
+    Aplica las reglas de `validate_invoice` a un bloque de facturas.
+
+    `headers`: una fila por factura (índice = id) con numero_factura, fecha_emision,
+    base_imponible, total_impuestos, total_factura, cif_proveedor y las claves
+    normalizadas cif_norm y proveedor_norm. `items`: suma (`suma_lineas`) y
+    número (`n_lineas`) de líneas por factura (índice = factura_id; sin fila = sin líneas).
+    Devuelve `status` y `validation_notes` con el mismo texto que la validación fila a fila.
+    """
+    tolerancia_totales = rules.rule("totales").tolerance
+    tolerancia_lineas = rules.rule("suma_lineas").tolerance
+    base = headers["base_imponible"].to_numpy(dtype=float)
+    impuestos = headers["total_impuestos"].to_numpy(dtype=float)
+    total = headers["total_factura"].to_numpy(dtype=float)
+
+    suma = items["suma_lineas"].reindex(headers.index, fill_value=0.0).to_numpy(dtype=float)
+    n_lineas = items["n_lineas"].reindex(headers.index, fill_value=0).to_numpy()
+
+    # 1. Totales: Base + Impuestos = Total
+    diferencia = np.abs(base + impuestos - total)
+    error_totales = diferencia > tolerancia_totales
+    # 2. Campos obligatorios
+    sin_numero = headers["numero_factura"].fillna("").to_numpy() == ""
+    sin_fecha = headers["fecha_emision"].isna().to_numpy()
+    # 3. Líneas: que existan y que su suma cuadre con Base o con Total
+    sin_lineas = n_lineas == 0
+    suma_mal = (~sin_lineas & (np.abs(suma - base) > tolerancia_lineas)
+                & (np.abs(suma - total) > tolerancia_lineas))
+    # 4. Proveedor: control del CIF (por valor distinto, con caché) y presencia en el maestro
+    cif_norm = headers["cif_norm"].fillna("")
+    cif_mal = cif_norm.map(_cif_invalido).to_numpy(dtype=bool)
+    registry = get_supplier_registry()
+    if registry.available:
+        conocido = cif_norm.isin(registry.known_cifs()) | headers["proveedor_norm"].isin(registry.known_names())
+        desconocido = ~conocido.to_numpy()
+    else:
+        desconocido = np.zeros(len(headers), dtype=bool)
+
+    # Solo se formatean los mensajes de las filas que incumplen (pocas)
+    index = headers.index
+    errores = _messages(error_totales, index, lambda m: [
+        MSG_TOTALES.format(base=b, impuestos=i, total=t, diferencia=d)
+        for b, i, t, d in zip(base[m].tolist(), impuestos[m].tolist(), total[m].tolist(), diferencia[m].tolist())
+    ])
+    avisos = _join([
+        _messages(sin_numero, index, MSG_SIN_NUMERO),
+        _messages(sin_fecha, index, MSG_SIN_FECHA),
+        _messages(sin_lineas, index, MSG_SIN_LINEAS),
+        _messages(suma_mal, index, lambda m: [MSG_SUMA_LINEAS.format(suma=s) for s in suma[m].tolist()]),
+        _messages(cif_mal, index, lambda m: [MSG_CIF_INVALIDO.format(cif=c) for c in headers["cif_proveedor"][m].tolist()]),
+        _messages(desconocido, index, MSG_PROVEEDOR_DESCONOCIDO),
+    ])
+
+    con_avisos = sin_numero | sin_fecha | sin_lineas | suma_mal | cif_mal | desconocido
+    return pd.DataFrame({
+        "status": np.where(error_totales, "ERROR", np.where(con_avisos, "REVIEW", "OK")),
+        "validation_notes": errores.where(error_totales, avisos),
+    }, index=index)
+
+def _flag_duplicates(result: pd.DataFrame, duplicate_of: pd.Series) -> pd.DataFrame:
+    """Versión por columnas de `duplicates.flag_duplicate`: OK → REVIEW y la nota delante."""
+    mask = duplicate_of.notna().to_numpy()
+    if not mask.any():
+        return result
+    result = result.copy()
+    original = duplicate_of[mask].astype(int)
+    notes = result.loc[mask, "validation_notes"]
+    message = pd.Series([MSG_DUPLICADO.format(original=o) for o in original.tolist()], index=notes.index)
+    result.loc[mask, "validation_notes"] = message.where(notes == "", message + "; " + notes)
+    result.loc[mask & (result["status"] == "OK").to_numpy(), "status"] = "REVIEW"
+    return result
+
+class BulkRevalidator:
+    """Recalcula el estado de las facturas guardadas, por bloques y con reglas vectorizadas."""
+
+    def __init__(self, engine: Engine, chunk_size: int = 100_000, rules: RuleEngine = DEFAULT_ENGINE):
+        missing = [rule.name for rule in rules.rules if rule.name not in VECTORISED_RULES]
+        if missing:
+            raise ValueError(f"Reglas sin versión vectorizada en bulk_validation: {missing}")
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.rules = rules
+
+    @staticmethod
+    def _in_range(query, desde: Optional[date], hasta: Optional[date]):
+        if desde is not None:
+            query = query.where(DBFactura.fecha_emision >= desde)
+        if hasta is not None:
+            query = query.where(DBFactura.fecha_emision <= hasta)
+        return query
+
+    def _headers_query(self, last_id: int, desde: Optional[date], hasta: Optional[date]):
+        query = (
+            select(DBFactura.id, DBFactura.numero_factura, DBFactura.fecha_emision, DBFactura.base_imponible,
+                   DBFactura.total_impuestos, DBFactura.total_factura, DBFactura.status, DBFactura.validation_notes,
+                   DBFactura.cif_proveedor, DBFactura.cif_norm, DBFactura.proveedor_norm, DBFactura.duplicate_of)
+            .where(DBFactura.id > last_id)
+            .order_by(DBFactura.id)
+            .limit(self.chunk_size)
+        )
+        return self._in_range(query, desde, hasta)
+
+    def _items_query(self, first_id: int, last_id: int, desde: Optional[date], hasta: Optional[date]):
+        # La suma y el recuento por factura los hace la DB (usando el índice de
+        # factura_id): a pandas llega una fila por factura, no una por línea.
+        # Con filtro de fechas las facturas del bloque no son contiguas: se cruzan con
+        # la cabecera para no sumar las líneas de las que quedan fuera del rango.
+        query = (
+            select(DBItemFactura.factura_id,
+                   func.sum(DBItemFactura.total_linea).label("suma_lineas"),
+                   func.count(DBItemFactura.id).label("n_lineas"))
+            .join(DBFactura, DBFactura.id == DBItemFactura.factura_id)
+            .where(DBFactura.id.between(first_id, last_id))
+            .group_by(DBItemFactura.factura_id)
+        )
+        return self._in_range(query, desde, hasta)
+
+    def run(self, desde: Optional[date] = None, hasta: Optional[date] = None,
+            dry_run: bool = False) -> RevalidationReport:
+        """Revalida las facturas emitidas entre `desde` y `hasta` (sin límites = todas)."""
+        report = RevalidationReport()
+        started = time.perf_counter()
+        write = (
+            update(DBFactura.__table__)
+            .where(DBFactura.__table__.c.id == bindparam("b_id"))
+            .values(status=bindparam("b_status"), validation_notes=bindparam("b_notes"))
+        )
+        last_id = 0
+        while True:
+            with self.engine.begin() as conn:  # Un bloque = una transacción
+                headers = pd.read_sql(self._headers_query(last_id, desde, hasta), conn, index_col="id")
+                if headers.empty:
+                    break
+                last_id = int(headers.index[-1])
+                report.scanned += len(headers)
+
+                known = (headers["base_imponible"].notna() & headers["total_impuestos"].notna()).to_numpy()
+                report.skipped += int((~known).sum())
+                headers = headers[known]
+                if headers.empty:
+                    continue
+
+                items = pd.read_sql(self._items_query(int(headers.index[0]), int(headers.index[-1]), desde, hasta),
+                                    conn, index_col="factura_id")
+                result = _flag_duplicates(revalidate_frame(headers, items, self.rules), headers["duplicate_of"])
+
+                changed = ((result["status"] != headers["status"])
+                           | (result["validation_notes"] != headers["validation_notes"].fillna(""))).to_numpy()
+                result = result[changed]
+                report.changed += len(result)
+                report.to_ok += int((result["status"] == "OK").sum())
+                report.to_review += int((result["status"] == "REVIEW").sum())
+                report.to_error += int((result["status"] == "ERROR").sum())
+                if not dry_run and len(result):
+                    conn.execute(write, [
+                        {"b_id": int(factura_id), "b_status": status, "b_notes": notes}
+                        for factura_id, status, notes in zip(result.index, result["status"], result["validation_notes"])
+                    ])
+        report.seconds = time.perf_counter() - started
+        return report
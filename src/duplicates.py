@@ -0,0 +1,89 @@
+import re
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+# -----------------------------------------------------------------------------
+# 21. DETECCIÓN DE DUPLICADOS (La misma factura en otro archivo)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es el "¿esta factura no la habíamos pagado ya?". El skip-index (seen_index.py)
+# solo reconoce el MISMO archivo. Un proveedor que reenvía el PDF, o el escaneo de
+# una copia impresa, son archivos distintos con la misma factura dentro.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Dos pistas: (a) la clave fiscal (CIF + número de factura) normalizada, que
+#    identifica una factura por ley; (b) si falta alguno de los dos, mismo
+#    proveedor + misma fecha + mismo total (± TOLERANCIA_DUPLICADO).
+# 2. Normalizar antes de comparar: "B-12.345.678" y "ES B12345678" son el mismo
+#    CIF; "F-2024/001" y "f 2024 001" el mismo número; "Ferretería López, S.L."
+#    y "FERRETERIA LOPEZ SL" el mismo proveedor.
+# 3. O(log n): Las claves normalizadas se guardan como columnas de `facturas` con
+#    índices compuestos (storage.py). Cada comprobación es una búsqueda en un
+#    B-tree, igual de rápida con mil facturas que con millones.
+# 4. No se descarta nada: Un posible duplicado se guarda en REVIEW con un puntero
+#    (`duplicate_of`) a la original. Decide una persona; a veces son dos facturas
+#    legítimas con el mismo importe.
+# -----------------------------------------------------------------------------
+
+# Diferencia máxima de total para considerar dos facturas la misma (céntimos de redondeo)
+TOLERANCIA_DUPLICADO = 0.01
+
+MSG_DUPLICADO = "Posible duplicado de la factura #{original}"
+
+# Formas jurídicas que no distinguen a un proveedor de otro
+_FORMAS_JURIDICAS = {"SL", "SA", "SLU", "SAU", "SLL", "SC", "CB", "SCOOP", "SLNE"}
+
+@dataclass
+class DuplicateMatch:
+    """Factura ya guardada que parece la misma que la nueva."""
+    factura_id: int
+    document_id: str
+    reason: str  # "clave" (CIF + número) | "importe" (proveedor + fecha + total)
+
+def _ascii(text: str) -> str:
+    """Mayúsculas y sin acentos."""
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode().upper()
+
+@lru_cache(maxsize=65_536)  # Los mismos proveedores se repiten en miles de facturas
+def normalise_cif(cif: Optional[str]) -> Optional[str]:
+    """CIF/NIF/VAT sin separadores ni prefijo de país español. None si viene vacío."""
+    if not cif:
+        return None
+    value = re.sub(r"[^A-Z0-9]", "", _ascii(cif))
+    if value.startswith("ES") and len(value) == 11:
+        value = value[2:]
+    return value or None
+
+def normalise_numero(numero: Optional[str]) -> Optional[str]:
+    """Número de factura sin separadores ni espacios. None si viene vacío."""
+    if not numero:
+        return None
+    return re.sub(r"[^A-Z0-9]", "", _ascii(numero)) or None
+
+@lru_cache(maxsize=65_536)
+def normalise_proveedor(nombre: Optional[str]) -> str:
+    """Nombre del proveedor sin acentos, puntuación ni forma jurídica ('' si no hay)."""
+    # "S.L." → "S L" → "SL": se juntan las iniciales sueltas antes de buscar la forma jurídica
+    tokens = re.sub(r"[^A-Z0-9]+", " ", _ascii(nombre or "")).split()
+    joined, buffer = [], ""
+    for token in tokens:
+        if len(token) == 1:
+            buffer += token
+            continue
+        if buffer:
+            joined.append(buffer)
+            buffer = ""
+        joined.append(token)
+    if buffer:
+        joined.append(buffer)
+    return "".join(token for token in joined if token not in _FORMAS_JURIDICAS)
+
+def flag_duplicate(status: str, notes: str, original_id: Optional[int]) -> Tuple[str, str]:
+    """Estado y notas de una factura que duplica a `original_id` (sin cambios si es None)."""
+    if original_id is None:
+        return status, notes
+    message = MSG_DUPLICADO.format(original=original_id)
+    # Un ERROR sigue siendo ERROR; un OK pasa a revisión
+    return ("REVIEW" if status == "OK" else status), (f"{message}; {notes}" if notes else message)
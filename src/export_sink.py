@@ -0,0 +1,335 @@
+import os
+import io
+import csv
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+from .models import Factura
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow es opcional: sin él solo se exporta el CSV
+    pa = pq = None
+
+# -----------------------------------------------------------------------------
+# 27. EXPORTACIÓN EN LOTE (CSV maestro y Parquet)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la salida de facturas hacia fuera de la DB: el CSV maestro de siempre
+# (output/facturas.csv) y, para analítica, ficheros Parquet de cabeceras y líneas
+# (output/parquet/facturas/*.parquet y output/parquet/invoice_items/*.parquet).
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. En lote: Antes cada factura abría el CSV, miraba si existía y escribía una
+#    línea. Ahora se acumulan en memoria y se escriben de golpe: un `open` y un
+#    `write` por lote. Lo pendiente se vuelca solo a los `flush_seconds`, aunque no
+#    lleguen más facturas, y siempre al cerrar.
+# 2. Sin líneas mezcladas: Los hilos del watcher escriben bajo un lock, y cada lote
+#    va al CSV en UNA escritura en modo append (que el sistema operativo no mezcla
+#    con la de otro proceso, como el dashboard).
+# 3. Parquet por columnas: Comprimido (zstd) y con tipos (fechas, números), se lee
+#    con pandas/DuckDB/Spark sin parsear texto. Se escribe en row groups de
+#    `row_group_size` filas; cada proceso escribe sus propios ficheros y los rota
+#    cada `file_rows` filas o `file_seconds` segundos (con un temporizador: también
+#    si no llegan más facturas). Hasta entonces, lo que no llena un row group está
+#    solo en memoria: un `kill -9` lo pierde del Parquet (no del CSV ni de la DB).
+# 4. Ficheros completos o nada: Un Parquet no se puede leer hasta que se cierra
+#    (el índice va al final). Mientras se escribe se llama `.parquet.tmp` y solo se
+#    renombra a `.parquet` al cerrarlo: quien lea la carpeta nunca ve uno a medias.
+# -----------------------------------------------------------------------------
+
+DEFAULT_CSV_PATH = "output/facturas.csv"
+DEFAULT_PARQUET_DIR = "output/parquet"
+
+CSV_HEADER = ["Fecha Emision", "Numero", "Proveedor", "CIF", "Base", "Impuestos", "Total", "Moneda", "Items Count"]
+
+if pa is not None:
+    FACTURAS_SCHEMA = pa.schema([
+        ("document_id", pa.string()),
+        ("numero_factura", pa.string()),
+        ("fecha_emision", pa.date32()),
+        ("nombre_proveedor", pa.string()),
+        ("cif_proveedor", pa.string()),
+        ("nombre_cliente", pa.string()),
+        ("base_imponible", pa.float64()),
+        ("total_impuestos", pa.float64()),
+        ("total_factura", pa.float64()),
+        ("moneda", pa.string()),
+        ("n_lineas", pa.int32()),
+    ])
+    ITEMS_SCHEMA = pa.schema([
+        ("document_id", pa.string()),
+        ("linea", pa.int32()),
+        ("descripcion", pa.string()),
+        ("cantidad", pa.float64()),
+        ("precio_unitario", pa.float64()),
+        ("total_linea", pa.float64()),
+    ])
+
+def csv_row(factura: Factura) -> list:
+    """Fila del CSV maestro de una factura."""
+    return [
+        factura.fecha_emision,
+        factura.numero_factura,
+        factura.nombre_proveedor,
+        factura.cif_proveedor,
+        factura.base_imponible,
+        factura.total_impuestos,
+        factura.total_factura,
+        factura.moneda,
+        len(factura.items),
+    ]
+
+def parquet_rows(document_id: str, factura: Factura) -> Tuple[dict, List[dict]]:
+    """Fila de cabecera y filas de líneas de una factura para los Parquet."""
+    header = dict(
+        document_id=document_id,
+        numero_factura=factura.numero_factura,
+        fecha_emision=factura.fecha_emision,
+        nombre_proveedor=factura.nombre_proveedor,
+        cif_proveedor=factura.cif_proveedor,
+        nombre_cliente=factura.nombre_cliente,
+        base_imponible=factura.base_imponible,
+        total_impuestos=factura.total_impuestos,
+        total_factura=factura.total_factura,
+        moneda=factura.moneda,
+        n_lineas=len(factura.items),
+    )
+    items = [dict(document_id=document_id, linea=n, descripcion=item.descripcion, cantidad=item.cantidad,
+                  precio_unitario=item.precio_unitario, total_linea=item.total_linea)
+             for n, item in enumerate(factura.items, start=1)]
+    return header, items
+
+class ParquetTableWriter:
+    """Escribe filas de una tabla en ficheros Parquet rotados, un row group cada `row_group_size` filas."""
+
+    def __init__(self, directory: str, schema, row_group_size: int = 10_000,
+                 file_rows: int = 1_000_000, file_seconds: float = 3600.0):
+        self.directory = Path(directory)
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.file_rows = file_rows
+        self.file_seconds = file_seconds
+        self._pending: List[dict] = []
+        self._writer = None
+        self._path: Optional[Path] = None
+        self._file_rows = 0
+        self._started_at: Optional[float] = None  # Primera fila del fichero en curso (escrita o pendiente)
+        self.files = 0  # Ficheros cerrados
+
+    def _open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f"part-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{self.files:04d}.parquet"
+        self._path = self.directory / name
+        self._writer = pq.ParquetWriter(f"{self._path}.tmp", self.schema, compression="zstd")
+        self._file_rows = 0
+
+    def _write_group(self, rows: List[dict]):
+        if self._writer is None:
+            self._open()
+        self._writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+        self._file_rows += len(rows)
+
+    def seconds_left(self) -> Optional[float]:
+        """Segundos hasta que toca cerrar el fichero en curso por tiempo (None si no hay filas)."""
+        if self._started_at is None:
+            return None
+        return max(0.0, self.file_seconds - (time.monotonic() - self._started_at))
+
+    def write(self, rows: List[dict]):
+        """Añade filas; escribe un row group por cada `row_group_size` acumuladas."""
+        if rows and self._started_at is None:
+            self._started_at = time.monotonic()
+        self._pending.extend(rows)
+        while len(self._pending) >= self.row_group_size:
+            group, self._pending = self._pending[:self.row_group_size], self._pending[self.row_group_size:]
+            self._write_group(group)
+        if self._file_rows >= self.file_rows or self.seconds_left() == 0:
+            self.close()
+
+    def close_if_expired(self):
+        """Cierra el fichero si ya cumplió `file_seconds` (aunque no hayan llegado más filas)."""
+        if self.seconds_left() == 0:
+            self.close()
+
+    def close(self):
+        """Escribe lo pendiente, cierra el fichero y lo hace visible (.tmp → .parquet)."""
+        if self._pending:
+            self._write_group(self._pending)
+            self._pending = []
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(f"{self._path}.tmp", self._path)
+            self._writer = None
+            self.files += 1
+        self._started_at = None
+
+class ExportSink:
+    """Exportación en lote al CSV maestro y (si hay pyarrow) a Parquet; segura entre hilos."""
+
+    def __init__(self, csv_path: Optional[str] = DEFAULT_CSV_PATH, parquet_dir: Optional[str] = DEFAULT_PARQUET_DIR,
+                 batch_size: int = 200, flush_seconds: float = 5.0, row_group_size: int = 10_000,
+                 parquet_file_seconds: float = 3600.0):
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._buffer: List[Tuple[str, Factura]] = []
+        self._timer: Optional[threading.Timer] = None
+        self._rotation_timer: Optional[threading.Timer] = None  # Cierre por tiempo de los Parquet
+        self.exported = 0
+        self.facturas = self.items = None
+        if parquet_dir and pa is None:
+            print("⚠️ pyarrow no está instalado: solo se exporta el CSV")
+        elif parquet_dir:
+            self.facturas = ParquetTableWriter(os.path.join(parquet_dir, "facturas"), FACTURAS_SCHEMA, row_group_size,
+                                               file_seconds=parquet_file_seconds)
+            self.items = ParquetTableWriter(os.path.join(parquet_dir, "invoice_items"), ITEMS_SCHEMA, row_group_size,
+                                            file_seconds=parquet_file_seconds)
+
+    @classmethod
+    def from_env(cls) -> "ExportSink":
+        return cls(csv_path=os.getenv("EXPORT_CSV", DEFAULT_CSV_PATH) or None,
+                   parquet_dir=os.getenv("EXPORT_PARQUET_DIR", DEFAULT_PARQUET_DIR) or None,
+                   batch_size=int(os.getenv("EXPORT_BATCH_SIZE", 200)),
+                   flush_seconds=float(os.getenv("EXPORT_FLUSH_SECONDS", 5.0)),
+                   parquet_file_seconds=float(os.getenv("EXPORT_PARQUET_FILE_SECONDS", 3600.0)))
+
+    def add(self, document_id: str, factura: Factura):
+        """Encola una factura guardada; se escribe al llenarse el lote o a los `flush_seconds`."""
+        with self._lock:
+            self._buffer.append((document_id, factura))
+            if len(self._buffer) >= self.batch_size:
+                self._flush_locked()
+            elif self._timer is None:
+                # Primera del lote: vuelco programado aunque no lleguen más
+                self._timer = threading.Timer(self.flush_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        if self.csv_path:
+            self._append_csv([factura for _, factura in batch])
+        if self.facturas is not None:
+            rows = [parquet_rows(document_id, factura) for document_id, factura in batch]
+            self.facturas.write([header for header, _ in rows])
+            self.items.write([item for _, items in rows for item in items])
+            self._schedule_rotation_locked()
+        self.exported += len(batch)
+        print(f"📊 Exportadas {len(batch)} facturas a {self.csv_path or 'Parquet'}")
+
+    def _schedule_rotation_locked(self):
+        """Programa el cierre por tiempo del Parquet en curso: sin él, con poco volumen las
+        filas se quedarían en memoria (invisibles) hasta que llegasen más o se cerrase el proceso."""
+        if self._rotation_timer is not None or self.facturas is None:
+            return
+        left = [s for s in (self.facturas.seconds_left(), self.items.seconds_left()) if s is not None]
+        if left:
+            self._rotation_timer = threading.Timer(min(left), self._rotate)
+            self._rotation_timer.daemon = True
+            self._rotation_timer.start()
+
+    def _rotate(self):
+        with self._lock:
+            self._rotation_timer = None
+            if self.facturas is None:
+                return
+            self.facturas.close_if_expired()
+            self.items.close_if_expired()
+            self._schedule_rotation_locked()
+
+    def _append_csv(self, facturas: List[Factura]):
+        out_dir = os.path.dirname(self.csv_path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        text = io.StringIO()
+        writer = csv.writer(text)
+        with open(self.csv_path, mode="a", newline="", encoding="utf-8") as f:
+            # Archivo nuevo (o vacío): cabecera. Se mira en el archivo ya abierto, no antes
+            if f.tell() == 0:
+                writer.writerow(CSV_HEADER)
+            writer.writerows(csv_row(factura) for factura in facturas)
+            f.write(text.getvalue())
+
+    def close(self):
+        """Vuelca lo pendiente y cierra los Parquet abiertos (al terminar el proceso)."""
+        with self._lock:
+            self._flush_locked()
+            if self._rotation_timer is not None:
+                self._rotation_timer.cancel()
+                self._rotation_timer = None
+            if self.facturas is not None:
+                self.facturas.close()
+                self.items.close()
+
+if __name__ == "__main__":
+    import argparse
+    import contextlib
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import date, timedelta
+
+    parser = argparse.ArgumentParser(description="Benchmark: CSV línea a línea frente a ExportSink en lote")
+    parser.add_argument("-n", type=int, default=20_000, help="Facturas a exportar")
+    parser.add_argument("--threads", type=int, default=8, help="Hilos escribiendo a la vez (como el watcher)")
+    args = parser.parse_args()
+
+    facturas = [
+        Factura(numero_factura=f"F-{i}", fecha_emision=date(2024, 1, 1) + timedelta(days=i % 365),
+                nombre_proveedor=f"Proveedor {i % 300}", base_imponible=100.0, total_impuestos=21.0,
+                total_factura=121.0, items=[{"descripcion": f"Concepto {j}", "cantidad": 1, "precio_unitario": 20.0,
+                                             "total_linea": 20.0} for j in range(5)])
+        for i in range(args.n)
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        # Lo de antes: abrir, comprobar si existe y escribir una línea, por factura
+        legacy = os.path.join(tmp, "una_a_una.csv")
+
+        def append_one(factura: Factura):
+            file_exists = os.path.isfile(legacy)
+            with open(legacy, mode="a", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                if not file_exists:
+                    writer.writerow(CSV_HEADER)
+                writer.writerow(csv_row(factura))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(append_one, facturas))
+        one_by_one = time.perf_counter() - started
+
+        def run_sink(sink: ExportSink) -> float:
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(args.threads) as pool:
+                list(pool.map(lambda ix: sink.add(f"doc-{ix[0]}", ix[1]), enumerate(facturas)))
+                sink.close()
+            return time.perf_counter() - started
+
+        csv_only = run_sink(ExportSink(os.path.join(tmp, "en_lote.csv"), parquet_dir=None))
+        both = run_sink(ExportSink(os.path.join(tmp, "en_lote_2.csv"), os.path.join(tmp, "parquet")))
+
+        with open(os.path.join(tmp, "en_lote.csv"), encoding="utf-8") as f:
+            batched_lines = sum(1 for _ in f)
+        print(f"🐢 CSV línea a línea:  {args.n} facturas en {one_by_one:.2f}s ({args.threads} hilos)")
+        print(f"🚀 ExportSink (CSV):   {args.n} facturas en {csv_only:.2f}s, x{one_by_one / csv_only:.1f} "
+              f"({batched_lines - 1} filas + 1 cabecera)")
+        print(f"🚀 ExportSink (CSV + Parquet): {both:.2f}s")
+        if pq is not None:
+            for table in ("facturas", "invoice_items"):
+                parquet = pq.ParquetDataset(os.path.join(tmp, "parquet", table))
+                rows = sum(fragment.metadata.num_rows for fragment in parquet.fragments)
+                groups = sum(fragment.metadata.num_row_groups for fragment in parquet.fragments)
+                print(f"   🗂️ Parquet {table}: {rows} filas en {groups} row groups")
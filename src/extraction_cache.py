@@ -0,0 +1,156 @@
+import json
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Type
+from pydantic import BaseModel
+from .models import Factura
+
+# -----------------------------------------------------------------------------
+# 8. CACHÉ PERSISTENTE DE EXTRACCIONES
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la "memoria" del extractor. Guarda en disco (SQLite) la Factura validada que
+# devolvió el LLM para un documento, y la devuelve al instante si se vuelve a pedir.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Reprocesar es gratis: Tras un crash, o al repetir un lote, los documentos que
+#    ya se extrajeron no vuelven a pasar por GPT-4o.
+# 2. Clave honesta: La clave combina el hash del archivo, el modelo, el texto del
+#    prompt y una huella del JSON Schema de `Factura`. Si cambias una `description`
+#    en src/models.py (que es parte del prompt), la huella cambia y las entradas
+#    antiguas dejan de usarse solas, sin tener que acordarse de borrar nada.
+# 3. Tamaño acotado: Política LRU por tamaño. Cuando la caché supera `max_bytes`,
+#    se borran las entradas usadas hace más tiempo.
+# -----------------------------------------------------------------------------
+
+def schema_fingerprint(model: Type[BaseModel] = Factura) -> str:
+    """Huella estable del JSON Schema del modelo (incluye las descriptions)."""
+    schema = json.dumps(model.model_json_schema(), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(schema.encode("utf-8")).hexdigest()
+
+class ExtractionCache:
+    """Caché en SQLite de Facturas extraídas, con expulsión LRU por tamaño."""
+
+    def __init__(self, db_path: str = "data/extraction_cache.db", max_bytes: int = 256 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.schema_version = schema_fingerprint(Factura)
+
+        # Contadores de la sesión (para el resumen del proceso)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._init_db()
+        self._total_bytes = self._load_total_bytes()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path)
+
+    def _init_db(self):
+        """Crea la tabla de la caché si no existe."""
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS extraction_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    created_at TIMESTAMP,
+                    last_access TIMESTAMP
+                )
+            """)
+            # Índice para encontrar rápido las entradas menos usadas (LRU)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_last_access ON extraction_cache (last_access)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _load_total_bytes(self) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM extraction_cache").fetchone()[0]
+        finally:
+            conn.close()
+
+    def make_key(self, content_hash: str, model_name: str, prompt: str) -> str:
+        """Clave = hash(contenido + modelo + prompt + versión del schema)."""
+        raw = "\n".join([content_hash, model_name, prompt, self.schema_version])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Factura]:
+        """Devuelve la Factura cacheada o None (y actualiza su último acceso)."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    "SELECT payload FROM extraction_cache WHERE cache_key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute(
+                    "UPDATE extraction_cache SET last_access = ? WHERE cache_key = ?",
+                    (datetime.now(), key)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+
+        self.hits += 1
+        return Factura.model_validate_json(row[0])
+
+    def put(self, key: str, factura: Factura):
+        """Guarda una Factura en la caché y expulsa entradas antiguas si hace falta."""
+        payload = factura.model_dump_json()
+        size = len(payload.encode("utf-8"))
+        now = datetime.now()
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                previous = conn.execute(
+                    "SELECT size_bytes FROM extraction_cache WHERE cache_key = ?", (key,)
+                ).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO extraction_cache (cache_key, payload, size_bytes, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, payload, size, now, now)
+                )
+                self._total_bytes += size - (previous[0] if previous else 0)
+                self._evict(conn)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Borra las entradas menos usadas hasta volver por debajo de max_bytes."""
+        while self._total_bytes > self.max_bytes:
+            rows = conn.execute(
+                "SELECT cache_key, size_bytes FROM extraction_cache ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            for cache_key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM extraction_cache WHERE cache_key = ?", (cache_key,))
+                self._total_bytes -= size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """Métricas de la caché: aciertos, fallos, tasa de acierto y tamaño."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self._total_bytes,
+        }
@@ -0,0 +1,139 @@
+import json
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+# -----------------------------------------------------------------------------
+# 17. MÉTRICAS DE EXTRACCIÓN (Tokens, coste y latencia por documento)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es el "taxímetro" de cada factura: cuántos tokens gastó, cuánto costó, cuánto
+# tardó, cuántos reintentos hubo y cuántos bytes subimos a la API.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. La factura de la API no dice QUÉ la encarece. Guardando estas métricas junto
+#    a cada factura (tabla `extraction_metrics`) podemos agrupar por proveedor,
+#    por tipo de documento o por tamaño de imagen y encontrar a los culpables.
+# 2. Tokens reales, no estimados: Leemos el `usage` de la respuesta de la API.
+#    Instructor suma en él los tokens de TODOS sus intentos de validación, así
+#    que un reintento por JSON mal formado también cuenta.
+# 3. Reintentos separados: Los de validación (el LLM devolvió algo inválido) y
+#    los de red/cuota (429, 5xx) tienen causas y remedios distintos.
+# 4. Coste estimado: Tokens × precio del modelo (`MODEL_PRICES`), llamada a llamada
+#    (con la cascada de modelos, un documento puede pasar por varios). Es una
+#    estimación: los precios cambian, actualízalos aquí.
+# -----------------------------------------------------------------------------
+
+# Precio en USD por millón de tokens: (entrada, salida)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Coste estimado en USD de una extracción (0 si el modelo no tiene precio)."""
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+def payload_bytes(messages: list) -> int:
+    """Bytes aproximados que viajan a la API (el JSON de los mensajes, base64 incluido)."""
+    return len(json.dumps(messages).encode("utf-8"))
+
+@dataclass
+class ExtractionMetrics:
+    """Métricas de la extracción de UN documento (todas sus llamadas sumadas)."""
+    model: str               # Modelo que produjo el resultado final
+    source: str = "llm"      # llm | cache | template
+    prompt_version: Optional[str] = None  # Huella de prompts + JSON Schema (llm_extractor.PROMPT_VERSION)
+    tier: int = 0            # Posición del modelo en la cascada (0 = el más barato)
+    escalations: int = 0     # Veces que se repitió con un modelo mayor
+    pages: int = 1
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    validation_retries: int = 0
+    network_retries: int = 0
+    payload_bytes: int = 0
+    wall_time_s: float = 0.0
+    cost_usd: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add_call(self, completion, attempts: int, sent_bytes: int, model: str):
+        """Suma una llamada: `usage` de la respuesta, nº de intentos de instructor y su coste."""
+        self.add_usage(getattr(completion, "usage", None), attempts, sent_bytes, model)
+
+    def add_usage(self, usage, attempts: int, sent_bytes: int, model: str):
+        """Como `add_call`, con el `usage` suelto (el acumulado de un InstructorRetryException)."""
+        with self._lock:  # Las páginas de un documento se extraen en paralelo
+            self.calls += 1
+            self.validation_retries += max(0, attempts - 1)
+            self.payload_bytes += sent_bytes
+            if usage is not None:
+                self.prompt_tokens += usage.prompt_tokens or 0
+                self.completion_tokens += usage.completion_tokens or 0
+                self.cost_usd += estimate_cost(model, usage.prompt_tokens or 0, usage.completion_tokens or 0)
+
+    def add_streamed_call(self, prompt_tokens: int, completion_tokens: int, sent_bytes: int, model: str):
+        """Suma una llamada en streaming: la respuesta no trae `usage`, los tokens son estimados."""
+        with self._lock:
+            self.calls += 1
+            self.payload_bytes += sent_bytes
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost_usd += estimate_cost(model, prompt_tokens, completion_tokens)
+
+    def count_network_retry(self, error: Exception = None, attempt: int = 0):
+        """Callback para el RateLimiter: un reintento por error de red/cuota."""
+        with self._lock:
+            self.network_retries += 1
+
+class RunMetrics:
+    """Acumulado de una ejecución de `process_folder` (para el resumen final)."""
+
+    def __init__(self):
+        self.documents = 0
+        self.by_source: Dict[str, int] = defaultdict(int)
+        self.by_model: Dict[str, int] = defaultdict(int)
+        self.escalations = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self.validation_retries = 0
+        self.network_retries = 0
+        self.payload_bytes = 0
+        self.wall_times: List[float] = []
+        self.cost_by_supplier: Dict[str, float] = defaultdict(float)
+
+    def add(self, metrics: Optional[ExtractionMetrics], supplier: str = ""):
+        if metrics is None:
+            return
+        self.documents += 1
+        self.by_source[metrics.source] += 1
+        if metrics.source == "llm":
+            self.by_model[metrics.model] += 1
+        self.escalations += metrics.escalations
+        self.prompt_tokens += metrics.prompt_tokens
+        self.completion_tokens += metrics.completion_tokens
+        self.cost_usd += metrics.cost_usd
+        self.validation_retries += metrics.validation_retries
+        self.network_retries += metrics.network_retries
+        self.payload_bytes += metrics.payload_bytes
+        self.wall_times.append(metrics.wall_time_s)
+        self.cost_by_supplier[supplier or "?"] += metrics.cost_usd
+
+    def percentile(self, pct: float) -> float:
+        """Percentil de la latencia por documento (método del rango más cercano)."""
+        if not self.wall_times:
+            return 0.0
+        ordered = sorted(self.wall_times)
+        index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def top_suppliers(self, n: int = 5) -> List[tuple]:
+        """Proveedores que más cuestan en esta ejecución."""
+        return sorted(self.cost_by_supplier.items(), key=lambda kv: kv[1], reverse=True)[:n]
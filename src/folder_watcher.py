@@ -49,7 +49,7 @@ class InvoiceFileHandler(FileSystemEventHandler):
         """
         super().__init__()
         self.process_callback = process_callback
-        self.extensions = extensions or ['.pdf', '.jpg', '.jpeg', '.png']
+        self.extensions = extensions or ['.pdf', '.jpg', '.jpeg', '.png', '.tif', '.tiff']
         
         # PRODUCCIÓN: Evitar procesar el mismo archivo múltiples veces si hay eventos duplicados
         # (algunos sistemas de archivos disparan múltiples eventos para una sola creación)
@@ -0,0 +1,350 @@
+import csv
+import os
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional, Sequence
+from sqlalchemy import and_, delete, insert, or_, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import Select
+from .storage import DBExportWatermark, DBFactura, DBItemFactura
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow es opcional: sin él no hay --format parquet
+    pa = pq = None
+
+# -----------------------------------------------------------------------------
+# 28. EXPORTACIÓN INCREMENTAL (Solo lo nuevo o cambiado desde la última vez)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la extracción nocturna para contabilidad: saca de `facturas` e `invoice_items`
+# las facturas creadas o modificadas desde la exportación anterior y las escribe
+# en CSV, Parquet o Excel (`python main.py export`). Cada destino (`--name`)
+# guarda su marca de agua en la tabla `export_watermarks`.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Proporcional al día, no al histórico: La marca es el (updated_at, id) de la
+#    última factura exportada. La consulta pide las posteriores por el índice
+#    `ix_facturas_updated_at`: con 10 años de facturas, la noche solo lee las de hoy.
+# 2. Memoria acotada: Las filas llegan por un cursor en streaming (`stream_results`)
+#    en bloques de `chunk_size`; cada bloque se escribe (y se piden sus líneas)
+#    antes de leer el siguiente. Nunca está la exportación entera en memoria.
+# 3. Nada se pierde: `updated_at` lo pone SQLAlchemy (default/onupdate) en cada
+#    INSERT y UPDATE: altas, correcciones del dashboard, `revalidate` y `reindex`.
+#    Solo se exporta hasta hace `lag_seconds`: una transacción que aún no ha hecho
+#    commit con una hora anterior no queda por detrás de la marca.
+# 4. Como mínimo una vez: Los ficheros se escriben como `.tmp` y se renombran al
+#    terminar; la marca se guarda DESPUÉS. Si algo falla a medias no hay ficheros
+#    nuevos ni marca movida, y la siguiente ejecución vuelve a empezar desde la misma.
+# -----------------------------------------------------------------------------
+
+DEFAULT_EXPORT_DIR = "output/exports"
+DEFAULT_EXPORT_NAME = "contabilidad"
+EXPORT_FORMATS = ("csv", "parquet", "xlsx")
+
+_facturas = DBFactura.__table__
+_items = DBItemFactura.__table__
+
+FACTURA_COLUMNS = [
+    _facturas.c.id, _facturas.c.document_id, _facturas.c.numero_factura, _facturas.c.fecha_emision,
+    _facturas.c.nombre_proveedor, _facturas.c.cif_proveedor, _facturas.c.nombre_cliente,
+    _facturas.c.base_imponible, _facturas.c.total_impuestos, _facturas.c.total_factura, _facturas.c.moneda,
+    _facturas.c.status, _facturas.c.validation_notes, _facturas.c.duplicate_of,
+    _facturas.c.created_at, _facturas.c.updated_at,
+]
+ITEM_COLUMNS = [
+    _items.c.factura_id, _facturas.c.document_id, _items.c.id.label("linea_id"), _items.c.descripcion,
+    _items.c.cantidad, _items.c.precio_unitario, _items.c.total_linea,
+]
+
+if pa is not None:
+    EXPORT_SCHEMAS = {
+        "facturas": pa.schema([
+            ("id", pa.int64()), ("document_id", pa.string()), ("numero_factura", pa.string()),
+            ("fecha_emision", pa.date32()), ("nombre_proveedor", pa.string()), ("cif_proveedor", pa.string()),
+            ("nombre_cliente", pa.string()), ("base_imponible", pa.float64()), ("total_impuestos", pa.float64()),
+            ("total_factura", pa.float64()), ("moneda", pa.string()), ("status", pa.string()),
+            ("validation_notes", pa.string()), ("duplicate_of", pa.int64()), ("created_at", pa.date32()),
+            ("updated_at", pa.timestamp("us")),
+        ]),
+        "lineas": pa.schema([
+            ("factura_id", pa.int64()), ("document_id", pa.string()), ("linea_id", pa.int64()),
+            ("descripcion", pa.string()), ("cantidad", pa.float64()), ("precio_unitario", pa.float64()),
+            ("total_linea", pa.float64()),
+        ]),
+    }
+
+# Límite de filas de una hoja de Excel (incluida la cabecera)
+XLSX_MAX_ROWS = 1_048_576
+
+@dataclass(frozen=True)
+class Watermark:
+    """Última factura exportada: (updated_at, id). Vacía = nunca se ha exportado."""
+    updated_at: Optional[datetime] = None
+    last_id: int = 0
+
+@dataclass
+class ExportReport:
+    """Resultado de `IncrementalExporter.run`."""
+    facturas: int = 0
+    items: int = 0
+    files: List[str] = field(default_factory=list)
+    since: Watermark = field(default_factory=Watermark)
+    watermark: Watermark = field(default_factory=Watermark)
+    seconds: float = 0.0
+
+def changed_invoices_query(since: Watermark, until: Optional[datetime] = None) -> Select:
+    """Facturas con (updated_at, id) posterior a `since` y updated_at <= `until`, en ese orden."""
+    query = select(*FACTURA_COLUMNS).order_by(_facturas.c.updated_at, _facturas.c.id)
+    if since.updated_at is not None:
+        # El >= acota el rango del índice; el OR desempata las de la misma hora por id
+        query = query.where(
+            _facturas.c.updated_at >= since.updated_at,
+            or_(_facturas.c.updated_at > since.updated_at,
+                and_(_facturas.c.updated_at == since.updated_at, _facturas.c.id > since.last_id)),
+        )
+    if until is not None:
+        query = query.where(_facturas.c.updated_at <= until)
+    return query
+
+def invoice_items_query(factura_ids: Sequence[int]) -> Select:
+    """Líneas de las facturas `factura_ids` (por el índice de factura_id)."""
+    return (
+        select(*ITEM_COLUMNS)
+        .join(_facturas, _facturas.c.id == _items.c.factura_id)
+        .where(_items.c.factura_id.in_(list(factura_ids)))
+        .order_by(_items.c.factura_id, _items.c.id)
+    )
+
+def load_watermark(engine: Engine, name: str) -> Watermark:
+    with engine.connect() as conn:
+        row = conn.execute(select(DBExportWatermark.__table__).where(DBExportWatermark.name == name)).first()
+    return Watermark(row.updated_at, row.last_id or 0) if row else Watermark()
+
+def save_watermark(conn: Connection, name: str, watermark: Watermark):
+    table = DBExportWatermark.__table__
+    conn.execute(delete(table).where(table.c.name == name))
+    conn.execute(insert(table).values(name=name, updated_at=watermark.updated_at, last_id=watermark.last_id,
+                                      exported_at=datetime.now()))
+
+# --- Escritores: una "tabla" de facturas y otra de líneas por exportación ---
+
+class _ExportWriter(ABC):
+    """Escribe las filas de `facturas` y `lineas` en ficheros `.tmp`; `commit` los renombra."""
+    suffix = ""
+
+    def __init__(self, directory: Path, stamp: str):
+        self.directory = directory
+        self.stamp, n = stamp, 1
+        # Dos exportaciones en el mismo segundo no pueden pisarse los ficheros
+        while any(directory.glob(f"{self.stamp}[-.]*")):
+            n += 1
+            self.stamp = f"{stamp}-{n}"
+        self._paths: List[Path] = []
+
+    def _path(self, table: str = "") -> Path:
+        path = self.directory / f"{self.stamp}{'-' + table if table else ''}{self.suffix}"
+        if path not in self._paths:
+            self.directory.mkdir(parents=True, exist_ok=True)  # Solo si hay algo que escribir
+            self._paths.append(path)
+        return path
+
+    @staticmethod
+    def _tmp(path: Path) -> Path:
+        return path.with_name(path.name + ".tmp")
+
+    @abstractmethod
+    def write(self, table: str, columns: List[str], rows: Sequence[tuple]):
+        """Añade `rows` a la tabla `table` (cada formato decide el fichero)."""
+
+    def _close(self):
+        pass
+
+    def commit(self) -> List[str]:
+        self._close()
+        for path in self._paths:
+            os.replace(self._tmp(path), path)
+        return [str(path) for path in self._paths]
+
+    def abort(self):
+        try:
+            self._close()
+        finally:
+            for path in self._paths:
+                self._tmp(path).unlink(missing_ok=True)
+
+class CsvExportWriter(_ExportWriter):
+    suffix = ".csv"
+
+    def __init__(self, directory: Path, stamp: str):
+        super().__init__(directory, stamp)
+        self._files = {}
+
+    def write(self, table, columns, rows):
+        if table not in self._files:
+            # utf-8-sig: Excel abre bien las tildes al hacer doble clic en el CSV
+            f = open(self._tmp(self._path(table)), "w", newline="", encoding="utf-8-sig")
+            self._files[table] = (f, csv.writer(f))
+            self._files[table][1].writerow(columns)
+        self._files[table][1].writerows(rows)
+
+    def _close(self):
+        for f, _ in self._files.values():
+            f.close()
+        self._files.clear()
+
+class ParquetExportWriter(_ExportWriter):
+    suffix = ".parquet"
+
+    def __init__(self, directory: Path, stamp: str):
+        if pq is None:
+            raise RuntimeError("La exportación a Parquet necesita pyarrow (pip install pyarrow)")
+        super().__init__(directory, stamp)
+        self._writers = {}
+
+    def write(self, table, columns, rows):
+        schema = EXPORT_SCHEMAS[table]
+        if table not in self._writers:
+            self._writers[table] = pq.ParquetWriter(self._tmp(self._path(table)), schema, compression="zstd")
+        # Un row group por bloque del cursor
+        data = {name: [row[i] for row in rows] for i, name in enumerate(columns)}
+        self._writers[table].write_table(pa.Table.from_pydict(data, schema=schema))
+
+    def _close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+class XlsxExportWriter(_ExportWriter):
+    """Un libro con dos hojas. openpyxl en modo write_only va volcando las filas a disco."""
+    suffix = ".xlsx"
+
+    def __init__(self, directory: Path, stamp: str):
+        from openpyxl import Workbook
+        super().__init__(directory, stamp)
+        self._workbook = Workbook(write_only=True)
+        self._sheets = {}
+        self._rows = {}
+
+    def write(self, table, columns, rows):
+        if table not in self._sheets:
+            self._sheets[table] = self._workbook.create_sheet(table)
+            self._sheets[table].append(columns)
+            self._rows[table] = 1
+        self._rows[table] += len(rows)
+        if self._rows[table] > XLSX_MAX_ROWS:
+            raise ValueError(f"La hoja '{table}' supera las {XLSX_MAX_ROWS:,} filas de Excel: usa --format parquet o csv")
+        for row in rows:
+            self._sheets[table].append(tuple(row))
+
+    def _close(self):
+        if self._workbook is not None and self._sheets:
+            self._workbook.save(self._tmp(self._path()))
+        self._workbook = None
+
+    def abort(self):
+        self._workbook = None  # Nada que guardar: el libro solo llega a disco al cerrarlo
+        super().abort()
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "parquet": ParquetExportWriter, "xlsx": XlsxExportWriter}
+
+class IncrementalExporter:
+    """Exporta las facturas cambiadas desde la marca de `name` y avanza la marca."""
+
+    def __init__(self, engine: Engine, name: str = DEFAULT_EXPORT_NAME, output_dir: str = DEFAULT_EXPORT_DIR,
+                 fmt: str = "csv", chunk_size: int = 5_000, lag_seconds: float = 60):
+        if fmt not in EXPORT_WRITERS:
+            raise ValueError(f"Formato no soportado: {fmt} (usa {', '.join(EXPORT_FORMATS)})")
+        self.engine = engine
+        self.name = name
+        self.output_dir = Path(output_dir) / name
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.lag_seconds = lag_seconds
+
+    def run(self, full: bool = False, dry_run: bool = False) -> ExportReport:
+        """`full` exporta todo el histórico (y deja la marca al final); `dry_run` no escribe ni mueve la marca."""
+        started = time.perf_counter()
+        since = Watermark() if full else load_watermark(self.engine, self.name)
+        report = ExportReport(since=since, watermark=since)
+        until = datetime.now() - timedelta(seconds=self.lag_seconds)
+
+        writer = EXPORT_WRITERS[self.fmt](self.output_dir, datetime.now().strftime("%Y%m%d-%H%M%S"))
+        try:
+            with self.engine.connect() as conn:
+                # Cursor en streaming: el driver entrega las filas de chunk_size en chunk_size
+                result = conn.execution_options(stream_results=True, yield_per=self.chunk_size).execute(
+                    changed_invoices_query(since, until))
+                columns = list(result.keys())
+                for rows in result.partitions():
+                    items = conn.execute(invoice_items_query([row.id for row in rows])).all()
+                    report.facturas += len(rows)
+                    report.items += len(items)
+                    report.watermark = Watermark(rows[-1].updated_at, rows[-1].id)
+                    if not dry_run:
+                        writer.write("facturas", columns, rows)
+                        if items:
+                            writer.write("lineas", [c.name for c in ITEM_COLUMNS], items)
+            if dry_run or not report.facturas:
+                writer.abort()
+            else:
+                report.files = writer.commit()
+                with self.engine.begin() as conn:
+                    save_watermark(conn, self.name, report.watermark)
+        except BaseException:
+            writer.abort()
+            raise
+        report.seconds = time.perf_counter() - started
+        return report
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import tempfile
+    from sqlalchemy import update
+    from .storage import Storage
+
+    parser = argparse.ArgumentParser(description="Benchmark: exportación completa frente a incremental")
+    parser.add_argument("--history", type=int, default=200_000, help="Facturas en el histórico")
+    parser.add_argument("--daily", type=int, default=2_000, help="Facturas nuevas o modificadas en el día")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = Storage(f"sqlite:///{tmp}/facturas.db")
+        ayer = datetime.now() - timedelta(days=1)
+        header = dict(nombre_proveedor="Proveedor", base_imponible=100.0, total_impuestos=21.0, total_factura=121.0,
+                      moneda="EUR", status="OK", validation_notes="")
+        with storage.engine.begin() as conn:
+            for start in range(0, args.history, 50_000):
+                n = min(50_000, args.history - start)
+                ids = conn.execute(insert(_facturas).returning(_facturas.c.id, sort_by_parameter_order=True), [
+                    {**header, "document_id": f"h-{start + i}", "numero_factura": f"H-{start + i}",
+                     "updated_at": ayer - timedelta(minutes=start + i)} for i in range(n)
+                ]).scalars().all()
+                conn.execute(insert(_items), [{"factura_id": factura_id, "descripcion": "Concepto", "cantidad": 1.0,
+                                               "precio_unitario": 100.0, "total_linea": 100.0}
+                                              for factura_id in ids for _ in range(3)])
+
+        exporter = IncrementalExporter(storage.engine, output_dir=f"{tmp}/out", fmt=args.format, lag_seconds=0)
+        first = exporter.run()
+        print(f"📦 Primera exportación (histórico): {first.facturas:,} facturas, {first.items:,} líneas "
+              f"en {first.seconds:.2f}s")
+
+        # El día: la mitad son altas nuevas y la otra mitad correcciones de facturas antiguas
+        with storage.engine.begin() as conn:
+            conn.execute(insert(_facturas), [{**header, "document_id": f"d-{i}", "numero_factura": f"D-{i}"}
+                                             for i in range(args.daily // 2)])
+            for factura_id in random.sample(range(1, args.history + 1), args.daily - args.daily // 2):
+                conn.execute(update(_facturas).where(_facturas.c.id == factura_id).values(status="REVIEW"))
+        nightly = exporter.run()
+        print(f"🌙 Exportación nocturna (incremental): {nightly.facturas:,} facturas, {nightly.items:,} líneas "
+              f"en {nightly.seconds:.2f}s (x{first.seconds / nightly.seconds:.0f} más rápida)")
+        empty = exporter.run()
+        print(f"✅ Sin cambios: {empty.facturas} facturas en {empty.seconds * 1000:.0f} ms, "
+              f"{len(empty.files)} ficheros")
+        storage.engine.dispose()
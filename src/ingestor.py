@@ -1,6 +1,8 @@
 import os
+import hashlib
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional
+from .extraction_metrics import ExtractionMetrics
 
 # -----------------------------------------------------------------------------
 # 2. INGESTA DE DOCUMENTOS (Patrón Adapter)
@@ -15,8 +17,18 @@ from typing import List, Optional
 #    y el resto del sistema NO cambia.
 # 2. Abstracción: Al resto del programa no le importa si el archivo vino de un USB o de la nube.
 #    Solo le importa que tiene un `content` y un `filename`.
+# 3. Identidad por Contenido: El ID de un documento es el hash SHA-256 de sus bytes,
+#    no su nombre. La misma factura renombrada, subida dos veces o procesada por el
+#    CLI y por el watcher tiene SIEMPRE el mismo ID, así que podemos descartarla
+#    antes de pagar otra llamada al LLM.
 # -----------------------------------------------------------------------------
 
+# Leemos en bloques de 1 MB: el hash se calcula con memoria constante aunque
+# el archivo pese cientos de MB (PDFs escaneados).
+HASH_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_EXTENSIONS = (".pdf", ".jpg", ".png", ".jpeg", ".tif", ".tiff")
+
 @dataclass
 class Document:
     """Representación unificada de un documento a procesar."""
@@ -25,33 +37,93 @@ class Document:
     filepath: str           # Ruta local donde está el archivo (para abrirlo)
     source: str             # Origen: 'local', 'email', 'upload'
     content_bytes: Optional[bytes] = None # Contenido binario (opcional si tenemos filepath)
+    content_hash: Optional[str] = None    # SHA-256 del contenido (base del ID)
+    metrics: Optional[ExtractionMetrics] = None  # Tokens/coste/latencia (lo rellena el extractor)
+
+def compute_file_hash(filepath: str, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """Calcula el SHA-256 de un archivo leyéndolo por bloques (streaming)."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def document_from_path(filepath: str, source: str) -> Document:
+    """Crea un Document cuyo ID se deriva del contenido del archivo."""
+    content_hash = compute_file_hash(filepath)
+    return Document(
+        id=f"sha256_{content_hash}",
+        filename=os.path.basename(filepath),
+        filepath=filepath,
+        source=source,
+        content_hash=content_hash
+    )
 
 class LocalFileIngestor:
-    """Ingestor simple que busca archivos en una carpeta local."""
+    """
+    Ingestor que recorre una carpeta local (y sus subcarpetas) de forma perezosa.
+    
+    ¿POR QUÉ UN GENERADOR?
+    - Con 100k+ archivos, construir una lista completa antes de empezar significa
+      esperar al escaneo entero y tener todos los Document en memoria a la vez.
+    - Con `yield`, el primer archivo sale en cuanto se encuentra: la extracción
+      empieza mientras el escaneo sigue, y la memoria no crece con la carpeta.
+    - `os.scandir` reutiliza la información del directorio (tipo de entrada) sin
+      hacer un `stat` extra por archivo, a diferencia de `os.listdir` + `os.path.isdir`.
+    """
     
-    def __init__(self, directory: str):
+    def __init__(self, directory: str, recursive: bool = True):
         self.directory = directory
+        self.recursive = recursive
+
+    def iter_documents(self, extensions: Iterable[str] = DEFAULT_EXTENSIONS) -> Iterator[Document]:
+        """Genera los Document de la carpeta uno a uno, a medida que se encuentran."""
+        # Conjunto precalculado: comprobar la extensión es O(1) por archivo
+        suffixes = frozenset(ext.lower() for ext in extensions)
 
-    def list_documents(self, extensions: List[str] = [".pdf", ".jpg", ".png", ".jpeg"]) -> List[Document]:
-        """Escanea el directorio y devuelve una lista de objetos Document."""
-        documents = []
-        
         if not os.path.exists(self.directory):
             print(f"⚠️ El directorio {self.directory} no existe.")
-            return []
-
-        for f in os.listdir(self.directory):
-            if any(f.lower().endswith(ext) for ext in extensions):
-                full_path = os.path.join(self.directory, f)
-                # En un caso real, aquí generaríamos un ID único o hash del archivo
-                doc_id = f"local_{f}" 
-                
-                doc = Document(
-                    id=doc_id,
-                    filename=f,
-                    filepath=full_path,
-                    source="local"
-                )
-                documents.append(doc)
-        
-        return documents
+            return
+
+        # Pila explícita en lugar de recursión: solo guardamos carpetas pendientes
+        pending = [self.directory]
+        while pending:
+            current = pending.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        # Archivos temporales u ocultos (ej: ~$factura.pdf, .DS_Store)
+                        if entry.name.startswith(('~', '.')):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                pending.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                        if os.path.splitext(entry.name)[1].lower() in suffixes:
+                            # El ID es el hash del contenido: renombrar el archivo no lo cambia
+                            try:
+                                document = document_from_path(entry.path, source="local")
+                            except OSError as e:
+                                # Un archivo ilegible (permisos, borrado a mitad) no corta el resto de la carpeta
+                                print(f"⚠️ No se pudo leer {entry.path}: {e}")
+                                continue
+                            yield document
+            except OSError as e:
+                print(f"⚠️ No se pudo leer {current}: {e}")
+
+    def iter_batches(self, batch_size: int = 50, extensions: Iterable[str] = DEFAULT_EXTENSIONS) -> Iterator[List[Document]]:
+        """Agrupa los documentos en lotes de `batch_size` sin materializar el total."""
+        batch = []
+        for doc in self.iter_documents(extensions):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def list_documents(self, extensions: Iterable[str] = DEFAULT_EXTENSIONS) -> List[Document]:
+        """Escanea el directorio y devuelve una lista de objetos Document."""
+        return list(self.iter_documents(extensions))
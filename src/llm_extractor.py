@@ -1,8 +1,28 @@
+import time
 import base64
+import hashlib
+import asyncio
+import httpx
+import openai
 import instructor
-from openai import OpenAI
-from .models import Factura
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from pydantic import ValidationError
+from instructor.retry import InstructorRetryException
+from tenacity import AsyncRetrying, Retrying, retry_if_not_exception_type, stop_after_attempt
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from .models import Factura, PaginaFactura
 from .ingestor import Document
+from .extraction_cache import ExtractionCache, schema_fingerprint
+from .extraction_metrics import ExtractionMetrics, payload_bytes
+from .image_preprocessing import PreprocessConfig, PreparedImage, preprocess_image, describe_savings, load_image_frames
+from .pdf_handler import extract_pdf_text, group_pages, has_usable_text, join_pages, rasterize_pdf
+from .multipage import merge_pages
+from .rate_limiter import RateLimiter, RETRYABLE_ERRORS, estimate_request_tokens
+from .supplier_templates import SupplierTemplateEngine
+from .validator import validate_invoice
+from .streaming import PartialTracker, StreamUpdate
 
 # -----------------------------------------------------------------------------
 # 3. MOTOR DE EXTRACCIÓN (LLM + Instructor)
@@ -19,82 +39,664 @@ from .ingestor import Document
 #    OCR tradicional (Tesseract) falla mucho con tablas y formatos raros.
 # 3. Reintentos (Retries): En producción, las APIs fallan. Instructor maneja
 #    automáticamente los reintentos si la validación de Pydantic falla.
+# 4. Concurrencia: La llamada al LLM es 99% espera de red. `AsyncLLMExtractor`
+#    mantiene N peticiones en vuelo a la vez (limitadas por un semáforo), así que
+#    un lote escala con la cuota de la API y no con la latencia de cada llamada.
+# 5. Caché: Si se le pasa una `ExtractionCache`, un documento ya extraído con el
+#    mismo modelo, prompt y schema se devuelve desde disco sin llamar a la API.
+# 6. Preprocesado: Las imágenes pasan por `preprocess_image` (rotación EXIF,
+#    reescalado, grises, JPEG) antes de codificarse: menos bytes que subir.
+# 7. PDFs: Si tienen capa de texto, mandamos TEXTO (barato). Solo si no la tienen
+#    rasterizamos las páginas y usamos visión (ver src/pdf_handler.py).
+# 8. Ritmo: Con un `RateLimiter`, cada llamada espera su turno de RPM/TPM y los
+#    errores 429/red se reintentan con backoff (ver src/rate_limiter.py).
+# 9. Plantillas: Con un `SupplierTemplateEngine`, los PDFs de proveedores conocidos
+#    se parsean en local antes de llamar al LLM (ver src/supplier_templates.py).
+# 10. Multipágina: Los documentos escaneados de varias páginas (PDF, TIFF) se extraen
+#    página a página EN PARALELO y se fusionan en una sola Factura (ver
+#    src/multipage.py). Los de texto, por tramos de páginas: casi siempre uno solo.
+# 11. Métricas: Cada extracción deja en `document.metrics` sus tokens (del `usage`
+#    real), reintentos, bytes enviados y tiempo (ver src/extraction_metrics.py).
+# 12. Cascada de modelos: Primero un modelo pequeño y rápido (gpt-4o-mini). Solo si
+#    su resultado tiene errores o avisos críticos (falta el número, los totales no
+#    cuadran) se repite con el siguiente modelo (gpt-4o). Las facturas limpias,
+#    que son la mayoría, cuestan ~15 veces menos.
+# 13. Streaming: `extract_stream` publica la cabecera y las líneas según llegan
+#    (ver src/streaming.py), para que quien sube una factura a mano no espere a ciegas.
 # -----------------------------------------------------------------------------
 
-def encode_image(image_path: str) -> str:
-    """Codifica una imagen a base64 para enviarla a GPT-4o."""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+PROMPT_EXTRACCION = "Extrae la información de esta factura. Si algún campo no está claro, déjalo vacío o infiérelo con sentido común."
+
+# Prompts de las facturas multipágina (una llamada por página)
+PROMPT_PRIMERA_PAGINA = (
+    "Esta es la página 1 de {total} de una factura. Extrae la cabecera, las líneas de detalle "
+    "de ESTA página y los totales si aparecen. Si no aparecen, infiérelos de lo que veas."
+)
+PROMPT_CONTINUACION = (
+    "Esta es la página {page} de {total} de una factura. Extrae solo las líneas de detalle "
+    "de ESTA página y los totales de la factura si aparecen en ella."
+)
+# PDFs con capa de texto: una llamada por tramo de páginas (las que quepan en MAX_TEXT_CHARS)
+PROMPT_PRIMER_TRAMO = (
+    "Este texto son las páginas {first} a {last} de una factura de {total} páginas. Extrae la cabecera, "
+    "las líneas de detalle de ESTAS páginas y los totales si aparecen. Si no aparecen, infiérelos de lo que veas."
+)
+PROMPT_CONTINUACION_TRAMO = (
+    "Este texto son las páginas {first} a {last} de una factura de {total} páginas. Extrae solo las líneas "
+    "de detalle de ESTAS páginas y los totales de la factura si aparecen en ellas."
+)
+
+# Versión del prompt que queda archivada con cada extracción: cambia si cambian los textos
+# de arriba o el JSON Schema de Factura (sus descriptions también son prompt)
+PROMPT_VERSION = hashlib.sha256(
+    "\n".join([PROMPT_EXTRACCION, PROMPT_PRIMERA_PAGINA, PROMPT_CONTINUACION, PROMPT_PRIMER_TRAMO,
+               PROMPT_CONTINUACION_TRAMO, schema_fingerprint(Factura)]).encode("utf-8")
+).hexdigest()[:12]
+
+# Páginas máximas que rasterizamos de un PDF escaneado en una sola llamada (modo batch)
+MAX_VISION_PAGES = 5
+
+# Páginas máximas de imagen que se extraen por separado (coste de visión acotado)
+MAX_SPLIT_PAGES = 30
+
+def _vision_message(images: List[PreparedImage], prompt: str = PROMPT_EXTRACCION) -> list:
+    """Mensaje de visión: el prompt seguido de una o varias imágenes."""
+    content = [{"type": "text", "text": prompt}]
+    for image in images:
+        base64_image = base64.b64encode(image.data).decode('utf-8')
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{image.mime_type};base64,{base64_image}"
+            },
+        })
+    return [{"role": "user", "content": content}]
+
+def _text_message(document: Document, text: str, prompt: str = PROMPT_EXTRACCION) -> list:
+    """Mensaje de solo texto con la capa de texto del PDF."""
+    return [
+        {
+            "role": "user",
+            "content": f"{prompt}\n\nTexto de la factura (archivo: {document.filename}):\n\n{text}"
+        }
+    ]
+
+def _load_pages(document: Document, preprocess: Optional[PreprocessConfig],
+                max_image_pages: int) -> Tuple[str, list]:
+    """
+    Lee el documento y lo separa en páginas.
+
+    Devuelve ("text", [texto por página]) para PDFs con capa de texto, o
+    ("image", [PreparedImage por página]) para imágenes, TIFF y PDFs escaneados.
+    """
+    extension = document.filename.split('.')[-1].lower()
+
+    if extension in ['jpg', 'jpeg', 'png', 'webp']:
+        # Flujo de Visión
+        prepared = preprocess_image(document.filepath, preprocess)
+        print(describe_savings(document.filename, prepared))
+        return "image", [prepared]
+
+    if extension in ['tif', 'tiff']:
+        # TIFF de escáner/fax: una imagen por página (la API no acepta TIFF)
+        frames = load_image_frames(document.filepath, preprocess, max_frames=max_image_pages)
+        print(f"🖼️ {document.filename}: TIFF con {len(frames)} pág. → JPEG")
+        return "image", frames
+
+    if extension == 'pdf':
+        page_texts = extract_pdf_text(document.filepath)
+        if has_usable_text(page_texts):
+            # Flujo de Texto: la capa de texto se extrae en local, gratis
+            print(f"📄 {document.filename}: capa de texto ({sum(map(len, page_texts))} caracteres, {len(page_texts)} pág.) → prompt de texto")
+            return "text", page_texts
+
+        # Fallback: PDF escaneado → imágenes de sus páginas
+        images = rasterize_pdf(document.filepath, preprocess, max_pages=max_image_pages)
+        payload_kb = sum(len(image.data) for image in images) / 1024
+        print(f"🖼️ {document.filename}: sin capa de texto útil → {len(images)} pág. rasterizadas ({payload_kb:.0f} KB)")
+        return "image", images
+
+    raise ValueError(f"Formato no soportado: .{extension} ({document.filename})")
+
+def build_messages(document: Document, preprocess: Optional[PreprocessConfig] = None) -> list:
+    """
+    Construye UN mensaje para el LLM con todo el documento (una sola llamada).
+    
+    - Imagen (jpg, png): payload de visión, preprocesada para reducir bytes.
+    - PDF con capa de texto: prompt de SOLO TEXTO (mucho más barato y rápido).
+    - PDF escaneado o TIFF: las primeras páginas como imágenes, en visión.
+    """
+    kind, pages = _load_pages(document, preprocess, MAX_VISION_PAGES)
+    if kind == "text":
+        return _text_message(document, join_pages(pages))
+    return _vision_message(pages)
+
+def build_page_messages(document: Document, preprocess: Optional[PreprocessConfig] = None) -> List[list]:
+    """
+    Construye un mensaje POR PÁGINA (para extraerlas en paralelo).
+
+    Un documento de una página devuelve una lista de un solo mensaje, idéntico
+    al de `build_messages`. En los de varias, el primero pide la `Factura`
+    completa y el resto solo las líneas (`PaginaFactura`). Los PDF con capa de
+    texto van por tramos de páginas, no página a página (`_text_chunk_messages`).
+    """
+    kind, pages = _load_pages(document, preprocess, MAX_SPLIT_PAGES)
+    if kind == "text":
+        return _text_chunk_messages(document, pages)
+    if len(pages) == 1:
+        return [_vision_message(pages)]
+
+    total = len(pages)
+    messages = []
+    for number, page in enumerate(pages, start=1):
+        if number == 1:
+            prompt = f"{PROMPT_EXTRACCION} {PROMPT_PRIMERA_PAGINA.format(total=total)}"
+        else:
+            prompt = PROMPT_CONTINUACION.format(page=number, total=total)
+        messages.append(_vision_message([page], prompt))
+    return messages
+
+def _text_chunk_messages(document: Document, page_texts: List[str]) -> List[list]:
+    """
+    Mensajes de un PDF con capa de texto: uno por tramo de páginas de hasta MAX_TEXT_CHARS.
+
+    Lo normal es que todo quepa en un tramo (una sola llamada, como `build_messages`).
+    Como mucho MAX_SPLIT_PAGES tramos: el coste de un PDF enorme queda acotado.
+    """
+    groups = group_pages(page_texts)
+    if len(groups) > MAX_SPLIT_PAGES:
+        print(f"⚠️ {document.filename}: {len(page_texts)} pág. de texto, solo se extraen los "
+              f"{MAX_SPLIT_PAGES} primeros tramos (hasta la pág. {groups[MAX_SPLIT_PAGES - 1][1]})")
+        groups = groups[:MAX_SPLIT_PAGES]
+    if len(groups) == 1:
+        return [_text_message(document, join_pages(page_texts))]
+
+    total = len(page_texts)
+    messages = []
+    for number, (first, last) in enumerate(groups, start=1):
+        template = f"{PROMPT_EXTRACCION} {PROMPT_PRIMER_TRAMO}" if number == 1 else PROMPT_CONTINUACION_TRAMO
+        text = join_pages(page_texts[first - 1:last], start=first)
+        messages.append(_text_message(document, text, template.format(first=first, last=last, total=total)))
+    return messages
+
+# Cascada por defecto: del modelo más barato al más capaz
+DEFAULT_MODELS = ("gpt-4o-mini", "gpt-4o")
+
+def parse_models(value: Optional[str]) -> List[str]:
+    """'gpt-4o-mini,gpt-4o' → ['gpt-4o-mini', 'gpt-4o'] (vacío = cascada por defecto)."""
+    models = [model.strip() for model in (value or "").split(",") if model.strip()]
+    return models or list(DEFAULT_MODELS)
+
+def escalation_reason(outcome: Union[Factura, Exception]) -> Optional[str]:
+    """Motivo para pasar al siguiente modelo de la cascada (None = resultado aceptable)."""
+    if isinstance(outcome, Exception):
+        return f"{type(outcome).__name__}: {outcome}"[:200]
+    validation = validate_invoice(outcome)
+    if validation.needs_escalation:
+        return "; ".join(validation.errors + validation.critical)
+    return None
+
+# Errores que no se arreglan cambiando de modelo: se propagan sin escalar
+_NO_ESCALATION_ERRORS = RETRYABLE_ERRORS + (asyncio.TimeoutError,)
+
+# Intentos de instructor por documento. Solo se reintentan errores de VALIDACIÓN
+# (el LLM devolvió algo que no encaja en Factura); los de cuota o red los gestiona
+# el RateLimiter con backoff, para que los reintentos no se acumulen.
+VALIDATION_ATTEMPTS = 2
+
+def validation_retries() -> Retrying:
+    return Retrying(stop=stop_after_attempt(VALIDATION_ATTEMPTS),
+                    retry=retry_if_not_exception_type(RETRYABLE_ERRORS), reraise=True)
+
+def validation_retries_async() -> AsyncRetrying:
+    return AsyncRetrying(stop=stop_after_attempt(VALIDATION_ATTEMPTS),
+                         retry=retry_if_not_exception_type(RETRYABLE_ERRORS), reraise=True)
+
+def _with_response_hook(http_client, hook):
+    """Añade un event hook de respuesta a un cliente httpx (sin perder los que ya tenga)."""
+    hooks = http_client.event_hooks
+    http_client.event_hooks = {"request": hooks["request"], "response": [*hooks["response"], hook]}
+    return http_client
+
+def cache_key_for(cache: Optional[ExtractionCache], document: Document, model_name: str,
+                  preprocess: Optional[PreprocessConfig] = None) -> Optional[str]:
+    """Clave de caché del documento, o None si no hay caché o no conocemos su hash."""
+    if cache is None or not document.content_hash:
+        return None
+    # El preprocesado cambia lo que ve el modelo: forma parte del "prompt"
+    prompt = f"{PROMPT_EXTRACCION}\n{PROMPT_PRIMERA_PAGINA}\n{preprocess or PreprocessConfig()}"
+    return cache.make_key(document.content_hash, model_name, prompt)
+
+def _add_failed_call(metrics: Optional[ExtractionMetrics], error: InstructorRetryException, messages: list,
+                     model: str):
+    """Los intentos que agotaron los reintentos de validación también se pagaron (antes de escalar)."""
+    if metrics is not None:
+        metrics.add_usage(error.total_usage, error.n_attempts, payload_bytes(messages), model)
 
 class LLMExtractor:
-    def __init__(self, api_key: str):
-        # Inicializamos el cliente "parcheado" por instructor
-        self.client = instructor.from_openai(OpenAI(api_key=api_key))
-        # Modelo a usar. GPT-4o es ideal para visión + texto.
-        self.model_name = "gpt-4o" 
+    def __init__(self, api_key: str, cache: Optional[ExtractionCache] = None,
+                 preprocess: Optional[PreprocessConfig] = None, http_client: Optional[httpx.Client] = None,
+                 limiter: Optional[RateLimiter] = None, templates: Optional[SupplierTemplateEngine] = None,
+                 page_concurrency: int = 4, models: Optional[Sequence[str]] = None):
+        self.limiter = limiter
+        self.templates = templates
+        self.page_concurrency = max(1, page_concurrency)
+        if limiter is not None:
+            # Las cabeceras x-ratelimit-* de cada respuesta alimentan al limitador
+            http_client = _with_response_hook(http_client or DefaultHttpxClient(), limiter.observe_response)
+
+        # Inicializamos el cliente "parcheado" por instructor.
+        # `http_client` permite compartir un pool de conexiones keep-alive entre llamadas.
+        # Con limitador, los reintentos de red/cuota son suyos: el SDK no reintenta.
+        self.client = instructor.from_openai(OpenAI(
+            api_key=api_key,
+            http_client=http_client,
+            max_retries=0 if limiter else openai.DEFAULT_MAX_RETRIES,
+        ))
+        # Cascada de modelos: del más barato al más capaz (GPT-4o es ideal para visión + texto).
+        self.models = list(models or DEFAULT_MODELS)
+        # Identifica la cascada completa (caché): el resultado depende de todos los modelos
+        self.model_name = "+".join(self.models)
+        self.cache = cache
+        self.preprocess = preprocess or PreprocessConfig()
+
+    def _create(self, messages: list, response_model=Factura, metrics: Optional[ExtractionMetrics] = None,
+                model: Optional[str] = None):
+        """Llamada a instructor, pasando por el limitador si lo hay."""
+        model = model or self.models[-1]
+
+        def call():
+            retries = validation_retries()
+            try:
+                result, completion = self.client.chat.completions.create_with_completion(
+                    model=model,
+                    response_model=response_model, # <--- AQUÍ ESTÁ LA CLAVE
+                    messages=list(messages),
+                    temperature=0.0, # Determinista
+                    max_retries=retries,
+                )
+            except InstructorRetryException as e:
+                _add_failed_call(metrics, e, messages, model)
+                raise
+            if metrics is not None:
+                metrics.add_call(completion, retries.statistics.get("attempt_number", 1), payload_bytes(messages), model)
+            return result
+
+        if self.limiter is None:
+            return call()
+        on_retry = metrics.count_network_retry if metrics is not None else None
+        return self.limiter.call(call, estimate_request_tokens(messages), on_retry=on_retry)
+
+    def _extract_pages(self, pages: List[list], metrics: ExtractionMetrics, model: str) -> Factura:
+        """Extrae todas las páginas con un modelo (en paralelo si hay varias) y las fusiona."""
+        if len(pages) == 1:
+            return self._create(pages[0], Factura, metrics, model)
+        with ThreadPoolExecutor(max_workers=min(len(pages), self.page_concurrency)) as pool:
+            first = pool.submit(self._create, pages[0], Factura, metrics, model)
+            rest = [pool.submit(self._create, page, PaginaFactura, metrics, model) for page in pages[1:]]
+            return merge_pages(first.result(), [future.result() for future in rest])
+
+    def _run_cascade(self, document: Document, pages: List[list], metrics: ExtractionMetrics,
+                     start: int = 0) -> Factura:
+        """Prueba los modelos en orden (desde `start`) y se queda con el primer resultado aceptable."""
+        for tier, model in list(enumerate(self.models))[start:]:
+            try:
+                outcome = self._extract_pages(pages, metrics, model)
+            except _NO_ESCALATION_ERRORS:
+                raise
+            except Exception as e:
+                outcome = e
+
+            is_last = tier == len(self.models) - 1
+            reason = None if is_last else escalation_reason(outcome)
+            if reason is None:
+                if isinstance(outcome, Exception):
+                    raise outcome
+                metrics.model, metrics.tier = model, tier
+                return outcome
+
+            metrics.escalations += 1
+            print(f"⤴️ {document.filename}: {model} no basta ({reason}) → {self.models[tier + 1]}")
 
     def extract(self, document: Document) -> Factura:
         """
         Toma un documento (PDF o Imagen) y extrae los datos en estructura Factura.
-        Nota: Para este MVP, asumimos que si es PDF, GPT-4o puede leerlo si se convierte a imagen
-        o si usamos un parser de texto antes. 
-        Para simplificar el MVP, trataremos todo como "visión" (ideal para imágenes) 
-        o texto crudo si pudiéramos extraerlo.
         
-        *TRUCO*: GPT-4o funciona muy bien con imágenes. Si el PDF es de una página,
-        lo ideal es convertirlo a imagen. Si es texto seleccionable, mejor pasar el texto.
-        Aquí, para simplificar, asumiremos que el usuario nos da imágenes o PDFs que 
-        podemos tratar (en un MVP real usaríamos 'pdf2image' para convertir PDFs).
+        *TRUCO*: GPT-4o funciona muy bien con imágenes, pero si el PDF tiene texto
+        seleccionable es mejor (y mucho más barato) pasarle el texto. `build_page_messages`
+        decide el camino: texto si hay capa de texto, visión si es imagen o escaneo.
+        Si el documento tiene varias páginas, se extraen en paralelo y se fusionan.
+        Las métricas de la extracción quedan en `document.metrics`.
         """
-        
+        started = time.perf_counter()
+        document.metrics = ExtractionMetrics(model=self.model_name, prompt_version=PROMPT_VERSION)
+        try:
+            return self._extract(document, document.metrics)
+        finally:
+            document.metrics.wall_time_s = time.perf_counter() - started
+
+    def _shortcut(self, document: Document, metrics: ExtractionMetrics, cache_key: Optional[str]) -> Optional[Factura]:
+        """Resultado sin llamar al LLM (caché o plantilla del proveedor), si lo hay."""
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                print(f"⚡ Caché: {document.filename} (sin llamada al LLM)")
+                metrics.source = "cache"
+                return cached
+
+        # Proveedor conocido con PDF de texto: parseo local, sin LLM
+        if self.templates is not None:
+            factura_plantilla = self.templates.try_parse(document)
+            if factura_plantilla is not None:
+                print(f"📐 Plantilla: {document.filename} ({factura_plantilla.nombre_proveedor}, sin llamada al LLM)")
+                metrics.source = "template"
+                return factura_plantilla
+        return None
+
+    def _remember(self, document: Document, factura: Factura, cache_key: Optional[str]):
+        """Guarda una extracción del LLM en la caché y aprende la plantilla del proveedor."""
+        if cache_key:
+            self.cache.put(cache_key, factura)
+        if self.templates is not None:
+            self.templates.learn(document, factura)
+
+    def _extract(self, document: Document, metrics: ExtractionMetrics) -> Factura:
+        cache_key = cache_key_for(self.cache, document, self.model_name, self.preprocess)
+        shortcut = self._shortcut(document, metrics, cache_key)
+        if shortcut is not None:
+            return shortcut
+
         print(f"🧠 Analizando documento: {document.filename}...")
 
-        # Construimos el mensaje para el LLM
-        # Si es una imagen (jpg, png), la enviamos como payload de visión.
-        # Si fuera un PDF complejo, habría que extraer texto o convertir a imagen.
-        # Aquí haremos una implementación básica que asume que si es imagen, enviamos imagen.
+        pages = build_page_messages(document, self.preprocess)
+        metrics.pages = len(pages)
+
+        # Llamada mágica a Instructor (modelo barato primero, escalando si hace falta)
+        if len(pages) > 1:
+            print(f"📑 {document.filename}: {len(pages)} páginas → extracción en paralelo")
+        factura_extraida = self._run_cascade(document, pages, metrics)
+        self._remember(document, factura_extraida, cache_key)
         
-        extension = document.filename.split('.')[-1].lower()
-        messages = []
-
-        if extension in ['jpg', 'jpeg', 'png', 'webp']:
-            # Flujo de Visión
-            base64_image = encode_image(document.filepath)
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Extrae la información de esta factura. Si algún campo no está claro, déjalo vacío o infiérelo con sentido común."},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            },
-                        },
-                    ],
-                }
-            ]
+        return factura_extraida
+
+    def extract_stream(self, document: Document) -> Iterator[StreamUpdate]:
+        """
+        Como `extract`, pero publica los campos según llegan (ver src/streaming.py).
+
+        Cada `StreamUpdate` trae la cabecera y las líneas ya definitivas; la última
+        trae además la Factura validada (`update.factura`). Para parar en cuanto
+        basta la cabecera (`update.header_ready`), sal del bucle: el stream se cierra.
+        Solo se hace streaming de la llamada de una página con el primer modelo de la
+        cascada; si su resultado no vale, se sigue con `extract` normal (sin streaming).
+        """
+        started = time.perf_counter()
+        document.metrics = ExtractionMetrics(model=self.model_name, prompt_version=PROMPT_VERSION)
+        try:
+            yield from self._extract_stream(document, document.metrics)
+        finally:
+            document.metrics.wall_time_s = time.perf_counter() - started
+
+    def _extract_stream(self, document: Document, metrics: ExtractionMetrics) -> Iterator[StreamUpdate]:
+        tracker = PartialTracker()
+        cache_key = cache_key_for(self.cache, document, self.model_name, self.preprocess)
+        factura = self._shortcut(document, metrics, cache_key)
+        if factura is not None:
+            yield tracker.finish(factura)
+            return
+
+        print(f"🧠 Analizando documento (streaming): {document.filename}...")
+        pages = build_page_messages(document, self.preprocess)
+        metrics.pages = len(pages)
+        if len(pages) > 1:
+            # Las páginas se fusionan al final: no hay un parcial útil que publicar
+            print(f"📑 {document.filename}: {len(pages)} páginas → extracción en paralelo")
+            factura = self._run_cascade(document, pages, metrics)
+        else:
+            factura = yield from self._stream_first_model(document, pages[0], tracker, metrics)
+        self._remember(document, factura, cache_key)
+        yield tracker.finish(factura)
+
+    def _stream_first_model(self, document: Document, messages: list, tracker: PartialTracker,
+                            metrics: ExtractionMetrics) -> Iterator[StreamUpdate]:
+        """Extrae en streaming con el primer modelo; si no basta, sigue la cascada normal."""
+        model = self.models[0]
+
+        def call():
+            # Sin reintentos de validación: el parcial no se valida hasta el final
+            return self.client.chat.completions.create_partial(
+                model=model,
+                response_model=Factura,
+                messages=list(messages),
+                temperature=0.0,
+                max_retries=1,
+            )
+
+        if self.limiter is None:
+            stream = call()
         else:
-            # Flujo de Texto (asumiendo PDF de texto o fallback)
-            # En un caso real: usaríamos pypdf para extraer texto.
-            # Para este MVP educativo: Le decimos al usuario que use imágenes o 
-            # implementamos un extractor de texto simple si fuera necesario.
-            # Por ahora, simularemos que leemos el archivo como texto si no es imagen,
-            # (esto fallará con PDFs binarios, pero sirve para explicar el concepto).
-            messages = [
-                {
-                    "role": "user", 
-                    "content": f"Extrae los datos de esta factura (nombre archivo: {document.filename}). [Aquí iría el contenido OCR o texto extraído]"
-                }
-            ]
-            print("⚠️ AVISO: Este MVP básico está optimizado para imágenes (JPG/PNG). Para PDFs reales, necesitaríamos 'pdf2image' o 'pypdf'.")
-
-        # Llamada mágica a Instructor
-        factura_extraida = self.client.chat.completions.create(
-            model=self.model_name,
-            response_model=Factura, # <--- AQUÍ ESTÁ LA CLAVE
-            messages=messages,
-            temperature=0.0, # Determinista
+            stream = self.limiter.call(call, estimate_request_tokens(messages), on_retry=metrics.count_network_retry)
+
+        partial = None
+        for partial in stream:
+            update = tracker.update(partial)
+            if update is not None:
+                yield update
+        completion_json = partial.model_dump_json() if partial is not None else ""
+        metrics.add_streamed_call(estimate_request_tokens(messages, completion_tokens=0),
+                                  len(completion_json) // 4, payload_bytes(messages), model)
+
+        try:
+            outcome = Factura.model_validate(partial.model_dump() if partial is not None else {})
+        except ValidationError as e:
+            outcome = e
+        is_last = len(self.models) == 1
+        reason = escalation_reason(outcome)
+        if reason is None or (is_last and isinstance(outcome, Factura)):
+            metrics.model, metrics.tier = model, 0
+            return outcome
+
+        if is_last:
+            # Un solo modelo: repetimos sin streaming, con los reintentos de validación de instructor
+            print(f"🔁 {document.filename}: el resultado en streaming no valida ({reason}) → reintento")
+            metrics.validation_retries += 1
+            return self._run_cascade(document, [messages], metrics)
+        metrics.escalations += 1
+        print(f"⤴️ {document.filename}: {model} no basta ({reason}) → {self.models[1]}")
+        return self._run_cascade(document, [messages], metrics, start=1)
+
+# Resultado de una extracción concurrente: la Factura o la excepción que la hizo fallar.
+# Devolvemos la excepción en lugar de lanzarla para que un documento roto no
+# cancele al resto del lote.
+ExtractionOutcome = Union[Factura, Exception]
+
+class AsyncLLMExtractor:
+    """
+    Variante asíncrona del extractor con concurrencia limitada.
+    
+    ¿CÓMO FUNCIONA?
+    - Usa el cliente `AsyncOpenAI` parcheado por instructor (mismos reintentos de validación).
+    - Un `asyncio.Semaphore` limita cuántas peticiones hay en vuelo a la vez
+      (para no reventar la cuota de la API).
+    - Cada petición tiene su propio timeout: una lenta no bloquea el lote para siempre.
+    - Las páginas de un documento largo se piden a la vez (hasta `page_concurrency`).
+    - Los resultados salen EN EL MISMO ORDEN que entraron los documentos.
+    """
+
+    def __init__(self, api_key: str, concurrency: int = 5, timeout: float = 120.0,
+                 cache: Optional[ExtractionCache] = None, preprocess: Optional[PreprocessConfig] = None,
+                 limiter: Optional[RateLimiter] = None, templates: Optional[SupplierTemplateEngine] = None,
+                 page_concurrency: int = 4, models: Optional[Sequence[str]] = None,
+                 http_client: Optional[httpx.AsyncClient] = None):
+        if concurrency < 1:
+            raise ValueError("concurrency debe ser >= 1")
+        self.limiter = limiter
+        self.templates = templates
+        if limiter is not None:
+            http_client = _with_response_hook(http_client or DefaultAsyncHttpxClient(), limiter.observe_response_async)
+        self.client = instructor.from_openai(AsyncOpenAI(
+            api_key=api_key,
+            timeout=timeout,
+            http_client=http_client,
+            max_retries=0 if limiter else openai.DEFAULT_MAX_RETRIES,
+        ))
+        self.models = list(models or DEFAULT_MODELS)
+        self.model_name = "+".join(self.models)
+        self.concurrency = concurrency
+        self.page_concurrency = max(1, page_concurrency)
+        self.timeout = timeout
+        self.cache = cache
+        self.preprocess = preprocess or PreprocessConfig()
+
+    async def _create(self, messages: list, response_model=Factura, metrics: Optional[ExtractionMetrics] = None,
+                      model: Optional[str] = None):
+        """Llamada asíncrona a instructor (con timeout), pasando por el limitador si lo hay."""
+        model = model or self.models[-1]
+
+        async def call():
+            retries = validation_retries_async()
+            # El timeout cubre la petición, no el tiempo esperando turno en el limitador
+            try:
+                result, completion = await asyncio.wait_for(
+                    self.client.chat.completions.create_with_completion(
+                        model=model,
+                        response_model=response_model,
+                        messages=list(messages),
+                        temperature=0.0,
+                        max_retries=retries,
+                    ),
+                    timeout=self.timeout,
+                )
+            except InstructorRetryException as e:
+                _add_failed_call(metrics, e, messages, model)
+                raise
+            if metrics is not None:
+                metrics.add_call(completion, retries.statistics.get("attempt_number", 1), payload_bytes(messages), model)
+            return result
+
+        if self.limiter is None:
+            return await call()
+        on_retry = metrics.count_network_retry if metrics is not None else None
+        return await self.limiter.call_async(call, estimate_request_tokens(messages), on_retry=on_retry)
+
+    async def _extract_pages(self, pages: List[list], metrics: ExtractionMetrics, model: str) -> Factura:
+        """Extrae todas las páginas con un modelo (a la vez si hay varias) y las fusiona."""
+        if len(pages) == 1:
+            return await self._create(pages[0], Factura, metrics, model)
+
+        page_slots = asyncio.Semaphore(self.page_concurrency)
+
+        async def page_call(messages: list, response_model):
+            async with page_slots:
+                return await self._create(messages, response_model, metrics, model)
+
+        first, *rest = await asyncio.gather(
+            page_call(pages[0], Factura),
+            *(page_call(page, PaginaFactura) for page in pages[1:]),
         )
-        
+        return merge_pages(first, rest)
+
+    async def _run_cascade(self, document: Document, pages: List[list], metrics: ExtractionMetrics) -> Factura:
+        """Versión asíncrona de `LLMExtractor._run_cascade`."""
+        for tier, model in enumerate(self.models):
+            try:
+                outcome = await self._extract_pages(pages, metrics, model)
+            except _NO_ESCALATION_ERRORS:
+                raise
+            except Exception as e:
+                outcome = e
+
+            is_last = tier == len(self.models) - 1
+            reason = None if is_last else escalation_reason(outcome)
+            if reason is None:
+                if isinstance(outcome, Exception):
+                    raise outcome
+                metrics.model, metrics.tier = model, tier
+                return outcome
+
+            metrics.escalations += 1
+            print(f"⤴️ {document.filename}: {model} no basta ({reason}) → {self.models[tier + 1]}")
+
+    async def extract(self, document: Document) -> Factura:
+        """
+        Extrae una factura de forma asíncrona (con timeout por petición).
+        Las métricas de la extracción quedan en `document.metrics`.
+        """
+        started = time.perf_counter()
+        document.metrics = ExtractionMetrics(model=self.model_name, prompt_version=PROMPT_VERSION)
+        try:
+            return await self._extract(document, document.metrics)
+        finally:
+            document.metrics.wall_time_s = time.perf_counter() - started
+
+    async def _extract(self, document: Document, metrics: ExtractionMetrics) -> Factura:
+        cache_key = cache_key_for(self.cache, document, self.model_name, self.preprocess)
+        if cache_key:
+            # La caché es SQLite (disco y un lock): fuera del event loop
+            cached = await asyncio.to_thread(self.cache.get, cache_key)
+            if cached is not None:
+                print(f"⚡ Caché: {document.filename} (sin llamada al LLM)")
+                metrics.source = "cache"
+                return cached
+
+        if self.templates is not None:
+            # Leer el PDF y aplicar regex es CPU/disco: fuera del event loop
+            factura_plantilla = await asyncio.to_thread(self.templates.try_parse, document)
+            if factura_plantilla is not None:
+                print(f"📐 Plantilla: {document.filename} ({factura_plantilla.nombre_proveedor}, sin llamada al LLM)")
+                metrics.source = "template"
+                return factura_plantilla
+
+        print(f"🧠 Analizando documento: {document.filename}...")
+
+        # Leer y codificar el archivo es E/S de disco: lo sacamos del event loop
+        pages = await asyncio.to_thread(build_page_messages, document, self.preprocess)
+        metrics.pages = len(pages)
+
+        if len(pages) > 1:
+            print(f"📑 {document.filename}: {len(pages)} páginas → extracción en paralelo")
+        factura_extraida = await self._run_cascade(document, pages, metrics)
+
+        if cache_key:
+            await asyncio.to_thread(self.cache.put, cache_key, factura_extraida)
+        if self.templates is not None:
+            await asyncio.to_thread(self.templates.learn, document, factura_extraida)
+
         return factura_extraida
+
+    async def extract_many(self, documents: Iterable[Document]) -> AsyncIterator[Tuple[Document, ExtractionOutcome]]:
+        """
+        Extrae un flujo de documentos con como mucho `concurrency` peticiones en vuelo.
+        
+        Acepta cualquier iterable (incluido el generador perezoso del ingestor) y va
+        devolviendo pares (documento, resultado) en orden de entrada. Solo se
+        adelantan `2 * concurrency` documentos, así que la memoria no depende
+        del tamaño de la carpeta.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        window = 2 * self.concurrency
+
+        async def run(doc: Document) -> ExtractionOutcome:
+            async with semaphore:
+                try:
+                    return await self.extract(doc)
+                except asyncio.TimeoutError:
+                    return TimeoutError(f"Timeout ({self.timeout:.0f}s) extrayendo {doc.filename}")
+                except Exception as e:
+                    return e
+
+        in_flight = deque()
+        iterator = iter(documents)
+        while True:
+            # El ingestor calcula hashes al avanzar: lo hacemos en un hilo
+            # para que las respuestas que van llegando se sigan atendiendo.
+            doc = await asyncio.to_thread(next, iterator, None)
+            if doc is None:
+                break
+            in_flight.append((doc, asyncio.create_task(run(doc))))
+            if len(in_flight) >= window:
+                head, task = in_flight.popleft()
+                yield head, await task
+
+        while in_flight:
+            head, task = in_flight.popleft()
+            yield head, await task
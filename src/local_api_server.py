@@ -0,0 +1,303 @@
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from .models import Factura, ItemFactura, PaginaFactura
+from .replay import Cassette, request_key
+from .supplier_registry import cif_control_digit
+
+# -----------------------------------------------------------------------------
+# 12. SERVIDOR LOCAL COMPATIBLE CON OPENAI (Pruebas sin internet)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es un "doble" de la API de OpenAI que corre en tu máquina. Responde a los mismos
+# endpoints que usamos (chat completions, files y batches) con facturas sintéticas.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Benchmarks reproducibles: Podemos medir el rendimiento del pipeline (batch,
+#    concurrencia, conciliación) sin gastar dinero ni depender de la red.
+# 2. Latencia y errores configurables: `latency` simula el tiempo de respuesta del
+#    modelo y `error_rate` la proporción de peticiones que devuelven HTTP 500.
+#    `weak_model` + `weak_rate` simulan un modelo barato que a veces se equivoca
+#    (deja vacío el número de factura), para probar la cascada de modelos.
+# 3. Mismo cliente: Basta con exportar OPENAI_BASE_URL=http://127.0.0.1:8765/v1;
+#    el código de producción no cambia.
+# 4. Replay: Con `--replay cassette.jsonl` sirve las respuestas grabadas con
+#    EXTRACTOR_BACKEND=record (ver `replay.py`); lo no grabado sigue siendo sintético.
+# 5. Streaming: Con `stream=True` la respuesta sale a trozos (Server-Sent Events)
+#    y la latencia se reparte entre ellos, como en la API real.
+#
+# USO:
+#   python -m src.local_api_server --port 8765 --latency 0.5 --error-rate 0.02
+# -----------------------------------------------------------------------------
+
+def synthetic_factura(seed: str) -> Factura:
+    """Genera una factura coherente (pasa la validación) a partir de una semilla."""
+    digest = hashlib.sha256(seed.encode("utf-8")).hexdigest()
+    base = round(50 + int(digest[:6], 16) % 5000 + int(digest[6:8], 16) / 100, 2)
+    impuestos = round(base * 0.21, 2)
+    cif_body = f"{int(digest[10:18], 16) % 10**7:07d}"  # Con dígito de control válido
+    return Factura(
+        numero_factura=f"F-{digest[:8].upper()}",
+        fecha_emision="2024-01-15",
+        nombre_proveedor=f"Proveedor {int(digest[8:10], 16) % 20:02d} S.L.",
+        cif_proveedor=f"B{cif_body}{cif_control_digit(cif_body)}",
+        base_imponible=base,
+        total_impuestos=impuestos,
+        total_factura=round(base + impuestos, 2),
+        items=[ItemFactura(descripcion="Servicios profesionales", cantidad=1, precio_unitario=base, total_linea=base)],
+    )
+
+def synthetic_response(request: dict, seed: str) -> BaseModel:
+    """Respuesta sintética con el modelo que pide la tool call (Factura o PaginaFactura)."""
+    factura = synthetic_factura(seed)
+    if requested_tool(request) == "PaginaFactura":
+        # Página de continuación: solo líneas (los totales van en la página 1)
+        return PaginaFactura(items=factura.items)
+    return factura
+
+def requested_tool(request: dict) -> str:
+    tool_choice = request.get("tool_choice")
+    if isinstance(tool_choice, dict):
+        return tool_choice.get("function", {}).get("name", "Factura")
+    return "Factura"
+
+def chat_completion_body(request: dict, factura: BaseModel) -> dict:
+    """Respuesta de chat completions con una tool call que contiene la Factura."""
+    prompt_chars = len(json.dumps(request.get("messages", [])))
+    arguments = factura.model_dump_json()
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "gpt-4o"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "tool_calls",
+            "message": {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {"name": type(factura).__name__, "arguments": arguments},
+                }],
+            },
+        }],
+        "usage": {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(arguments) // 4,
+            "total_tokens": prompt_chars // 4 + len(arguments) // 4,
+        },
+    }
+
+def stream_chunks(body: dict, chunk_chars: int = 32) -> List[dict]:
+    """Parte una respuesta de chat completions en los chunks de `stream=True` (SSE)."""
+    call = body["choices"][0]["message"]["tool_calls"][0]
+    arguments = call["function"]["arguments"]
+    base = {"id": body["id"], "object": "chat.completion.chunk", "created": body["created"], "model": body["model"]}
+    chunks = [{**base, "choices": [{"index": 0, "finish_reason": None, "delta": {
+        "role": "assistant", "content": None,
+        "tool_calls": [{"index": 0, "id": call["id"], "type": "function",
+                        "function": {"name": call["function"]["name"], "arguments": ""}}],
+    }}]}]
+    for start in range(0, len(arguments), chunk_chars):
+        piece = arguments[start:start + chunk_chars]
+        chunks.append({**base, "choices": [{"index": 0, "finish_reason": None, "delta": {
+            "tool_calls": [{"index": 0, "function": {"arguments": piece}}],
+        }}]})
+    chunks.append({**base, "choices": [{"index": 0, "finish_reason": "tool_calls", "delta": {}}]})
+    return chunks
+
+class LocalAPIState:
+    """Archivos y batches en memoria del servidor local."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0,
+                 weak_model: Optional[str] = None, weak_rate: float = 0.0,
+                 replay: Optional[str] = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.weak_model = weak_model
+        self.weak_rate = weak_rate
+        self.cassette = Cassette(replay) if replay else None
+        self.files: Dict[str, dict] = {}
+        self.batches: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def complete(self, request: dict) -> (int, dict):
+        """Simula una chat completion: latencia + posible error + respuesta grabada o sintética."""
+        if self.latency and not request.get("stream"):  # En streaming la latencia se reparte entre chunks
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, {"error": {"message": "Error simulado", "type": "server_error"}}
+        if self.cassette is not None:
+            # La huella ordena las claves: vale igual el cuerpo ya decodificado
+            recorded = self.cassette.get(request_key(json.dumps(request).encode("utf-8")))
+            if recorded is not None:
+                return 200, recorded
+        seed = json.dumps(request.get("messages", []), sort_keys=True)
+        response = synthetic_response(request, seed)
+        if (request.get("model") == self.weak_model and isinstance(response, Factura)
+                and random.random() < self.weak_rate):
+            response = response.model_copy(update={"numero_factura": None})
+        return 200, chat_completion_body(request, response)
+
+    def add_file(self, filename: str, content: bytes, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        meta = {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed",
+        }
+        with self.lock:
+            self.files[file_id] = {"meta": meta, "content": content}
+        return meta
+
+    def create_batch(self, body: dict) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window", "24h"),
+            "status": "in_progress", "created_at": int(time.time()), "metadata": body.get("metadata"),
+            "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch_id: str):
+        batch = self.batches[batch_id]
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        batch["request_counts"]["total"] = len(lines)
+        output, errors = [], []
+        for raw in lines:
+            request = json.loads(raw)
+            status, body = self.complete(request["body"])
+            line = {
+                "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": status, "body": body},
+                "error": None,
+            }
+            (output if status == 200 else errors).append(json.dumps(line))
+            batch["request_counts"]["completed" if status == 200 else "failed"] += 1
+
+        if output:
+            batch["output_file_id"] = self.add_file("output.jsonl", "\n".join(output).encode("utf-8"), "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = self.add_file("errors.jsonl", "\n".join(errors).encode("utf-8"), "batch_output")["id"]
+        batch["status"] = "completed"
+
+class LocalAPIHandler(BaseHTTPRequestHandler):
+    """Enruta las peticiones HTTP a `LocalAPIState`."""
+    state: LocalAPIState = None
+
+    def log_message(self, format, *args):
+        pass  # Silencioso: en benchmarks miles de líneas de log falsean la medida
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, chunks: List[dict]):
+        """Envía los chunks como Server-Sent Events, repartiendo la latencia entre ellos."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        delay = self.state.latency / len(chunks)
+        for chunk in chunks:
+            time.sleep(delay)
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True  # Sin Content-Length: el cierre marca el final
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            request = json.loads(self._read_body())
+            status, payload = self.state.complete(request)
+            if request.get("stream") and status == 200:
+                # Grabada en streaming: ya es la lista de chunks
+                return self._send_stream(payload if isinstance(payload, list) else stream_chunks(payload))
+            return self._send_json(status, payload)
+        if path.endswith("/files"):
+            return self._upload_file()
+        if path.endswith("/batches"):
+            return self._send_json(200, self.state.create_batch(json.loads(self._read_body())))
+        self._send_json(404, {"error": {"message": f"Ruta no soportada: {self.path}"}})
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in self.state.batches:
+            return self._send_json(200, self.state.batches[parts[-1]])
+        if len(parts) >= 3 and parts[-1] == "content" and parts[-2] in self.state.files:
+            content = self.state.files[parts[-2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        self._send_json(404, {"error": {"message": f"No encontrado: {self.path}"}})
+
+    def _upload_file(self):
+        # multipart/form-data: lo parseamos con el parser MIME de la librería estándar
+        raw = b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self._read_body()
+        message = BytesParser(policy=default_policy).parsebytes(raw)
+        fields, filename, content = {}, "upload.jsonl", b""
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                filename, content = part.get_filename(), part.get_payload(decode=True)
+            else:
+                fields[name] = part.get_content().strip()
+        self._send_json(200, self.state.add_file(filename, content, fields.get("purpose", "batch")))
+
+def start_server(port: int = 8765, latency: float = 0.0, error_rate: float = 0.0,
+                 host: str = "127.0.0.1", weak_model: Optional[str] = None,
+                 weak_rate: float = 0.0, replay: Optional[str] = None) -> ThreadingHTTPServer:
+    """Arranca el servidor en un hilo de fondo y lo devuelve (para parar: .shutdown())."""
+    state = LocalAPIState(latency, error_rate, weak_model, weak_rate, replay)
+    handler = type("BoundLocalAPIHandler", (LocalAPIHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Servidor local compatible con la API de OpenAI")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Segundos de latencia simulada por petición")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Proporción de peticiones con HTTP 500")
+    parser.add_argument("--weak-model", default=None, help="Modelo que a veces devuelve facturas incompletas")
+    parser.add_argument("--weak-rate", type=float, default=0.0, help="Proporción de respuestas incompletas del --weak-model")
+    parser.add_argument("--replay", default=None, help="Cassette JSONL con respuestas grabadas a servir")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.latency, args.error_rate,
+                          weak_model=args.weak_model, weak_rate=args.weak_rate, replay=args.replay)
+    print(f"🧪 Servidor local escuchando en http://127.0.0.1:{args.port}/v1 (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,189 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, bindparam, inspect, insert, select, text, update,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+from .duplicates import normalise_cif, normalise_numero, normalise_proveedor
+
+# -----------------------------------------------------------------------------
+# 23. MIGRACIONES DEL ESQUEMA (Evolucionar la base sin borrarla)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la lista numerada de cambios que ha sufrido la estructura de la base de datos
+# (columnas, índices, datos derivados). Al arrancar, `Storage` aplica los que le
+# falten al archivo SQLite que encuentre, sea de hace un año o recién creado.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Versión guardada en la propia base: La tabla `schema_version` anota qué
+#    migraciones se aplicaron y cuándo. Arrancar no inspecciona el esquema entero
+#    ni recorre tablas: una consulta y, si no falta nada, listo.
+# 2. Una transacción por migración: En SQLite los ALTER/CREATE INDEX son
+#    transaccionales. Si una migración falla a medias, no queda aplicada ni anotada
+#    y se reintenta en el siguiente arranque.
+# 3. Varios procesos a la vez: Watcher y dashboard arrancan juntos. Cada migración
+#    empieza escribiendo su fila en `schema_version` (clave primaria = versión):
+#    el primero que llega la aplica; el otro espera el bloqueo y ve que ya está.
+# 4. Sin Alembic: Para una base local basta con esto. Si se pasa a PostgreSQL con
+#    varios equipos tocando el esquema, este es el punto a sustituir por Alembic.
+# -----------------------------------------------------------------------------
+
+_metadata = MetaData()
+
+schema_version = Table(
+    "schema_version", _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String),
+    Column("applied_at", DateTime),
+)
+
+@dataclass(frozen=True)
+class Migration:
+    """Un cambio del esquema. `apply` recibe la conexión (dentro de la transacción) y los modelos."""
+    version: int
+    description: str
+    apply: Callable[[Connection, MetaData], None]
+
+def _create_indexes(*names: str) -> Callable[[Connection, MetaData], None]:
+    """Migración que crea los índices `names` de los modelos (todos si no se indica ninguno)."""
+    def apply(conn: Connection, metadata: MetaData):
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                if not names or index.name in names:
+                    index.create(conn, checkfirst=True)
+    return apply
+
+def _add_columns(table_name: str, *names: str) -> Callable[[Connection, MetaData], None]:
+    """Migración que añade las columnas `names` del modelo a `table_name`, si faltan."""
+    def apply(conn: Connection, metadata: MetaData):
+        table = metadata.tables[table_name]
+        existing = {column["name"] for column in inspect(conn).get_columns(table_name)}
+        for name in names:
+            if name not in existing:
+                column_type = table.c[name].type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"))
+                print(f"🛠️ Columna añadida: {table_name}.{name}")
+    return apply
+
+def _add_missing_columns(conn: Connection, metadata: MetaData):
+    """
+    ALTER TABLE ADD COLUMN de todas las columnas de los modelos que falten.
+
+    `create_all` crea tablas que faltan pero NO altera las que ya existen. Para
+    columnas nuevas y opcionales basta con un ALTER TABLE ADD COLUMN.
+    """
+    for table in metadata.sorted_tables:
+        _add_columns(table.name, *table.columns.keys())(conn, metadata)
+
+def _baseline(conn: Connection, metadata: MetaData):
+    """Columnas e índices añadidos a mano antes de existir las migraciones (bases de cualquier versión)."""
+    _add_missing_columns(conn, metadata)
+    _create_indexes()(conn, metadata)
+
+def _backfill_duplicate_keys(conn: Connection, metadata: MetaData, chunk_size: int = 50_000):
+    """Calcula las claves de duplicado de las facturas guardadas antes de que existieran."""
+    table = metadata.tables["facturas"]
+    # Usa el índice: no recorre la tabla si no hay pendientes (base nueva o ya rellenada)
+    if conn.execute(select(table.c.id).where(table.c.proveedor_norm.is_(None)).limit(1)).first() is None:
+        return
+    write = (
+        update(table)
+        .where(table.c.id == bindparam("b_id"))
+        .values(cif_norm=bindparam("b_cif"), numero_norm=bindparam("b_numero"), proveedor_norm=bindparam("b_proveedor"))
+    )
+    chunk = (
+        select(table.c.id, table.c.cif_proveedor, table.c.numero_factura, table.c.nombre_proveedor,
+               table.c.proveedor_norm)
+        .order_by(table.c.id)
+        .limit(chunk_size)
+    )
+    filled, last_id = 0, 0
+    while True:
+        # Paginación por id (clave primaria): cada bloque empieza donde acabó el anterior
+        rows = conn.execute(chunk.where(table.c.id > last_id)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        rows = [row for row in rows if row.proveedor_norm is None]
+        if rows:
+            conn.execute(write, [
+                {"b_id": row.id, "b_cif": normalise_cif(row.cif_proveedor),
+                 "b_numero": normalise_numero(row.numero_factura),
+                 "b_proveedor": normalise_proveedor(row.nombre_proveedor)}
+                for row in rows
+            ])
+            filled += len(rows)
+    if filled:
+        print(f"🛠️ Claves de duplicado calculadas para {filled:,} facturas existentes")
+
+def _add_updated_at(conn: Connection, metadata: MetaData):
+    """Columna `updated_at` con su índice; las filas existentes toman su fecha de alta."""
+    _add_columns("facturas", "updated_at")(conn, metadata)
+    # Con hora y en el formato de SQLAlchemy: SQLite guarda DateTime como texto y la marca
+    # de la exportación se compara como texto ('2024-01-15' a secas quedaría fuera de orden)
+    conn.execute(text("UPDATE facturas SET updated_at = COALESCE(created_at, DATE('now')) || ' 00:00:00.000000' "
+                      "WHERE updated_at IS NULL"))
+    _create_indexes("ix_facturas_updated_at")(conn, metadata)
+
+# Añadir al final, nunca reordenar ni renumerar: la versión es lo que queda anotado en cada base
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Columnas e índices anteriores a las migraciones", _baseline),
+    Migration(2, "Claves normalizadas de duplicado (cif_norm, numero_norm, proveedor_norm)", _backfill_duplicate_keys),
+    Migration(3, "Índices de los filtros del dashboard (estado y proveedor por fecha)",
+              _create_indexes("ix_facturas_status_fecha", "ix_facturas_proveedor_fecha")),
+    # La tabla extraction_archive es nueva: la crea create_all
+    Migration(4, "Moneda y cliente de la factura", _add_columns("facturas", "moneda", "nombre_cliente")),
+    # La tabla export_watermarks es nueva: la crea create_all
+    Migration(5, "Fecha de modificación de las facturas (exportación incremental)", _add_updated_at),
+]
+
+def current_version(engine: Engine) -> int:
+    """Última migración aplicada (0 si la base no tiene `schema_version`)."""
+    if not inspect(engine).has_table(schema_version.name):
+        return 0
+    with engine.connect() as conn:
+        return conn.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc())).scalar() or 0
+
+def applied_migrations(engine: Engine) -> List[dict]:
+    """Filas de `schema_version` (versión, descripción, fecha), de la más antigua a la última."""
+    if not inspect(engine).has_table(schema_version.name):
+        return []
+    with engine.connect() as conn:
+        return [dict(row._mapping) for row in conn.execute(select(schema_version).order_by(schema_version.c.version))]
+
+def migrate(engine: Engine, metadata: MetaData, migrations: Optional[List[Migration]] = None) -> List[Migration]:
+    """Crea las tablas que falten y aplica las migraciones pendientes, en orden. Devuelve las aplicadas."""
+    migrations = MIGRATIONS if migrations is None else migrations
+    existing = set(inspect(engine).get_table_names())
+    # Tablas nuevas: se crean ya con todas sus columnas e índices
+    metadata.create_all(engine)
+    _metadata.create_all(engine)
+    with engine.begin() as conn:
+        if not existing & set(metadata.tables):
+            # Base recién creada: ya tiene el esquema actual, no hay nada que migrar
+            try:
+                conn.execute(insert(schema_version), [
+                    {"version": m.version, "description": m.description, "applied_at": datetime.now()}
+                    for m in migrations
+                ])
+            except IntegrityError:
+                pass  # Otro proceso creó la base a la vez y ya las anotó
+            return []
+        done = set(conn.execute(select(schema_version.c.version)).scalars())
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version in done:
+            continue
+        with engine.begin() as conn:
+            try:
+                # Primero la anotación: toma el bloqueo de escritura antes de tocar nada
+                conn.execute(insert(schema_version).values(
+                    version=migration.version, description=migration.description, applied_at=datetime.now()))
+            except IntegrityError:
+                continue  # Otro proceso la aplicó mientras tanto
+            migration.apply(conn, metadata)
+        print(f"🛠️ Migración {migration.version:03d} aplicada: {migration.description}")
+        applied.append(migration)
+    return applied
@@ -86,3 +86,22 @@ class Factura(BaseModel):
         default_factory=list,
         description="Lista de líneas o conceptos de la factura."
     )
+
+class PaginaFactura(BaseModel):
+    """Contenido de una página de continuación (de la 2 en adelante) de una factura larga."""
+    items: List[ItemFactura] = Field(
+        default_factory=list,
+        description="Líneas de detalle que aparecen en ESTA página. No incluyas la cabecera de la tabla ni filas de arrastre como 'Suma y sigue' o 'Suma anterior'."
+    )
+    base_imponible: Optional[float] = Field(
+        None,
+        description="Base imponible de la factura, SOLO si aparece en esta página."
+    )
+    total_impuestos: Optional[float] = Field(
+        None,
+        description="Total de impuestos de la factura, SOLO si aparece en esta página."
+    )
+    total_factura: Optional[float] = Field(
+        None,
+        description="Importe final a pagar, SOLO si aparece en esta página."
+    )
@@ -0,0 +1,98 @@
+import re
+from typing import List, Optional, Tuple
+from .models import Factura, ItemFactura, PaginaFactura
+
+# -----------------------------------------------------------------------------
+# 16. FACTURAS MULTIPÁGINA (Extracción por página + fusión)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es el "montador" de facturas largas. Una factura de la luz con 6 páginas de
+# líneas se extrae página a página (en paralelo) y aquí se juntan los trozos en
+# una sola `Factura`.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Latencia: El tiempo de una llamada al LLM crece con los tokens de salida. Seis
+#    páginas de líneas en una sola llamada tardan ~6 veces más que una página; seis
+#    llamadas en paralelo tardan lo que la página más larga.
+# 2. Sin truncar: Antes solo se enviaban las primeras páginas. Ahora cada página
+#    tiene su propia llamada, con su propio presupuesto de salida.
+# 3. Reparto de papeles: La página 1 aporta la cabecera (número, fecha, proveedor).
+#    Todas aportan líneas. Los totales se toman de la última página que los traiga
+#    (suelen estar al final).
+# 4. Deduplicación: Las facturas largas repiten filas entre páginas ("Suma y sigue",
+#    la última línea de una página repetida arriba de la siguiente, pies de página
+#    que el LLM confunde con líneas). Se eliminan antes de validar. Una fila que
+#    sale en TODAS las páginas puede ser un cargo real por página: solo se quita si
+#    así la suma de líneas se acerca a la base imponible.
+# -----------------------------------------------------------------------------
+
+# Filas de arrastre entre páginas: no son conceptos facturados
+_CARRY_OVER_RE = re.compile(
+    r"^\s*(suma\s+y\s+sigue|suma\s+anterior|a\s+trasladar|trasladado|total\s+p[aá]gina|subtotal\s+p[aá]gina)\b",
+    re.IGNORECASE,
+)
+
+def _item_key(item: ItemFactura) -> Tuple:
+    """Clave de comparación de una línea (descripción normalizada + importes)."""
+    description = " ".join(item.descripcion.split()).casefold()
+    return description, round(item.cantidad, 2), round(item.precio_unitario, 2), round(item.total_linea, 2)
+
+def dedupe_page_items(pages: List[List[ItemFactura]], base_imponible: Optional[float] = None) -> List[ItemFactura]:
+    """
+    Une las líneas de todas las páginas eliminando las repetidas por el maquetado.
+
+    - Filas de arrastre ('Suma y sigue', 'Suma anterior', 'Total página').
+    - La primera fila de una página si es idéntica a la última de la anterior.
+    - Filas que aparecen en TODAS las páginas (3 o más): cabecera/pie repetido,
+      se conserva solo la primera aparición. Solo si hay `base_imponible` y sin
+      ellas la suma de líneas queda igual o más cerca; si no, son cargos reales.
+    """
+    pages = [[item for item in page if not _CARRY_OVER_RE.match(item.descripcion)] for page in pages]
+
+    repeated = set()
+    if len(pages) >= 3:
+        keys_per_page = [{_item_key(item) for item in page} for page in pages]
+        repeated = set.intersection(*keys_per_page)
+    kept = _merge(pages, set())
+    if not repeated or base_imponible is None:
+        return kept
+    dropped = _merge(pages, repeated)
+
+    def gap(items: List[ItemFactura]) -> float:
+        return abs(sum(item.total_linea for item in items) - base_imponible)
+
+    return dropped if gap(dropped) <= gap(kept) else kept
+
+def _merge(pages: List[List[ItemFactura]], repeated: set) -> List[ItemFactura]:
+    """Concatena las páginas quitando el solape entre páginas y las repeticiones de `repeated`."""
+    merged: List[ItemFactura] = []
+    seen_repeated = set()
+    previous_last = None
+    for page in pages:
+        for position, item in enumerate(page):
+            key = _item_key(item)
+            if position == 0 and key == previous_last:
+                continue
+            if key in repeated:
+                if key in seen_repeated:
+                    continue
+                seen_repeated.add(key)
+            merged.append(item)
+        if page:
+            previous_last = _item_key(page[-1])
+    return merged
+
+def merge_pages(first: Factura, continuation: List[PaginaFactura]) -> Factura:
+    """Fusiona la página 1 (Factura completa) con las páginas de continuación."""
+    totals = {}
+    for page in continuation:
+        if page.total_factura is not None:
+            # Totales de la última página que los traiga (y no de una anterior a medias)
+            totals = {
+                name: value for name in ("base_imponible", "total_impuestos", "total_factura")
+                if (value := getattr(page, name)) is not None
+            }
+
+    base = totals.get("base_imponible", first.base_imponible)
+    items = dedupe_page_items([first.items] + [page.items for page in continuation], base)
+    return first.model_copy(update={"items": items, **totals})
@@ -0,0 +1,102 @@
+from typing import List, Optional, Tuple
+from .image_preprocessing import PreprocessConfig, PreparedImage, prepare_pil_image
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# -----------------------------------------------------------------------------
+# 10. LECTOR DE PDFs (Texto primero, imagen solo si hace falta)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es el módulo que decide CÓMO le enseñamos un PDF al LLM.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Coste: La mayoría de PDFs de proveedores se generan desde un ERP y tienen una
+#    capa de texto seleccionable. Extraerla en local (pypdf) es gratis y mandarla
+#    como texto cuesta un orden de magnitud menos que mandar imágenes de visión.
+# 2. Fallback: Si el PDF es un escaneo (sin texto, o con 4 caracteres sueltos),
+#    rasterizamos las páginas a imagen (pypdfium2) y usamos el flujo de visión.
+# 3. Sin dependencias del sistema: pypdfium2 trae su propio binario, así que no
+#    hace falta instalar poppler en el contenedor (como pediría pdf2image).
+# -----------------------------------------------------------------------------
+
+# Por debajo de esta media de caracteres por página consideramos que el PDF
+# es un escaneo (o que el texto es basura del OCR del escáner).
+MIN_CHARS_PER_PAGE = 80
+
+# Límite de texto que mandamos al LLM (una factura normal ocupa 2-10k caracteres)
+MAX_TEXT_CHARS = 40_000
+
+def extract_pdf_text(pdf_path: str, max_pages: Optional[int] = None) -> List[str]:
+    """Extrae la capa de texto de cada página. Devuelve [] si no se puede leer."""
+    if PdfReader is None:
+        print("⚠️ pypdf no está instalado: no se puede leer la capa de texto del PDF.")
+        return []
+
+    try:
+        reader = PdfReader(pdf_path)
+        pages = reader.pages if max_pages is None else reader.pages[:max_pages]
+        return [(page.extract_text() or "").strip() for page in pages]
+    except Exception as e:
+        print(f"⚠️ No se pudo leer el texto de {pdf_path}: {e}")
+        return []
+
+def has_usable_text(page_texts: List[str], min_chars_per_page: int = MIN_CHARS_PER_PAGE) -> bool:
+    """¿La capa de texto tiene contenido suficiente para no necesitar visión?"""
+    if not page_texts:
+        return False
+    total_chars = sum(len(text) for text in page_texts)
+    return total_chars / len(page_texts) >= min_chars_per_page
+
+def join_pages(page_texts: List[str], max_chars: int = MAX_TEXT_CHARS, start: int = 1) -> str:
+    """Une las páginas (numeradas desde `start`) con separadores claros y recorta a `max_chars`."""
+    text = "\n\n".join(
+        f"--- Página {i} ---\n{page}" for i, page in enumerate(page_texts, start=start)
+    )
+    return text[:max_chars]
+
+def group_pages(page_texts: List[str], max_chars: int = MAX_TEXT_CHARS) -> List[Tuple[int, int]]:
+    """
+    Agrupa páginas consecutivas en tramos (primera, última) de hasta `max_chars` caracteres.
+
+    Una página de texto cabe muchas veces en una llamada: agrupar evita repetir el
+    prompt por cada página. Una página más larga que `max_chars` va sola (y se recorta).
+    """
+    groups, first, size = [], 1, 0
+    for number, page in enumerate(page_texts, start=1):
+        length = len(page) + 20  # Separador "--- Página N ---"
+        if number > first and size + length > max_chars:
+            groups.append((first, number - 1))
+            first, size = number, 0
+        size += length
+    if page_texts:
+        groups.append((first, len(page_texts)))
+    return groups
+
+def rasterize_pdf(pdf_path: str, config: PreprocessConfig = None, dpi: int = 150,
+                  max_pages: Optional[int] = None) -> List[PreparedImage]:
+    """Convierte las páginas del PDF en imágenes JPEG listas para visión."""
+    if pdfium is None:
+        raise RuntimeError("El PDF no tiene texto y pypdfium2 no está instalado para rasterizarlo.")
+
+    config = config or PreprocessConfig()
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        n_pages = len(pdf) if max_pages is None else min(len(pdf), max_pages)
+        images = []
+        for index in range(n_pages):
+            page = pdf[index]
+            bitmap = page.render(scale=dpi / 72)
+            # original_bytes = 0: no hay "imagen original" con la que comparar
+            images.append(prepare_pil_image(bitmap.to_pil(), config, original_bytes=0))
+            page.close()
+        return images
+    finally:
+        pdf.close()
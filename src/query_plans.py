@@ -0,0 +1,91 @@
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Callable, List, Optional
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+from .models import Factura
+from .storage import DBItemFactura, Storage, filter_options_queries, invoice_filter_query
+from .bulk_validation import BulkRevalidator
+from .incremental_export import Watermark, changed_invoices_query, invoice_items_query
+
+# -----------------------------------------------------------------------------
+# 24. PLANES DE CONSULTA (¿Usa cada consulta su índice?)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Un índice que existe pero no se usa es peor que no tenerlo: ocupa disco y frena
+# cada INSERT. Aquí se le pregunta a SQLite (EXPLAIN QUERY PLAN) cómo piensa
+# resolver cada consulta importante del sistema y se comprueba que usa el índice
+# previsto y no recorre la tabla entera.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Las consultas reales: Cada comprobación construye la consulta con el MISMO
+#    código que la ejecuta (storage.py, bulk_validation.py, incremental_export.py).
+#    Si alguien cambia un filtro y deja de encajar con el índice, falla aquí y no
+#    en producción.
+# 2. Con la base de verdad: `python main.py check-schema` lo comprueba contra
+#    data/facturas.db (o una copia con millones de filas) y sale con código 1 si
+#    algún plan no usa su índice, para poder ponerlo en CI.
+# 3. Solo SQLite: EXPLAIN QUERY PLAN es de SQLite. En otra base se omite.
+# -----------------------------------------------------------------------------
+
+# Factura de ejemplo para construir las consultas (los valores no cambian el plan)
+_MUESTRA = Factura(
+    numero_factura="F-2024/001", fecha_emision=date(2024, 1, 15), nombre_proveedor="Ferretería López S.L.",
+    cif_proveedor="B12345674", base_imponible=100.0, total_impuestos=21.0, total_factura=121.0, items=[],
+)
+
+@dataclass(frozen=True)
+class AccessPath:
+    """Una consulta del sistema y el índice que debe usar."""
+    name: str
+    index: str  # Texto que debe aparecer en el plan (nombre del índice)
+    query: Callable[[Engine], Select]
+
+@dataclass
+class PlanCheck:
+    """Resultado de comprobar un AccessPath."""
+    path: AccessPath
+    plan: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return any(self.path.index in line for line in self.plan)
+
+ACCESS_PATHS: List[AccessPath] = [
+    AccessPath("Dashboard: facturas por estado y fechas", "ix_facturas_status_fecha",
+               lambda engine: invoice_filter_query(date(2024, 1, 1), date(2024, 3, 31), estados=["REVIEW"])),
+    AccessPath("Dashboard: facturas de un proveedor por fechas", "ix_facturas_proveedor_fecha",
+               lambda engine: invoice_filter_query(date(2024, 1, 1), date(2024, 3, 31),
+                                                   proveedores=[_MUESTRA.nombre_proveedor])),
+    AccessPath("Dashboard: rango de fechas del filtro", "ix_facturas_fecha_emision",
+               lambda engine: filter_options_queries()["fechas"]),
+    AccessPath("Dashboard: estados del filtro", "ix_facturas_status_fecha",
+               lambda engine: filter_options_queries()["estados"]),
+    AccessPath("Dashboard: proveedores del filtro", "ix_facturas_proveedor_fecha",
+               lambda engine: filter_options_queries()["proveedores"]),
+    AccessPath("Duplicados: CIF + número", "ix_facturas_clave_fiscal",
+               lambda engine: Storage.duplicate_queries(_MUESTRA)[0][1]),
+    AccessPath("Duplicados: proveedor + fecha + total", "ix_facturas_proveedor_fecha_total",
+               lambda engine: Storage.duplicate_queries(_MUESTRA)[1][1]),
+    AccessPath("Revalidación: suma de líneas por factura", "ix_invoice_items_factura_id",
+               lambda engine: BulkRevalidator(engine)._items_query(1, 100_000, None, None)),
+    AccessPath("Edición: líneas de una factura", "ix_invoice_items_factura_id",
+               lambda engine: select(DBItemFactura).where(DBItemFactura.factura_id == 1)),
+    AccessPath("Exportación incremental: cambios desde la marca", "ix_facturas_updated_at",
+               lambda engine: changed_invoices_query(Watermark(datetime(2024, 1, 15), 1), datetime(2024, 1, 16))),
+    AccessPath("Exportación incremental: líneas de las facturas exportadas", "ix_invoice_items_factura_id",
+               lambda engine: invoice_items_query([1, 2, 3])),
+]
+
+def explain(engine: Engine, query: Select) -> List[str]:
+    """Líneas de EXPLAIN QUERY PLAN de `query` (con los parámetros ya sustituidos)."""
+    sql = str(query.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+
+def check_query_plans(engine: Engine, paths: Optional[List[AccessPath]] = None) -> List[PlanCheck]:
+    """Plan de cada consulta de `paths` (por defecto ACCESS_PATHS). Vacío si la base no es SQLite."""
+    if engine.dialect.name != "sqlite":
+        return []
+    return [PlanCheck(path, explain(engine, path.query(engine))) for path in (paths or ACCESS_PATHS)]
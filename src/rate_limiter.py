@@ -0,0 +1,296 @@
+import re
+import io
+import time
+import base64
+import random
+import asyncio
+import threading
+from typing import Awaitable, Callable, Optional, TypeVar
+import openai
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# -----------------------------------------------------------------------------
+# 14. LIMITADOR DE RITMO (Token Bucket adaptativo)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es el "semáforo de la autopista". Antes de cada llamada al LLM comprueba que nos
+# queda presupuesto de peticiones por minuto (RPM) y de tokens por minuto (TPM).
+# Si no, espera lo justo en lugar de lanzar la petición y comerse un 429.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Dos cubos: OpenAI limita RPM y TPM a la vez. Una imagen grande consume miles
+#    de tokens, así que contar solo peticiones no basta. Estimamos los tokens de
+#    cada imagen a partir de su resolución (misma fórmula de "tiles" que la API).
+# 2. Adaptativo: Cada respuesta trae cabeceras `x-ratelimit-remaining-*`. Si la API
+#    dice que queda menos de lo que creíamos (otro proceso comparte la key), nos
+#    ajustamos. Un 429 con `retry-after` pausa a TODOS los workers, no solo a uno.
+# 3. Backoff con jitter: Tras un error, esperamos un tiempo exponencial aleatorio
+#    ("full jitter"). Así N workers no reintentan todos en el mismo milisegundo.
+# 4. Sin reintentos en cascada: El SDK de OpenAI y instructor reintentan por su
+#    cuenta. Con el limitador activo, el SDK no reintenta (max_retries=0) e
+#    instructor solo reintenta errores de VALIDACIÓN; los de red/cuota, aquí.
+# 5. Observabilidad: `metrics()` expone presupuesto restante y tiempo en cola.
+# -----------------------------------------------------------------------------
+
+T = TypeVar("T")
+
+# Errores que merece la pena reintentar (cuota, red, caídas temporales del servidor)
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+# Tokens que reservamos para la respuesta (una Factura en JSON ronda 300-1000)
+COMPLETION_TOKENS_ESTIMATE = 800
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Tokens de visión de una imagen según la regla de OpenAI:
+    encajar en 2048x2048, reducir el lado corto a 768 y contar tiles de 512 px.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
+
+def _image_tokens_from_url(url: str) -> int:
+    """Estima los tokens de una imagen en data URL leyendo solo su cabecera."""
+    if Image is None or not url.startswith("data:"):
+        return estimate_image_tokens(2048, 2048)
+    try:
+        data = base64.b64decode(url.split(",", 1)[1])
+        with Image.open(io.BytesIO(data)) as img:
+            return estimate_image_tokens(*img.size)
+    except Exception:
+        return estimate_image_tokens(2048, 2048)
+
+def estimate_request_tokens(messages: list, completion_tokens: int = COMPLETION_TOKENS_ESTIMATE) -> int:
+    """Estimación (por exceso) de los tokens que consumirá una petición."""
+    tokens = completion_tokens
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4 + 4
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // 4 + 4
+            elif part.get("type") == "image_url":
+                tokens += _image_tokens_from_url(part["image_url"]["url"])
+    return tokens
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Convierte '6m0s', '1.5s' o '20ms' (formato de las cabeceras) a segundos."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_RE.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+class TokenBucket:
+    """Cubo que se rellena a ritmo constante hasta `capacity` (no es thread-safe)."""
+
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Segundos hasta poder sacar `amount` (0 si ya hay)."""
+        missing = amount - self.level
+        return max(0.0, missing / self.rate) if self.rate else 0.0
+
+class RateLimiter:
+    """
+    Limitador compartido por todos los hilos/tareas que llaman a la API.
+
+    Cada petición "reserva" su coste aunque tenga que esperar (el cubo puede
+    quedar en negativo): así las peticiones se atienden en orden de llegada y
+    ninguna se cuela por delante de otra que ya estaba esperando.
+    """
+
+    def __init__(self, requests_per_minute: int = 500, tokens_per_minute: int = 30_000,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+        # Métricas
+        self._waiting = 0
+        self._acquired = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._rate_limited = 0
+        self._retries = 0
+
+    # --- Reserva de presupuesto -------------------------------------------------
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            # Una petición más grande que el cubo entero nunca cabría: la capamos
+            tokens = min(tokens, self.tokens.capacity)
+            wait = max(
+                self.requests.wait_for(1),
+                self.tokens.wait_for(tokens),
+                self._paused_until - now,
+            )
+            self.requests.level -= 1
+            self.tokens.level -= tokens
+            self._acquired += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            return wait
+
+    def acquire(self, tokens: int):
+        """Bloquea el hilo hasta que haya presupuesto para la petición."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            self._waiting += 1
+            try:
+                time.sleep(wait)
+            finally:
+                self._waiting -= 1
+
+    async def acquire_async(self, tokens: int):
+        """Igual que `acquire`, pero sin bloquear el event loop."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            self._waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._waiting -= 1
+
+    # --- Información de la API --------------------------------------------------
+
+    def update_from_headers(self, headers):
+        """Ajusta los cubos con las cabeceras x-ratelimit-* y retry-after."""
+        with self._lock:
+            now = time.monotonic()
+            for bucket, suffix in ((self.requests, "requests"), (self.tokens, "tokens")):
+                remaining = headers.get(f"x-ratelimit-remaining-{suffix}")
+                if remaining is None:
+                    continue
+                bucket.refill(now)
+                # Solo bajamos: si la API ve menos presupuesto, otro proceso lo está usando
+                bucket.level = min(bucket.level, float(remaining))
+
+            retry_after = parse_duration(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000 if retry_after is not None else parse_duration(headers.get("retry-after"))
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+    def observe_response(self, response):
+        """Event hook de httpx (cliente síncrono): lee las cabeceras de cada respuesta."""
+        self.update_from_headers(response.headers)
+
+    async def observe_response_async(self, response):
+        """Event hook de httpx (cliente asíncrono)."""
+        self.update_from_headers(response.headers)
+
+    def backoff_delay(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """Espera antes del reintento `attempt`: backoff exponencial con full jitter."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        response = getattr(error, "response", None)
+        if response is not None:
+            self.update_from_headers(response.headers)
+            retry_after = parse_duration(response.headers.get("retry-after"))
+            if retry_after:
+                delay = max(delay, retry_after)
+        return delay
+
+    # --- Ejecución con reintentos -------------------------------------------------
+
+    def call(self, fn: Callable[[], T], tokens: int,
+             on_retry: Optional[Callable[[Exception, int], None]] = None) -> T:
+        """
+        Ejecuta `fn` respetando el presupuesto y reintentando errores temporales.
+        `on_retry(error, intento)` se llama antes de cada reintento (métricas).
+        """
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                return fn()
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                if on_retry is not None:
+                    on_retry(e, attempt)
+                delay = self._on_retry(e, attempt)
+                time.sleep(delay)
+
+    async def call_async(self, fn: Callable[[], Awaitable[T]], tokens: int,
+                         on_retry: Optional[Callable[[Exception, int], None]] = None) -> T:
+        """Versión asíncrona de `call`."""
+        attempt = 0
+        while True:
+            await self.acquire_async(tokens)
+            try:
+                return await fn()
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                if on_retry is not None:
+                    on_retry(e, attempt)
+                delay = self._on_retry(e, attempt)
+                await asyncio.sleep(delay)
+
+    def _on_retry(self, error: Exception, attempt: int) -> float:
+        self._retries += 1
+        if isinstance(error, openai.RateLimitError):
+            self._rate_limited += 1
+        delay = self.backoff_delay(attempt, error)
+        print(f"⏳ {type(error).__name__}: reintento {attempt}/{self.max_retries} en {delay:.1f}s")
+        return delay
+
+    def metrics(self) -> dict:
+        """Presupuesto actual y tiempos de espera en cola."""
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return {
+                "requests_available": max(0.0, self.requests.level),
+                "tokens_available": max(0.0, self.tokens.level),
+                "waiting": self._waiting,
+                "acquired": self._acquired,
+                "avg_wait_s": self._total_wait / self._acquired if self._acquired else 0.0,
+                "max_wait_s": self._max_wait,
+                "rate_limited": self._rate_limited,
+                "retries": self._retries,
+                "paused_for_s": max(0.0, self._paused_until - now),
+            }
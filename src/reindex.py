@@ -0,0 +1,148 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import FrozenSet, Iterator, List, Tuple
+from sqlalchemy import bindparam, delete, insert, select, update
+from sqlalchemy.engine import Engine
+from .extraction_archive import decode_factura
+from .storage import DBExtractionArchive, DBFactura, DBItemFactura, InvoiceRow, _header_values, _item_values
+from .validator import DEFAULT_ENGINE
+
+# -----------------------------------------------------------------------------
+# 26. REINDEXADO (Reconstruir facturas e invoice_items desde el archivo)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Vuelve a derivar las columnas de `facturas` y las filas de `invoice_items` a
+# partir del JSON archivado de cada extracción (src/extraction_archive.py). Sirve
+# para rellenar una columna nueva o reparar la tabla sin volver a pagar al LLM.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. En paralelo: Descomprimir y validar con Pydantic es CPU pura. Lo hacen N
+#    procesos (no hilos: el GIL los pondría en fila) sobre bloques de entradas.
+# 2. A la velocidad del disco: El proceso principal solo lee bloques del archivo
+#    y escribe los resultados con executemany, una transacción por bloque, mientras
+#    los procesos hijos ya están con los bloques siguientes.
+# 3. Respeta lo que no es derivable: Estado, notas y `duplicate_of` de las facturas
+#    existentes no se tocan (los cambian `revalidate` y los revisores); los id
+#    tampoco, así que métricas y punteros de duplicado siguen apuntando bien. Una
+#    factura que falta en `facturas` se inserta validada con las reglas actuales.
+# 4. Manda lo último: Si un documento tiene varias entradas (extracción y luego
+#    corrección en el dashboard), se procesan en orden y gana la más reciente.
+# -----------------------------------------------------------------------------
+
+# Columnas de `facturas` que salen del JSON archivado (el resto no se reescribe)
+_NO_DERIVADAS = {"document_id", "status", "validation_notes", "duplicate_of"}
+
+@dataclass
+class ReindexReport:
+    """Resultado de `ArchiveReindexer.run`."""
+    entries: int = 0      # Entradas del archivo leídas
+    updated: int = 0      # Facturas existentes reescritas
+    inserted: int = 0     # Facturas que faltaban en `facturas`
+    items: int = 0        # Líneas escritas en `invoice_items`
+    seconds: float = 0.0
+
+def _derive_chunk(rows: List[Tuple[str, str, bytes]], missing: FrozenSet[str]) -> List[Tuple[dict, List[dict]]]:
+    """En un proceso hijo: (cabecera, líneas) de cada documento del bloque, la entrada más reciente."""
+    derived = {}
+    for document_id, codec, payload in rows:
+        factura = decode_factura(payload, codec)
+        # Solo se valida lo que hay que insertar: las existentes conservan su estado
+        result = DEFAULT_ENGINE.validate(factura) if document_id in missing else None
+        derived[document_id] = (
+            _header_values(InvoiceRow(document_id, factura, result and result.status, result and result.notes)),
+            _item_values(0, factura),
+        )
+    return list(derived.values())
+
+class ArchiveReindexer:
+    """Reconstruye `facturas` e `invoice_items` desde `extraction_archive`, por bloques y en paralelo."""
+
+    def __init__(self, engine: Engine, workers: int = 0, chunk_size: int = 10_000):
+        self.engine = engine
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def _chunks(self) -> Iterator[List[Tuple[str, str, bytes]]]:
+        """Bloques del archivo en orden de id (paginación por clave primaria)."""
+        archive = DBExtractionArchive.__table__
+        query = (
+            select(archive.c.id, archive.c.document_id, archive.c.codec, archive.c.payload)
+            .order_by(archive.c.id)
+            .limit(self.chunk_size)
+        )
+        last_id = 0
+        while True:
+            with self.engine.connect() as conn:
+                rows = conn.execute(query.where(archive.c.id > last_id)).all()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            yield [(row.document_id, row.codec, row.payload) for row in rows]
+
+    def _missing(self, rows: List[Tuple[str, str, bytes]]) -> FrozenSet[str]:
+        """document_id del bloque que no están en `facturas`."""
+        facturas = DBFactura.__table__
+        document_ids = {document_id for document_id, _, _ in rows}
+        with self.engine.connect() as conn:
+            found = conn.execute(select(facturas.c.document_id).where(facturas.c.document_id.in_(document_ids)))
+            return frozenset(document_ids - set(found.scalars()))
+
+    def _write(self, derived: List[Tuple[dict, List[dict]]], report: ReindexReport):
+        """Una transacción por bloque: UPDATE de las existentes, INSERT de las que faltan y sus líneas."""
+        facturas, items_table = DBFactura.__table__, DBItemFactura.__table__
+        columns = [name for name in derived[0][0] if name not in _NO_DERIVADAS]
+        write = (
+            update(facturas)
+            .where(facturas.c.id == bindparam("b_id"))
+            .values({name: bindparam(f"b_{name}") for name in columns})
+        )
+        with self.engine.begin() as conn:
+            ids = dict(conn.execute(
+                select(facturas.c.document_id, facturas.c.id)
+                .where(facturas.c.document_id.in_([header["document_id"] for header, _ in derived]))
+            ).all())
+            existing = [(header, items) for header, items in derived if header["document_id"] in ids]
+            missing = [(header, items) for header, items in derived if header["document_id"] not in ids]
+            if existing:
+                conn.execute(write, [{"b_id": ids[header["document_id"]], **{f"b_{name}": header[name] for name in columns}}
+                                     for header, _ in existing])
+            if missing:
+                new_ids = conn.execute(
+                    insert(facturas).returning(facturas.c.id, sort_by_parameter_order=True),
+                    [header for header, _ in missing],
+                ).scalars().all()
+                ids.update(zip((header["document_id"] for header, _ in missing), new_ids))
+            # También con los id nuevos: SQLite reutiliza los de filas borradas y pueden quedar líneas huérfanas
+            conn.execute(delete(items_table).where(items_table.c.factura_id.in_(list(ids.values()))))
+            items = [{**item, "factura_id": ids[header["document_id"]]}
+                     for header, lines in derived for item in lines]
+            if items:
+                conn.execute(insert(items_table), items)
+        report.updated += len(existing)
+        report.inserted += len(missing)
+        report.items += len(items)
+
+    def run(self) -> ReindexReport:
+        report = ReindexReport()
+        started = time.perf_counter()
+        if self.workers == 1:
+            # Con una sola CPU un proceso hijo solo añade el coste de serializar los bloques
+            for rows in self._chunks():
+                report.entries += len(rows)
+                self._write(_derive_chunk(rows, self._missing(rows)), report)
+        else:
+            # Como mucho 2 bloques por proceso en vuelo: memoria acotada y los hijos nunca esperan
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                in_flight = deque()
+                for rows in self._chunks():
+                    report.entries += len(rows)
+                    in_flight.append(pool.submit(_derive_chunk, rows, self._missing(rows)))
+                    if len(in_flight) >= 2 * self.workers:
+                        self._write(in_flight.popleft().result(), report)
+                while in_flight:
+                    self._write(in_flight.popleft().result(), report)
+        report.seconds = time.perf_counter() - started
+        return report
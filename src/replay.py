@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+import httpx
+
+# -----------------------------------------------------------------------------
+# 18. GRABAR Y REPRODUCIR (Backend de extracción sin red)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es una "grabadora" de conversaciones con la API. En modo `record` cada respuesta
+# de chat completions se guarda en un archivo JSONL (la "cassette") junto a la
+# huella de su petición. En modo `replay` las respuestas salen de la cassette, sin
+# red y sin API key, con la latencia y la tasa de errores que queramos simular.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Benchmarks en CI y entornos aislados: `process_folder` y el watcher se pueden
+#    medir de punta a punta (ingesta, preprocesado, limitador, validación, DB) sin
+#    depender de OpenAI. Mismos documentos + misma cassette = misma carga.
+# 2. Se enchufa en el transporte HTTP (httpx): el SDK de OpenAI, instructor, los
+#    reintentos y las métricas funcionan EXACTAMENTE igual que en producción. Solo
+#    cambia de dónde salen los bytes de la respuesta.
+# 3. Huella estable: La clave es el SHA-256 del cuerpo JSON de la petición con las
+#    claves ordenadas (modelo, mensajes con las imágenes en base64, tools). Si el
+#    preprocesado o el prompt cambian, la petición cambia y hay que volver a grabar.
+# 4. Streaming: Las respuestas con `stream=True` se graban como la lista de chunks
+#    (solo si el consumidor las leyó enteras) y se reproducen como Server-Sent Events.
+# 5. Fallos controlados: `error_rate` devuelve HTTP 500 para ejercitar reintentos.
+#    Una petición que no está en la cassette da 404, o una factura sintética si se
+#    pide `miss="synthetic"` (útil para cargas grandes con pocos documentos grabados).
+#
+# También se puede servir una cassette por HTTP con el servidor local:
+#   python -m src.local_api_server --replay data/cassette.jsonl --latency 0.8
+# -----------------------------------------------------------------------------
+
+BACKENDS = ("openai", "record", "replay")
+CHAT_PATH = "/chat/completions"
+
+def request_key(body: bytes) -> str:
+    """Huella de una petición de chat completions (independiente del orden de claves)."""
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        canonical = body.decode("utf-8", errors="replace")
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def _is_chat(request: httpx.Request) -> bool:
+    return request.method == "POST" and request.url.path.endswith(CHAT_PATH)
+
+def _is_stream(response: httpx.Response) -> bool:
+    return response.headers.get("content-type", "").startswith("text/event-stream")
+
+def parse_sse(raw: bytes) -> List[dict]:
+    """Chunks JSON de un cuerpo `text/event-stream` (sin el `[DONE]` final)."""
+    chunks = []
+    for line in raw.decode("utf-8").splitlines():
+        if line.startswith("data: ") and line != "data: [DONE]":
+            chunks.append(json.loads(line[len("data: "):]))
+    return chunks
+
+def sse_body(chunks: List[dict]) -> bytes:
+    """Cuerpo `text/event-stream` con los chunks y el `[DONE]` final."""
+    return "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks).encode("utf-8") + b"data: [DONE]\n\n"
+
+# Respuesta grabada: el cuerpo JSON, o la lista de chunks si fue en streaming
+Recorded = Union[dict, List[dict]]
+
+class Cassette:
+    """Pares petición → respuesta guardados en un JSONL append-only."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._responses: Dict[str, Recorded] = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._responses[entry["key"]] = entry["response"]
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+    def get(self, key: str) -> Optional[Recorded]:
+        return self._responses.get(key)
+
+    def record(self, key: str, response: Recorded):
+        with self._lock:
+            if key in self._responses:
+                return
+            self._responses[key] = response
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "response": response}, ensure_ascii=False) + "\n")
+
+# --- Grabación -----------------------------------------------------------------
+
+class _TeeStream(httpx.SyncByteStream):
+    """Deja pasar un stream de respuesta y avisa con los bytes completos al terminar."""
+
+    def __init__(self, stream: httpx.SyncByteStream, on_complete: Callable[[bytes], None]):
+        self.stream = stream
+        self.on_complete = on_complete
+
+    def __iter__(self):
+        parts = []
+        for part in self.stream:
+            parts.append(part)
+            yield part
+        self.on_complete(b"".join(parts))  # Si el consumidor corta antes, no se graba
+
+    def close(self):
+        self.stream.close()
+
+class _AsyncTeeStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, on_complete: Callable[[bytes], None]):
+        self.stream = stream
+        self.on_complete = on_complete
+
+    async def __aiter__(self):
+        parts = []
+        async for part in self.stream:
+            parts.append(part)
+            yield part
+        self.on_complete(b"".join(parts))
+
+    async def aclose(self):
+        await self.stream.aclose()
+
+class RecordingTransport(httpx.BaseTransport):
+    """Transporte real que además graba las respuestas 200 de chat completions."""
+
+    def __init__(self, cassette: Cassette, inner: Optional[httpx.BaseTransport] = None):
+        self.cassette = cassette
+        self.inner = inner or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self.inner.handle_request(request)
+        if not _is_chat(request) or response.status_code != 200:
+            return response
+        key = request_key(request.content)
+        if _is_stream(response):
+            tee = _TeeStream(response.stream, lambda raw: self.cassette.record(key, parse_sse(raw)))
+            return httpx.Response(200, headers=response.headers, stream=tee, extensions=response.extensions)
+        response.read()
+        self.cassette.record(key, response.json())
+        return response
+
+    def close(self):
+        self.inner.close()
+
+class AsyncRecordingTransport(httpx.AsyncBaseTransport):
+    """Versión asíncrona de `RecordingTransport`."""
+
+    def __init__(self, cassette: Cassette, inner: Optional[httpx.AsyncBaseTransport] = None):
+        self.cassette = cassette
+        self.inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.inner.handle_async_request(request)
+        if not _is_chat(request) or response.status_code != 200:
+            return response
+        key = request_key(request.content)
+        if _is_stream(response):
+            tee = _AsyncTeeStream(response.stream, lambda raw: self.cassette.record(key, parse_sse(raw)))
+            return httpx.Response(200, headers=response.headers, stream=tee, extensions=response.extensions)
+        await response.aread()
+        self.cassette.record(key, response.json())
+        return response
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+# --- Reproducción --------------------------------------------------------------
+
+class ReplayResponder:
+    """Decide la respuesta simulada de una petición (compartido por sync y async)."""
+
+    def __init__(self, cassette: Cassette, latency: float = 0.0, error_rate: float = 0.0,
+                 miss: str = "error"):
+        if miss not in ("error", "synthetic"):
+            raise ValueError("miss debe ser 'error' o 'synthetic'")
+        self.cassette = cassette
+        self.latency = latency
+        self.error_rate = error_rate
+        self.miss = miss
+        self.hits = 0
+        self.misses = 0
+
+    def respond(self, request: dict, key: str) -> Tuple[int, Recorded]:
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, {"error": {"message": "Error simulado (replay)", "type": "server_error"}}
+        recorded = self.cassette.get(key)
+        if recorded is not None:
+            self.hits += 1
+            return 200, recorded
+        self.misses += 1
+        if self.miss == "synthetic":
+            # Import tardío: el servidor local solo hace falta para este caso
+            from .local_api_server import chat_completion_body, stream_chunks, synthetic_response
+            seed = json.dumps(request.get("messages", []), sort_keys=True)
+            body = chat_completion_body(request, synthetic_response(request, seed))
+            return 200, stream_chunks(body) if request.get("stream") else body
+        return 404, {"error": {"message": f"Petición no grabada en {self.cassette.path} ({key[:12]})",
+                               "type": "invalid_request_error"}}
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if not _is_chat(request):
+            return httpx.Response(404, json={"error": {"message": f"Ruta no soportada en replay: {request.url.path}"}})
+        status, payload = self.respond(json.loads(request.content), request_key(request.content))
+        if status == 200 and isinstance(payload, list):
+            return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, content=sse_body(payload))
+        return httpx.Response(status, json=payload)
+
+class ReplayTransport(httpx.BaseTransport):
+    """Sirve respuestas grabadas sin red, con latencia y errores simulados."""
+
+    def __init__(self, responder: ReplayResponder):
+        self.responder = responder
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if self.responder.latency:
+            time.sleep(self.responder.latency)
+        return self.responder.handle(request)
+
+class AsyncReplayTransport(httpx.AsyncBaseTransport):
+    """Versión asíncrona: la latencia se simula sin bloquear el event loop."""
+
+    def __init__(self, responder: ReplayResponder):
+        self.responder = responder
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.responder.latency:
+            await asyncio.sleep(self.responder.latency)
+        return self.responder.handle(request)
+
+class ExtractionBackend:
+    """
+    Configuración del backend de extracción: de dónde salen las respuestas del LLM.
+
+    - openai: la API real (o la que indique OPENAI_BASE_URL).
+    - record: la API real, grabando cada respuesta en la cassette.
+    - replay: la cassette, sin red ni API key.
+    """
+
+    def __init__(self, kind: str = "openai", cassette_path: str = "data/cassette.jsonl",
+                 latency: float = 0.0, error_rate: float = 0.0, miss: str = "error"):
+        if kind not in BACKENDS:
+            raise ValueError(f"Backend desconocido: {kind} (opciones: {', '.join(BACKENDS)})")
+        self.kind = kind
+        self.cassette = Cassette(cassette_path) if kind != "openai" else None
+        self.responder = ReplayResponder(self.cassette, latency, error_rate, miss) if kind == "replay" else None
+
+    @classmethod
+    def from_env(cls) -> "ExtractionBackend":
+        """Lee EXTRACTOR_BACKEND, EXTRACTOR_CASSETTE y REPLAY_* (para el watcher)."""
+        return cls(
+            kind=os.getenv("EXTRACTOR_BACKEND", "openai"),
+            cassette_path=os.getenv("EXTRACTOR_CASSETTE", "data/cassette.jsonl"),
+            latency=float(os.getenv("REPLAY_LATENCY", 0.0)),
+            error_rate=float(os.getenv("REPLAY_ERROR_RATE", 0.0)),
+            miss=os.getenv("REPLAY_MISS", "error"),
+        )
+
+    @property
+    def needs_api_key(self) -> bool:
+        return self.kind != "replay"
+
+    def transport(self, limits: Optional[httpx.Limits] = None) -> Optional[httpx.BaseTransport]:
+        """Transporte síncrono (None = el transporte por defecto de httpx)."""
+        if self.kind == "record":
+            return RecordingTransport(self.cassette, httpx.HTTPTransport(limits=limits) if limits else None)
+        if self.kind == "replay":
+            return ReplayTransport(self.responder)
+        return httpx.HTTPTransport(limits=limits) if limits else None
+
+    def async_transport(self) -> Optional[httpx.AsyncBaseTransport]:
+        """Transporte asíncrono (None = el transporte por defecto de httpx)."""
+        if self.kind == "record":
+            return AsyncRecordingTransport(self.cassette)
+        if self.kind == "replay":
+            return AsyncReplayTransport(self.responder)
+        return None
+
+    def describe(self) -> str:
+        if self.kind == "openai":
+            return "API de OpenAI"
+        if self.kind == "record":
+            return f"API de OpenAI, grabando en {self.cassette.path} ({len(self.cassette)} respuestas)"
+        return (f"replay de {self.cassette.path} ({len(self.cassette)} respuestas, "
+                f"latencia {self.responder.latency}s, errores {self.responder.error_rate:.0%})")
@@ -0,0 +1,107 @@
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+# -----------------------------------------------------------------------------
+# 7. ÍNDICE DE DOCUMENTOS YA PROCESADOS (Skip-Index)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la "lista de invitados" del sistema. Guarda el ID (hash del contenido) de
+# cada documento que ya se ha procesado con éxito, para no volver a mandarlo al LLM.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Coste: Cada llamada a GPT-4o cuesta dinero y varios segundos. Comprobar si un
+#    hash está en un `set` de Python cuesta microsegundos.
+# 2. Antes, no después: La restricción UNIQUE de la tabla `facturas` solo salta al
+#    guardar, es decir, DESPUÉS de haber pagado la extracción.
+# 3. Persistente: Se guarda en un SQLite propio (data/seen_index.db), así que sobrevive
+#    a reinicios y lo comparten el CLI y el watcher. Lo que no está en el `set` se
+#    busca en la tabla: lo añadido por otro proceso después de arrancar también cuenta.
+# -----------------------------------------------------------------------------
+
+class SeenIndex:
+    """Conjunto persistente de IDs de documento ya procesados."""
+
+    def __init__(self, db_path: str = "data/seen_index.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._init_db()
+
+        # Cargamos todos los IDs en memoria: la consulta es un lookup en un set.
+        self._seen = self._load_ids()
+
+    def _init_db(self):
+        """Crea la tabla del índice si no existe."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS seen_documents (
+                    document_id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    seen_at TIMESTAMP
+                )
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _load_ids(self) -> set:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return {row[0] for row in conn.execute("SELECT document_id FROM seen_documents")}
+        finally:
+            conn.close()
+
+    def __contains__(self, document_id: str) -> bool:
+        if document_id in self._seen:
+            return True
+        # Fallo en memoria: puede haberlo añadido otro proceso (CLI, batch-collect u otro
+        # watcher) después de cargar el set. Se consulta por la clave primaria.
+        conn = sqlite3.connect(self.db_path)
+        try:
+            found = conn.execute("SELECT 1 FROM seen_documents WHERE document_id = ?", (document_id,)).fetchone()
+        finally:
+            conn.close()
+        if found:
+            with self._lock:
+                self._seen.add(document_id)  # Solo los positivos: un "no" puede dejar de serlo
+        return found is not None
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def add(self, document_id: str, filename: str = None):
+        """Marca un documento como procesado (memoria + disco)."""
+        with self._lock:
+            if document_id in self._seen:
+                return
+            conn = sqlite3.connect(self.db_path)
+            try:
+                conn.execute(
+                    "INSERT OR IGNORE INTO seen_documents (document_id, filename, seen_at) VALUES (?, ?, ?)",
+                    (document_id, filename, datetime.now())
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            self._seen.add(document_id)
+
+    def add_many(self, documents):
+        """Marca varios (document_id, filename) como procesados con un solo commit."""
+        with self._lock:
+            new = [(document_id, filename, datetime.now()) for document_id, filename in documents
+                   if document_id not in self._seen]
+            if not new:
+                return
+            conn = sqlite3.connect(self.db_path)
+            try:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO seen_documents (document_id, filename, seen_at) VALUES (?, ?, ?)", new
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            self._seen.update(document_id for document_id, _, _ in new)
@@ -1,10 +1,21 @@
 import os
-import csv
-from datetime import datetime
-from sqlalchemy import create_engine, Column, String, Float, Date, Integer, ForeignKey, Text
+import time
+import threading
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import create_engine, event, func, insert, select, text, Column, String, Float, Date, DateTime, Integer, ForeignKey, Index, LargeBinary, Text
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
 from sqlalchemy.exc import IntegrityError
 from .models import Factura
+from .extraction_metrics import ExtractionMetrics
+from .migrations import migrate
+from .extraction_archive import ARCHIVE_CODEC, encode_factura
+from .duplicates import (
+    DuplicateMatch, TOLERANCIA_DUPLICADO, flag_duplicate, normalise_cif, normalise_numero, normalise_proveedor,
+)
 
 # -----------------------------------------------------------------------------
 # 5. PERSISTENCIA (SQLAlchemy)
@@ -18,10 +29,71 @@ from .models import Factura
 #    El código NO cambia.
 # 2. Seguridad (SQL Injection): Al usar ORM, estás protegido automáticamente
 #    contra ataques de inyección SQL.
-# 3. Migraciones: En un proyecto real, usaríamos 'Alembic' junto con estos modelos
-#    para gestionar cambios en la estructura de la tabla sin borrar datos.
+# 3. Migraciones: Los cambios de estructura (columnas, índices) se aplican al
+#    archivo existente sin borrar datos, una vez y en orden (src/migrations.py).
+# 4. Guardado en lote: `save_invoice` hace un commit (un fsync) por factura.
+#    `save_invoices` agrupa cientos de facturas en una transacción con INSERTs en
+#    lote (executemany). Benchmark: python -m src.storage --bench 1000
+# 5. Lectores y escritores a la vez: El watcher escribe mientras el dashboard lee.
+#    Con el journal clásico de SQLite una lectura larga bloquea las escrituras
+#    ("database is locked"). En modo WAL los lectores no bloquean al escritor ni al
+#    revés. Los PRAGMA se aplican a CADA conexión nueva (evento `connect`) y el
+#    engine es uno por proceso (`get_engine`). Prueba: python -m src.storage --stress 10
 # -----------------------------------------------------------------------------
 
+DEFAULT_DB_URL = "sqlite:///data/facturas.db"
+
+# PRAGMA de cada conexión SQLite (ver https://www.sqlite.org/pragma.html)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",      # Lectores y escritor concurrentes (se guarda en el archivo)
+    "synchronous": "NORMAL",    # En WAL es seguro ante caídas del proceso; fsync solo en checkpoints
+    "busy_timeout": 10_000,     # ms esperando un bloqueo antes de "database is locked"
+    "cache_size": -64_000,      # Negativo = KiB: 64 MB de caché de páginas por conexión
+    "mmap_size": 268_435_456,   # 256 MB leídos por memory-map (menos copias en lecturas grandes)
+    "temp_store": "MEMORY",     # Ordenaciones y tablas temporales en memoria
+}
+
+_engines: Dict[Tuple, Engine] = {}
+_engines_lock = threading.Lock()
+
+def _sqlite_file_url(db_path: str) -> str:
+    """URL de SQLite con ruta absoluta (relativa al CWD), creando el directorio si falta."""
+    file_path = db_path.replace("sqlite:///", "")
+    # Si es ruta relativa, asumimos que es relativa al CWD
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(os.getcwd(), file_path)
+
+    db_dir = os.path.dirname(file_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+        print(f"📁 Directorio creado: {db_dir}")
+    return f"sqlite:///{file_path}"
+
+def get_engine(db_path: str = DEFAULT_DB_URL, pragmas: Optional[dict] = None) -> Engine:
+    """
+    Engine compartido por todo el proceso para `db_path` (CLI, watcher y dashboard).
+
+    En SQLite, cada conexión nueva del pool recibe `pragmas` (por defecto SQLITE_PRAGMAS).
+    """
+    is_sqlite = db_path.startswith("sqlite:///")
+    if is_sqlite:
+        db_path = _sqlite_file_url(db_path)
+    pragmas = dict(SQLITE_PRAGMAS if pragmas is None else pragmas)
+    key = (db_path, tuple(sorted(pragmas.items())))
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = create_engine(db_path)
+            if is_sqlite and pragmas:
+                @event.listens_for(engine, "connect")
+                def _apply_pragmas(dbapi_connection, connection_record):
+                    cursor = dbapi_connection.cursor()
+                    for name, value in pragmas.items():
+                        cursor.execute(f"PRAGMA {name}={value}")
+                    cursor.close()
+            _engines[key] = engine
+    return engine
+
 Base = declarative_base()
 
 # Definición de Tablas SQL (Espejo de nuestros modelos Pydantic pero para DB)
@@ -31,21 +103,44 @@ class DBFactura(Base):
     id = Column(Integer, primary_key=True)
     document_id = Column(String, unique=True) # Enlace con el archivo original
     numero_factura = Column(String, nullable=True)
-    fecha_emision = Column(Date, nullable=True)
+    fecha_emision = Column(Date, nullable=True, index=True) # Consultas y revalidación por rango de fechas
     nombre_proveedor = Column(String)
     cif_proveedor = Column(String, nullable=True)
+    nombre_cliente = Column(String, nullable=True)
+    base_imponible = Column(Float, nullable=True) # NULL en filas anteriores a esta columna
+    total_impuestos = Column(Float, nullable=True)
     total_factura = Column(Float)
+    moneda = Column(String, nullable=True) # NULL en filas anteriores a esta columna (eran EUR)
     status = Column(String) # OK, REVIEW, ERROR
     validation_notes = Column(Text, nullable=True) # Errores o warnings
     created_at = Column(Date, default=datetime.now)
+    # Último INSERT/UPDATE de la fila (revisores, revalidate, reindex): de aquí lee la exportación incremental
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=True)
+    # Claves normalizadas para detectar la misma factura en otro archivo (src/duplicates.py)
+    cif_norm = Column(String, nullable=True)
+    numero_norm = Column(String, nullable=True)
+    proveedor_norm = Column(String, nullable=True) # NULL = fila anterior a la detección (se rellena al arrancar)
+    duplicate_of = Column(Integer, ForeignKey('facturas.id'), nullable=True) # Factura original si es un posible duplicado
+
+    __table_args__ = (
+        # Búsquedas de duplicados en O(log n): igualdad en el prefijo, rango en el total
+        Index("ix_facturas_clave_fiscal", "cif_norm", "numero_norm"),
+        Index("ix_facturas_proveedor_fecha_total", "proveedor_norm", "fecha_emision", "total_factura"),
+        # Filtros del dashboard: igualdad (estado / proveedor) y rango de fechas en el mismo índice
+        Index("ix_facturas_status_fecha", "status", "fecha_emision"),
+        Index("ix_facturas_proveedor_fecha", "nombre_proveedor", "fecha_emision"),
+        # Exportación incremental: filas cambiadas desde la marca, en orden (updated_at, id)
+        Index("ix_facturas_updated_at", "updated_at", "id"),
+    )
 
     items = relationship("DBItemFactura", back_populates="factura")
+    metrics = relationship("DBExtractionMetrics", back_populates="factura", uselist=False)
 
 class DBItemFactura(Base):
     __tablename__ = 'invoice_items'
     
     id = Column(Integer, primary_key=True)
-    factura_id = Column(Integer, ForeignKey('facturas.id'))
+    factura_id = Column(Integer, ForeignKey('facturas.id'), index=True) # Líneas de una factura sin recorrer la tabla
     descripcion = Column(String)
     cantidad = Column(Float)
     precio_unitario = Column(Float)
@@ -53,52 +148,227 @@ class DBItemFactura(Base):
     
     factura = relationship("DBFactura", back_populates="items")
 
-class Storage:
-    def __init__(self, db_path: str = "sqlite:///data/facturas.db"):
-        # Asegurar que el directorio existe
-        if "sqlite:///" in db_path:
-            file_path = db_path.replace("sqlite:///", "")
-            # Si es ruta relativa, asumimos que es relativa al CWD
-            if not os.path.isabs(file_path):
-                file_path = os.path.join(os.getcwd(), file_path)
-            
-            db_dir = os.path.dirname(file_path)
-            if db_dir and not os.path.exists(db_dir):
-                os.makedirs(db_dir, exist_ok=True)
-                print(f"📁 Directorio creado: {db_dir}")
+class DBExtractionMetrics(Base):
+    """Tokens, coste y latencia de la extracción de cada factura (1 a 1 con `facturas`)."""
+    __tablename__ = 'extraction_metrics'
+
+    id = Column(Integer, primary_key=True)
+    factura_id = Column(Integer, ForeignKey('facturas.id'), unique=True)
+    model = Column(String)
+    source = Column(String) # llm, cache, template
+    tier = Column(Integer, default=0) # Posición del modelo en la cascada
+    escalations = Column(Integer, default=0)
+    pages = Column(Integer)
+    calls = Column(Integer)
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    validation_retries = Column(Integer)
+    network_retries = Column(Integer)
+    payload_bytes = Column(Integer)
+    wall_time_s = Column(Float)
+    cost_usd = Column(Float)
+    created_at = Column(DateTime, default=datetime.now)
+
+    factura = relationship("DBFactura", back_populates="metrics")
+
+class DBExtractionArchive(Base):
+    """Factura validada completa de cada extracción, comprimida (src/extraction_archive.py). Solo se añade."""
+    __tablename__ = 'extraction_archive'
+
+    id = Column(Integer, primary_key=True)
+    document_id = Column(String) # Puede repetirse: manda la entrada más reciente
+    model = Column(String, nullable=True)
+    prompt_version = Column(String, nullable=True)
+    source = Column(String) # llm, cache, template, revision
+    codec = Column(String)
+    payload = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.now)
+
+class DBExportWatermark(Base):
+    """Hasta dónde llegó la última exportación incremental de cada destino (src/incremental_export.py)."""
+    __tablename__ = 'export_watermarks'
 
-        self.engine = create_engine(db_path)
-        Base.metadata.create_all(self.engine)
+    name = Column(String, primary_key=True) # Destino de la exportación (ej: contabilidad)
+    updated_at = Column(DateTime, nullable=True) # updated_at de la última factura exportada
+    last_id = Column(Integer, default=0) # Su id: desempata facturas con el mismo updated_at
+    exported_at = Column(DateTime, default=datetime.now)
+
+@dataclass
+class InvoiceRow:
+    """Una factura lista para guardar (lo que recibe `save_invoice`, como objeto)."""
+    document_id: str
+    factura: Factura
+    status: str
+    notes: str
+    metrics: Optional[ExtractionMetrics] = None
+    duplicate: Optional[DuplicateMatch] = None
+
+@dataclass
+class BulkSaveReport:
+    """Resultado de `save_invoices`."""
+    saved: List[str] = field(default_factory=list)                       # document_id guardados
+    conflicts: List[Tuple[str, str]] = field(default_factory=list)       # (document_id, motivo)
+    seconds: float = 0.0
+
+def _header_values(row: InvoiceRow) -> dict:
+    """Columnas de `facturas` para una factura."""
+    factura = row.factura
+    return dict(
+        document_id=row.document_id,
+        numero_factura=factura.numero_factura,
+        fecha_emision=factura.fecha_emision,
+        nombre_proveedor=factura.nombre_proveedor,
+        cif_proveedor=factura.cif_proveedor,
+        nombre_cliente=factura.nombre_cliente,
+        base_imponible=factura.base_imponible,
+        total_impuestos=factura.total_impuestos,
+        total_factura=factura.total_factura,
+        moneda=factura.moneda,
+        status=row.status,
+        validation_notes=row.notes,
+        cif_norm=normalise_cif(factura.cif_proveedor),
+        numero_norm=normalise_numero(factura.numero_factura),
+        proveedor_norm=normalise_proveedor(factura.nombre_proveedor),
+        duplicate_of=row.duplicate.factura_id if row.duplicate else None,
+    )
+
+def _item_values(factura_id: int, factura: Factura) -> List[dict]:
+    """Filas de `invoice_items` de una factura."""
+    return [dict(factura_id=factura_id, descripcion=item.descripcion, cantidad=item.cantidad,
+                 precio_unitario=item.precio_unitario, total_linea=item.total_linea)
+            for item in factura.items]
+
+def _archive_values(document_id: str, factura: Factura, metrics: Optional[ExtractionMetrics] = None,
+                    source: Optional[str] = None) -> dict:
+    """Fila de `extraction_archive`: la Factura entera, comprimida, con su modelo y versión de prompt."""
+    return dict(
+        document_id=document_id,
+        model=metrics.model if metrics else None,
+        prompt_version=metrics.prompt_version if metrics else None,
+        source=source or (metrics.source if metrics else None),
+        codec=ARCHIVE_CODEC,
+        payload=encode_factura(factura),
+    )
+
+def _metrics_values(factura_id: int, metrics: ExtractionMetrics) -> dict:
+    """Fila de `extraction_metrics` de una factura."""
+    return dict(
+        factura_id=factura_id,
+        model=metrics.model,
+        source=metrics.source,
+        tier=metrics.tier,
+        escalations=metrics.escalations,
+        pages=metrics.pages,
+        calls=metrics.calls,
+        prompt_tokens=metrics.prompt_tokens,
+        completion_tokens=metrics.completion_tokens,
+        validation_retries=metrics.validation_retries,
+        network_retries=metrics.network_retries,
+        payload_bytes=metrics.payload_bytes,
+        wall_time_s=metrics.wall_time_s,
+        cost_usd=metrics.cost_usd,
+    )
+
+def invoice_filter_query(desde: Optional[date] = None, hasta: Optional[date] = None,
+                         estados: Optional[Iterable[str]] = None,
+                         proveedores: Optional[Iterable[str]] = None) -> Select:
+    """Facturas del dashboard con los filtros resueltos en la DB (None = sin filtrar por ese campo)."""
+    query = select(DBFactura.__table__)
+    if estados is not None:
+        query = query.where(DBFactura.status.in_(list(estados)))
+    if proveedores is not None:
+        query = query.where(DBFactura.nombre_proveedor.in_(list(proveedores)))
+    if desde is not None:
+        query = query.where(DBFactura.fecha_emision >= desde)
+    if hasta is not None:
+        query = query.where(DBFactura.fecha_emision <= hasta)
+    return query
+
+def filter_options_queries() -> Dict[str, Select]:
+    """Consultas de los valores posibles de cada filtro del dashboard (todas resueltas con un índice)."""
+    return {
+        # MIN y MAX por separado: SQLite solo lee un extremo del índice si hay un único agregado
+        "fechas": select(select(func.min(DBFactura.fecha_emision)).scalar_subquery(),
+                         select(func.max(DBFactura.fecha_emision)).scalar_subquery()),
+        "estados": select(DBFactura.status).where(DBFactura.status.is_not(None)).distinct().order_by(DBFactura.status),
+        "proveedores": (select(DBFactura.nombre_proveedor).where(DBFactura.nombre_proveedor.is_not(None))
+                        .distinct().order_by(DBFactura.nombre_proveedor)),
+    }
+
+def filter_options(engine: Engine) -> dict:
+    """Rango de fechas, estados y proveedores presentes en `facturas` (para montar los filtros)."""
+    queries = filter_options_queries()
+    with engine.connect() as conn:
+        desde, hasta = conn.execute(queries["fechas"]).one()
+        return {
+            "desde": desde,
+            "hasta": hasta,
+            "estados": list(conn.execute(queries["estados"]).scalars()),
+            "proveedores": list(conn.execute(queries["proveedores"]).scalars()),
+        }
+
+class Storage:
+    def __init__(self, db_path: str = DEFAULT_DB_URL, pragmas: Optional[dict] = None):
+        # Engine del proceso (WAL y PRAGMA en SQLite); crea el directorio si no existe
+        self.engine = get_engine(db_path, pragmas)
+        # Tablas nuevas y migraciones pendientes del archivo existente (src/migrations.py)
+        migrate(self.engine, Base.metadata)
         self.Session = sessionmaker(bind=self.engine)
 
-    def save_invoice(self, document_id: str, factura: Factura, status: str, notes: str):
-        """Guarda la factura en la base de datos SQL."""
+    @staticmethod
+    def duplicate_queries(factura: Factura) -> List[Tuple[str, Select]]:
+        """Consultas (motivo, SELECT) que buscan una factura ya guardada igual a `factura`, en orden."""
+        cif, numero = normalise_cif(factura.cif_proveedor), normalise_numero(factura.numero_factura)
+        proveedor = normalise_proveedor(factura.nombre_proveedor)
+        queries = []
+        if cif and numero:
+            queries.append(("clave", select(DBFactura.id, DBFactura.document_id)
+                            .where(DBFactura.cif_norm == cif, DBFactura.numero_norm == numero)))
+        if proveedor and factura.fecha_emision is not None:
+            queries.append(("importe", select(DBFactura.id, DBFactura.document_id)
+                            .where(DBFactura.proveedor_norm == proveedor,
+                                   DBFactura.fecha_emision == factura.fecha_emision,
+                                   DBFactura.total_factura.between(factura.total_factura - TOLERANCIA_DUPLICADO,
+                                                                   factura.total_factura + TOLERANCIA_DUPLICADO))))
+        # La original es la más antigua (un duplicado de un duplicado apunta a la primera)
+        return [(reason, query.order_by(DBFactura.id).limit(1)) for reason, query in queries]
+
+    def find_duplicate(self, factura: Factura) -> Optional[DuplicateMatch]:
+        """Busca una factura ya guardada que sea la misma (por clave fiscal o por importe)."""
+        with self.engine.connect() as conn:
+            for reason, query in self.duplicate_queries(factura):
+                row = conn.execute(query).first()
+                if row is not None:
+                    return DuplicateMatch(factura_id=row.id, document_id=row.document_id, reason=reason)
+        return None
+
+    def check_duplicate(self, factura: Factura, status: str, notes: str) -> Tuple[str, str, Optional[DuplicateMatch]]:
+        """Antes de `save_invoice`: si la factura ya está guardada, la pasa a REVIEW apuntando a la original."""
+        duplicate = self.find_duplicate(factura)
+        status, notes = flag_duplicate(status, notes, duplicate.factura_id if duplicate else None)
+        if duplicate:
+            motivo = "mismo CIF y número" if duplicate.reason == "clave" else "mismo proveedor, fecha y total"
+            print(f"🔁 Posible duplicado de la factura #{duplicate.factura_id} ({motivo})")
+        return status, notes, duplicate
+
+    def save_invoice(self, document_id: str, factura: Factura, status: str, notes: str,
+                     metrics: Optional[ExtractionMetrics] = None, duplicate: Optional[DuplicateMatch] = None):
+        """Guarda la factura (y, si las hay, sus métricas de extracción) en la base de datos SQL."""
         session = self.Session()
         try:
             # Crear cabecera
-            db_factura = DBFactura(
-                document_id=document_id,
-                numero_factura=factura.numero_factura,
-                fecha_emision=factura.fecha_emision,
-                nombre_proveedor=factura.nombre_proveedor,
-                cif_proveedor=factura.cif_proveedor,
-                total_factura=factura.total_factura,
-                status=status,
-                validation_notes=notes
-            )
+            db_factura = DBFactura(**_header_values(InvoiceRow(document_id, factura, status, notes, duplicate=duplicate)))
             session.add(db_factura)
             session.flush() # Para obtener el ID autogenerado
 
             # Crear líneas
-            for item in factura.items:
-                db_item = DBItemFactura(
-                    factura_id=db_factura.id,
-                    descripcion=item.descripcion,
-                    cantidad=item.cantidad,
-                    precio_unitario=item.precio_unitario,
-                    total_linea=item.total_linea
-                )
-                session.add(db_item)
+            for values in _item_values(db_factura.id, factura):
+                session.add(DBItemFactura(**values))
+
+            if metrics is not None:
+                session.add(DBExtractionMetrics(**_metrics_values(db_factura.id, metrics)))
+            # En la misma transacción: no hay factura guardada sin su extracción archivada
+            session.add(DBExtractionArchive(**_archive_values(document_id, factura, metrics)))
             
             session.commit()
             print(f"💾 Guardado en DB: {factura.numero_factura} (ID: {db_factura.id})")
@@ -114,34 +384,238 @@ class Storage:
         finally:
             session.close()
 
-    def export_to_csv(self, factura: Factura, filename: str = "output/facturas.csv"):
-        """Añade una línea al CSV maestro de facturas."""
-        # Asegurar directorio de salida
-        out_dir = os.path.dirname(filename)
-        if out_dir and not os.path.exists(out_dir):
-            os.makedirs(out_dir, exist_ok=True)
-
-        file_exists = os.path.isfile(filename)
-        
-        with open(filename, mode='a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            
-            # Escribir cabecera si es archivo nuevo
-            if not file_exists:
-                writer.writerow([
-                    "Fecha Emision", "Numero", "Proveedor", "CIF", 
-                    "Base", "Impuestos", "Total", "Moneda", "Items Count"
-                ])
-            
-            writer.writerow([
-                factura.fecha_emision,
-                factura.numero_factura,
-                factura.nombre_proveedor,
-                factura.cif_proveedor,
-                factura.base_imponible,
-                factura.total_impuestos,
-                factura.total_factura,
-                factura.moneda,
-                len(factura.items)
-            ])
-        print(f"📊 Exportado a CSV: {filename}")
+    def save_invoices(self, rows: Iterable[InvoiceRow], batch_size: int = 500) -> BulkSaveReport:
+        """
+        Guarda muchas facturas con una transacción (un commit) por bloque de `batch_size`.
+
+        Cabeceras, líneas y métricas se insertan con executemany. Una factura que ya
+        existe (mismo `document_id`) se anota en `conflicts` y el resto del bloque se
+        guarda igualmente.
+        """
+        report = BulkSaveReport()
+        started = time.perf_counter()
+        batch: List[InvoiceRow] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self._save_batch(batch, report)
+                batch = []
+        if batch:
+            self._save_batch(batch, report)
+        report.seconds = time.perf_counter() - started
+        return report
+
+    def _save_batch(self, batch: List[InvoiceRow], report: BulkSaveReport):
+        # Conflictos conocidos de antemano: ya en la DB o repetidos dentro del bloque
+        with self.engine.connect() as conn:
+            existing = set(conn.execute(
+                select(DBFactura.document_id).where(DBFactura.document_id.in_([row.document_id for row in batch]))
+            ).scalars())
+        pending, seen = [], set()
+        for row in batch:
+            if row.document_id in existing or row.document_id in seen:
+                report.conflicts.append((row.document_id, "ya existe en la base de datos"))
+                continue
+            seen.add(row.document_id)
+            pending.append(row)
+        if not pending:
+            return
+        try:
+            with self.engine.begin() as conn:
+                self._insert_rows(conn, pending)
+            report.saved.extend(row.document_id for row in pending)
+        except IntegrityError:
+            # Otro proceso guardó alguna a la vez: se repite fila a fila para aislar el conflicto
+            with self.engine.begin() as conn:
+                for row in pending:
+                    try:
+                        with conn.begin_nested():  # SAVEPOINT: un fallo no deshace las demás
+                            self._insert_rows(conn, [row])
+                        report.saved.append(row.document_id)
+                    except IntegrityError as e:
+                        report.conflicts.append((row.document_id, str(e.orig)))
+
+    @staticmethod
+    def _insert_rows(conn, rows: List[InvoiceRow]):
+        """INSERT en lote de cabeceras (devuelven su id) y después de sus líneas, métricas y archivo."""
+        ids = conn.execute(
+            insert(DBFactura.__table__).returning(DBFactura.__table__.c.id, sort_by_parameter_order=True),
+            [_header_values(row) for row in rows],
+        ).scalars().all()
+        items = [values for factura_id, row in zip(ids, rows) for values in _item_values(factura_id, row.factura)]
+        if items:
+            conn.execute(insert(DBItemFactura.__table__), items)
+        metrics = [_metrics_values(factura_id, row.metrics) for factura_id, row in zip(ids, rows) if row.metrics]
+        if metrics:
+            conn.execute(insert(DBExtractionMetrics.__table__), metrics)
+        conn.execute(insert(DBExtractionArchive.__table__),
+                     [_archive_values(row.document_id, row.factura, row.metrics) for row in rows])
+
+    def load_invoice(self, factura_id: int) -> Optional[Factura]:
+        """Reconstruye la Factura guardada (cabecera y líneas); None si no existe."""
+        session = self.Session()
+        try:
+            db_factura = session.get(DBFactura, factura_id)
+            if db_factura is None:
+                return None
+            return Factura(
+                numero_factura=db_factura.numero_factura,
+                fecha_emision=db_factura.fecha_emision,
+                nombre_proveedor=db_factura.nombre_proveedor,
+                cif_proveedor=db_factura.cif_proveedor,
+                nombre_cliente=db_factura.nombre_cliente,
+                base_imponible=db_factura.base_imponible or 0.0,
+                total_impuestos=db_factura.total_impuestos or 0.0,
+                total_factura=db_factura.total_factura,
+                moneda=db_factura.moneda or "EUR",
+                items=[{
+                    "descripcion": item.descripcion,
+                    "cantidad": item.cantidad,
+                    "precio_unitario": item.precio_unitario,
+                    "total_linea": item.total_linea,
+                } for item in db_factura.items]
+            )
+        finally:
+            session.close()
+
+    def update_invoice(self, factura_id: int, factura: Factura, status: str, notes: str) -> bool:
+        """Guarda la cabecera corregida por un revisor junto con su nuevo estado."""
+        session = self.Session()
+        try:
+            db_factura = session.get(DBFactura, factura_id)
+            if db_factura is None:
+                return False
+            db_factura.numero_factura = factura.numero_factura
+            db_factura.fecha_emision = factura.fecha_emision
+            db_factura.nombre_proveedor = factura.nombre_proveedor
+            db_factura.cif_proveedor = factura.cif_proveedor
+            db_factura.base_imponible = factura.base_imponible
+            db_factura.total_impuestos = factura.total_impuestos
+            db_factura.total_factura = factura.total_factura
+            db_factura.cif_norm = normalise_cif(factura.cif_proveedor)
+            db_factura.numero_norm = normalise_numero(factura.numero_factura)
+            db_factura.proveedor_norm = normalise_proveedor(factura.nombre_proveedor)
+            db_factura.nombre_cliente = factura.nombre_cliente
+            db_factura.moneda = factura.moneda
+            db_factura.status = status
+            db_factura.validation_notes = notes
+            # La corrección también se archiva: un reindexado no la pierde
+            session.add(DBExtractionArchive(**_archive_values(db_factura.document_id, factura, source="revision")))
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print(f"❌ Error actualizando la factura {factura_id}: {e}")
+            return False
+        finally:
+            session.close()
+
+if __name__ == "__main__":
+    import argparse
+    import contextlib
+    import io
+    import random
+    import tempfile
+    from datetime import timedelta
+    from sqlalchemy.exc import OperationalError
+
+    parser = argparse.ArgumentParser(description="Pruebas de rendimiento de la capa de persistencia")
+    parser.add_argument("--bench", type=int, default=None,
+                        help="Benchmark: N facturas con save_invoice (una a una) frente a save_invoices (en lote)")
+    parser.add_argument("--stress", type=float, default=None,
+                        help="Prueba de concurrencia: segundos de escrituras (watcher) y lecturas (dashboard) a la vez")
+    parser.add_argument("--items", type=int, default=5, help="Líneas por factura")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--writers", type=int, default=2, help="Hilos escritores en --stress")
+    parser.add_argument("--readers", type=int, default=4, help="Hilos lectores en --stress")
+    parser.add_argument("--rows", type=int, default=100_000, help="Facturas precargadas en --stress")
+    args = parser.parse_args()
+    if args.bench is None and args.stress is None:
+        parser.error("indica --bench N y/o --stress SEGUNDOS")
+
+    def synthetic_rows(n: int, prefix: str = "bench") -> List[InvoiceRow]:
+        rows = []
+        for i in range(n):
+            items = [{"descripcion": f"Concepto {j}", "cantidad": 1, "precio_unitario": 10.0, "total_linea": 10.0}
+                     for j in range(args.items)]
+            base = 10.0 * args.items
+            factura = Factura(numero_factura=f"B-{i}", fecha_emision=date(2024, 1, 1) + timedelta(days=i % 365),
+                              nombre_proveedor=f"Proveedor {random.randint(1, 200)}", base_imponible=base,
+                              total_impuestos=round(base * 0.21, 2), total_factura=round(base * 1.21, 2), items=items)
+            rows.append(InvoiceRow(f"{prefix}-{i}", factura, "OK", "", ExtractionMetrics(model="gpt-4o-mini")))
+        return rows
+
+    if args.bench is not None:
+        rows = synthetic_rows(args.bench)
+        with tempfile.TemporaryDirectory() as tmp:
+            single = Storage(f"sqlite:///{tmp}/una_a_una.db")
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # save_invoice imprime una línea por factura
+                for row in rows:
+                    single.save_invoice(row.document_id, row.factura, row.status, row.notes, metrics=row.metrics)
+            one_by_one = time.perf_counter() - started
+
+            bulk = Storage(f"sqlite:///{tmp}/en_lote.db")
+            report = bulk.save_invoices(rows, batch_size=args.batch_size)
+            # Lote mixto: las ya guardadas salen como conflicto y las nuevas se guardan igualmente
+            repeated = bulk.save_invoices(rows[:10] + synthetic_rows(10, prefix="nueva"), batch_size=args.batch_size)
+            single.engine.dispose()
+            bulk.engine.dispose()
+
+        print(f"🐢 save_invoice:  {args.bench} facturas en {one_by_one:.2f}s ({args.bench / one_by_one:,.0f}/s)")
+        print(f"🚀 save_invoices: {len(report.saved)} facturas en {report.seconds:.2f}s "
+              f"({len(report.saved) / report.seconds:,.0f}/s), x{one_by_one / report.seconds:.1f}")
+        print(f"⚠️ Lote mixto (10 repetidas + 10 nuevas): {len(repeated.conflicts)} conflictos, "
+              f"{len(repeated.saved)} guardadas")
+
+    def stress(url: str, pragmas: dict, seconds: float) -> dict:
+        """Escritores guardando de una en una (watcher) y lectores leyendo la tabla entera (dashboard)."""
+        storage = Storage(url, pragmas)
+        storage.save_invoices(synthetic_rows(args.rows, prefix="base"), batch_size=5_000)
+        result = {"writes": 0, "write_errors": 0, "latencies": [], "reads": 0, "read_errors": 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + seconds
+
+        def writer(worker: int):
+            n = 0
+            while time.monotonic() < deadline:
+                row, n = synthetic_rows(1, prefix=f"w{worker}-{n}")[0], n + 1
+                started = time.perf_counter()
+                ok = storage.save_invoice(row.document_id, row.factura, row.status, row.notes, metrics=row.metrics)
+                with lock:
+                    result["writes" if ok else "write_errors"] += 1
+                    result["latencies"].append(time.perf_counter() - started)
+
+        def reader():
+            while time.monotonic() < deadline:
+                try:
+                    with storage.engine.connect() as conn:
+                        conn.execute(text("SELECT * FROM facturas")).fetchall()
+                    key = "reads"
+                except OperationalError:
+                    key = "read_errors"
+                with lock:
+                    result[key] += 1
+
+        threads = ([threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+                   + [threading.Thread(target=reader) for _ in range(args.readers)])
+        with contextlib.redirect_stdout(io.StringIO()):  # Los "💾 Guardado" y "❌ Error" se cuentan, no se imprimen
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        storage.engine.dispose()
+        return result
+
+    if args.stress is not None:
+        print(f"🔥 {args.writers} escritores + {args.readers} lectores durante {args.stress:.0f}s "
+              f"sobre {args.rows:,} facturas precargadas")
+        modes = [("rollback journal", {}), ("WAL + PRAGMA", SQLITE_PRAGMAS)]
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, pragmas in modes:
+                r = stress(f"sqlite:///{tmp}/{name.split()[0].lower()}.db", pragmas, args.stress)
+                latencies = sorted(r["latencies"]) or [0.0]
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                print(f"  {name:17} escrituras {r['writes']:>6} ({r['write_errors']} fallidas), "
+                      f"latencia p95 {p95 * 1000:7.1f} ms, máx {latencies[-1] * 1000:7.1f} ms | "
+                      f"lecturas {r['reads']:>4} ({r['read_errors']} fallidas)")
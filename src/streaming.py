@@ -0,0 +1,97 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, ValidationError
+from .models import Factura, ItemFactura
+
+# -----------------------------------------------------------------------------
+# 19. EXTRACCIÓN EN STREAMING (Campos según llegan)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es el "teletipo" de la extracción. En lugar de esperar a la Factura completa,
+# el LLM nos envía el JSON a trozos e instructor lo va parseando como un modelo
+# parcial (`Partial[Factura]`). Aquí convertimos esos parciales en
+# actualizaciones (`StreamUpdate`): "ya tenemos el proveedor", "llegó la línea 3".
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Latencia percibida: Una extracción por visión tarda varios segundos. Quien
+#    sube una factura a mano ve el proveedor y el total en cuanto se generan.
+# 2. Solo lo definitivo: Un parcial puede traer "Proveed" o un importe a medio
+#    escribir. Un campo se publica cuando el modelo ya pasó al SIGUIENTE campo
+#    (genera en el orden del schema), y una línea cuando empieza la siguiente.
+# 3. Parada temprana: Si con la cabecera basta (ej: comprobar un duplicado),
+#    el consumidor sale del bucle y el stream HTTP se cierra sin pagar las líneas.
+# 4. El resultado final se sigue validando: la última actualización trae la
+#    Factura completa validada por Pydantic (y por la cascada de modelos).
+# -----------------------------------------------------------------------------
+
+# Campos de cabecera que se publican en cuanto llegan
+HEADER_FIELDS = ("nombre_proveedor", "fecha_emision", "total_factura")
+
+@dataclass
+class StreamUpdate:
+    """Estado de una extracción en curso (lo nuevo de este fragmento y lo acumulado)."""
+    header: Dict[str, Any]                                         # Campos de cabecera definitivos
+    items: List[ItemFactura]                                       # Líneas completas hasta ahora
+    new_fields: List[str] = field(default_factory=list)
+    new_items: List[ItemFactura] = field(default_factory=list)
+    factura: Optional[Factura] = None                              # Solo en la última: el resultado validado
+
+    @property
+    def done(self) -> bool:
+        return self.factura is not None
+
+    @property
+    def header_ready(self) -> bool:
+        """¿Han llegado ya todos los campos de HEADER_FIELDS?"""
+        return all(name in self.header for name in HEADER_FIELDS)
+
+class PartialTracker:
+    """Compara parciales consecutivos y emite solo lo que ya es definitivo."""
+
+    # Orden en que el modelo genera los campos (el del schema)
+    FIELD_ORDER = list(Factura.model_fields)
+
+    def __init__(self):
+        self.header: Dict[str, Any] = {}
+        self.items: List[ItemFactura] = []
+
+    def update(self, partial: BaseModel) -> Optional[StreamUpdate]:
+        """Procesa un parcial de instructor; None si no trae nada definitivo nuevo."""
+        present = [name for name in self.FIELD_ORDER if name in partial.model_fields_set]
+        # Un campo es definitivo cuando ya ha empezado uno posterior
+        settled = set(present[:-1])
+        new_fields = []
+        for name in HEADER_FIELDS:
+            if name in settled and name not in self.header:
+                self.header[name] = getattr(partial, name, None)  # None = la factura no lo trae
+                new_fields.append(name)
+
+        raw_items = getattr(partial, "items", None) or []
+        # Todas las líneas menos la última están completas (la última se está escribiendo)
+        new_items = []
+        for raw in raw_items[len(self.items):-1]:
+            item = _complete_item(raw)
+            if item is None:
+                break
+            self.items.append(item)
+            new_items.append(item)
+
+        if not new_fields and not new_items:
+            return None
+        return StreamUpdate(dict(self.header), list(self.items), new_fields, new_items)
+
+    def finish(self, factura: Factura) -> StreamUpdate:
+        """Última actualización: la factura validada (puede venir de otro modelo de la cascada)."""
+        header = {name: getattr(factura, name) for name in HEADER_FIELDS}
+        new_fields = [name for name in header if name not in self.header or self.header[name] != header[name]]
+        known = len(self.items) if self.items == factura.items[:len(self.items)] else 0
+        self.header, self.items = header, list(factura.items)
+        return StreamUpdate(dict(header), list(factura.items), new_fields, factura.items[known:], factura)
+
+def _complete_item(raw: Any) -> Optional[ItemFactura]:
+    """Convierte una línea parcial en ItemFactura (None si aún le faltan campos)."""
+    data = raw.model_dump() if isinstance(raw, BaseModel) else raw
+    try:
+        return ItemFactura.model_validate(data)
+    except ValidationError:
+        return None
@@ -0,0 +1,211 @@
+import os
+import csv
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional
+from .duplicates import normalise_cif, normalise_proveedor
+from .models import Factura
+
+# -----------------------------------------------------------------------------
+# 22. MAESTRO DE PROVEEDORES (NIF/CIF/NIE y nombre canónico)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la "agenda" de proveedores de la empresa: CIF, nombre oficial y los alias con
+# que aparece en las facturas ("Ferretería López", "FERRETERIA LOPEZ SL"...). Se
+# carga de un CSV o de un SQLite exportado del ERP (SUPPLIER_REGISTRY).
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Dígito de control: Un NIF/CIF/NIE lleva una letra o dígito de control. Si el
+#    LLM lee mal una cifra, el control no cuadra y lo detectamos sin consultar nada.
+# 2. En memoria: Se indexa por CIF normalizado y por nombre normalizado en dos
+#    `dict`. Una búsqueda son microsegundos, no una consulta al ERP por factura.
+# 3. Nombre canónico: Si el proveedor está en el maestro, la factura se guarda con
+#    su nombre oficial. Los informes por proveedor y la detección de duplicados
+#    dejan de depender de cómo lo escribió cada factura.
+# 4. Recarga sola: Cada pocos segundos se mira la fecha de modificación del archivo
+#    (un `stat`, no una lectura). Si cambió, se recarga UNA vez por proceso y todos
+#    los hilos del watcher ven la versión nueva.
+# -----------------------------------------------------------------------------
+
+DEFAULT_REGISTRY_PATH = "data/proveedores.csv"
+
+# Letra de control de NIF y NIE (número módulo 23)
+_LETRAS_NIF = "TRWAGMYFPDXBNJZSQVHLCKE"
+# Carácter de control de CIF cuando es letra (J=0, A=1, ..., I=9)
+_LETRAS_CIF = "JABCDEFGHI"
+_TIPOS_CIF = "ABCDEFGHJNPQRSUVW"
+# Entidades cuyo CIF termina siempre en letra / siempre en dígito
+_CIF_CONTROL_LETRA = "NPQRSW"
+_CIF_CONTROL_DIGITO = "ABEH"
+
+def cif_control_digit(body: str) -> int:
+    """Dígito de control de un CIF a partir de sus 7 dígitos centrales."""
+    pares = sum(int(d) for d in body[1::2])
+    impares = sum(sum(divmod(int(d) * 2, 10)) for d in body[0::2])
+    return (10 - (pares + impares) % 10) % 10
+
+@lru_cache(maxsize=65_536)
+def valid_tax_id(value: str) -> bool:
+    """¿Cuadra el carácter de control de un NIF, NIE o CIF español (ya normalizado)?"""
+    if len(value) != 9:
+        return False
+    first, body, control = value[0], value[1:8], value[8]
+    if value[:8].isdigit():  # NIF (DNI): 8 dígitos + letra
+        return control == _LETRAS_NIF[int(value[:8]) % 23]
+    if first in "XYZ" and body.isdigit():  # NIE: X/Y/Z valen 0/1/2
+        return control == _LETRAS_NIF[int(str("XYZ".index(first)) + body) % 23]
+    if first in "KLM" and body.isdigit():  # NIF especiales (menores, no residentes)
+        return control == _LETRAS_NIF[int(body) % 23]
+    if first in _TIPOS_CIF and body.isdigit():  # CIF: letra + 7 dígitos + control
+        digito = cif_control_digit(body)
+        if first in _CIF_CONTROL_LETRA:
+            return control == _LETRAS_CIF[digito]
+        if first in _CIF_CONTROL_DIGITO:
+            return control == str(digito)
+        return control in (str(digito), _LETRAS_CIF[digito])
+    return False
+
+def is_spanish_tax_id(value: str) -> bool:
+    """¿Tiene forma de identificador fiscal español? (un VAT extranjero no se comprueba)"""
+    return len(value) == 9 and (value[:8].isdigit() or value[0] in "XYZKLM" + _TIPOS_CIF)
+
+@dataclass(frozen=True)
+class Supplier:
+    """Proveedor del maestro."""
+    cif: str
+    nombre: str
+
+class SupplierRegistry:
+    """Índice en memoria del maestro de proveedores, recargado cuando cambia el archivo."""
+
+    def __init__(self, path: str = DEFAULT_REGISTRY_PATH, check_interval: float = 5.0):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._by_cif: Dict[str, Supplier] = {}
+        self._by_name: Dict[str, Supplier] = {}
+        self._mtime: Optional[int] = None
+        self._checked_at = 0.0
+        self.loads = 0
+        self.invalid = 0  # CIFs del maestro con el control mal (se cargan igualmente)
+        self._reload_if_changed(force=True)
+
+    @classmethod
+    def from_env(cls) -> "SupplierRegistry":
+        return cls(os.getenv("SUPPLIER_REGISTRY", DEFAULT_REGISTRY_PATH),
+                   check_interval=float(os.getenv("SUPPLIER_REGISTRY_CHECK_S", 5.0)))
+
+    @property
+    def available(self) -> bool:
+        """¿Hay maestro cargado? Sin maestro no se marca ningún proveedor como desconocido."""
+        return bool(self._by_cif or self._by_name)
+
+    def __len__(self) -> int:
+        return len(set(self._by_cif.values()) | set(self._by_name.values()))
+
+    def _read_rows(self):
+        """Filas (cif, nombre, alias) del CSV o de la tabla `proveedores` del SQLite."""
+        if self.path.suffix.lower() in (".db", ".sqlite", ".sqlite3"):
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            try:
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(proveedores)")}
+                alias = "alias" if "alias" in columns else "''"
+                return conn.execute(f"SELECT cif, nombre, {alias} FROM proveedores").fetchall()
+            finally:
+                conn.close()
+        # utf-8-sig: los CSV exportados de Excel o del ERP suelen empezar con BOM
+        with open(self.path, newline="", encoding="utf-8-sig") as f:
+            return [(row.get("cif"), row.get("nombre"), row.get("alias")) for row in csv.DictReader(f)]
+
+    def _reload_if_changed(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked_at < self.check_interval:
+                return  # Otro hilo acaba de comprobarlo
+            self._checked_at = now
+            try:
+                mtime = self.path.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self._mtime:
+                return
+            by_cif, by_name, invalid = {}, {}, 0
+            if mtime is not None:
+                try:
+                    rows = self._read_rows()
+                except (OSError, UnicodeDecodeError, csv.Error, sqlite3.Error) as e:
+                    # Archivo a medio escribir o mal formado: se sigue con el índice anterior
+                    # y no se vuelve a intentar hasta que el archivo cambie otra vez
+                    self._mtime = mtime
+                    print(f"⚠️ No se pudo cargar el maestro de proveedores ({self.path}): {e}. "
+                          f"Se mantiene el anterior ({len(self)} proveedores)")
+                    return
+                for cif, nombre, alias in rows:
+                    cif = normalise_cif(cif)
+                    if not cif or not nombre:
+                        continue
+                    if is_spanish_tax_id(cif) and not valid_tax_id(cif):
+                        invalid += 1
+                    supplier = Supplier(cif=cif, nombre=nombre.strip())
+                    by_cif[cif] = supplier
+                    for name in [nombre, *(alias or "").split("|")]:
+                        if normalise_proveedor(name):
+                            by_name[normalise_proveedor(name)] = supplier
+            # Se sustituyen los índices de golpe: las búsquedas en curso ven el viejo o el nuevo
+            self._by_cif, self._by_name, self._mtime = by_cif, by_name, mtime
+            self.invalid = invalid
+            self.loads += 1
+            if mtime is not None:
+                print(f"📇 Maestro de proveedores cargado: {len(by_cif)} proveedores ({self.path})")
+                if not by_cif:
+                    print(f"⚠️ El maestro {self.path} existe pero no tiene filas válidas "
+                          f"(¿faltan las columnas cif y nombre?)")
+                if invalid:
+                    print(f"⚠️ {invalid} CIFs del maestro con dígito de control incorrecto")
+
+    def lookup(self, cif: Optional[str] = None, nombre: Optional[str] = None) -> Optional[Supplier]:
+        """Busca por CIF y, si no aparece, por nombre o alias."""
+        self._reload_if_changed()
+        cif = normalise_cif(cif)
+        if cif and cif in self._by_cif:
+            return self._by_cif[cif]
+        return self._by_name.get(normalise_proveedor(nombre)) if nombre else None
+
+    def known_cifs(self) -> frozenset:
+        """CIFs normalizados del maestro (para la revalidación masiva)."""
+        self._reload_if_changed()
+        return frozenset(self._by_cif)
+
+    def known_names(self) -> frozenset:
+        """Nombres y alias normalizados del maestro."""
+        self._reload_if_changed()
+        return frozenset(self._by_name)
+
+    def canonicalise(self, factura: Factura) -> Factura:
+        """Devuelve la factura con el nombre oficial si el proveedor está en el maestro."""
+        supplier = self.lookup(factura.cif_proveedor, factura.nombre_proveedor)
+        if supplier is None:
+            return factura
+        # El CIF solo se completa si falta: uno distinto al del maestro se deja a la vista
+        cif = factura.cif_proveedor or supplier.cif
+        if factura.nombre_proveedor == supplier.nombre and cif == factura.cif_proveedor:
+            return factura
+        return factura.model_copy(update={"nombre_proveedor": supplier.nombre, "cif_proveedor": cif})
+
+_registry: Optional[SupplierRegistry] = None
+_registry_lock = threading.Lock()
+
+def get_supplier_registry() -> SupplierRegistry:
+    """Maestro del proceso (uno solo, compartido por todos los hilos), creado la primera vez."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = SupplierRegistry.from_env()
+    return _registry
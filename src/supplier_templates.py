@@ -0,0 +1,394 @@
+import re
+import json
+import sqlite3
+import threading
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .models import Factura, ItemFactura
+from .ingestor import Document
+from .pdf_handler import extract_pdf_text, has_usable_text
+from .validator import validate_invoice
+
+# -----------------------------------------------------------------------------
+# 15. PLANTILLAS DE PROVEEDOR (Atajo sin LLM para formatos conocidos)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la "memoria muscular" del sistema. Cuando el LLM extrae bien (estado OK) una
+# factura de un proveedor cuyo PDF tiene texto, aprendemos DÓNDE estaba cada dato:
+# la etiqueta que lo precede ("Total factura:", "Nº:") y el orden de columnas de
+# las líneas. La próxima factura de ese proveedor se parsea en local con regex.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Volumen concentrado: El 70% de las facturas viene de ~20 proveedores con un
+#    formato fijo. Parsearlas en local tarda milisegundos y cuesta 0 €.
+# 2. Seguridad: El resultado de la plantilla SOLO se acepta si `validate_invoice`
+#    no da ni errores ni avisos (totales cuadran, hay número, fecha y líneas).
+#    Si algo no encaja, se cae al LLM como siempre. Nunca empeora la calidad.
+# 3. Medible: Se guardan aciertos y fallos por proveedor (`stats()`), para ver
+#    qué plantillas funcionan y cuáles conviene revisar.
+#
+# LIMITACIÓN: Solo aplica a PDFs con capa de texto. Las fotos no tienen texto
+# local (haría falta OCR), así que siempre van al LLM.
+# -----------------------------------------------------------------------------
+
+# Campos de cabecera que aprendemos por etiqueta (el resto son constantes del proveedor)
+_AMOUNT_FIELDS = ("base_imponible", "total_impuestos", "total_factura")
+_ITEM_FIELDS = ("cantidad", "precio_unitario", "total_linea")
+
+_NUMBER_TOKEN_RE = re.compile(r"-?\d[\d.,]*\d|-?\d")
+_DATE_TOKEN_RE = re.compile(r"\b(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4})\b|\b(\d{4})-(\d{2})-(\d{2})\b")
+_CURRENCY_TOKENS = {"€", "eur", "euros", "$", "usd"}
+
+# Patrones de valor usados al aplicar una plantilla
+_VALUE_PATTERNS = {
+    "numero_factura": r"([A-Za-z0-9][A-Za-z0-9/\-_.]*)",
+    "fecha_emision": r"(\d{1,2}[/.\-]\d{1,2}[/.\-]\d{4}|\d{4}-\d{2}-\d{2})",
+    "amount": r"(-?\d[\d.,]*\d|-?\d)",
+}
+
+def normalize_tax_id(value: Optional[str]) -> str:
+    """CIF/NIF en mayúsculas y sin separadores (para buscarlo en el texto)."""
+    return re.sub(r"[^A-Z0-9]", "", (value or "").upper())
+
+def parse_amount(token: str) -> Optional[float]:
+    """Convierte '1.234,56', '1,234.56', '1234,5' o '21%' a float (o None)."""
+    token = token.strip().rstrip("%€$").replace(" ", "")
+    if not token or not _NUMBER_TOKEN_RE.fullmatch(token):
+        return None
+    if "," in token and "." in token:
+        # El separador que aparece el último es el decimal
+        if token.rfind(",") > token.rfind("."):
+            token = token.replace(".", "").replace(",", ".")
+        else:
+            token = token.replace(",", "")
+    elif "," in token:
+        head, _, tail = token.rpartition(",")
+        token = f"{head.replace(',', '')}.{tail}" if len(tail) != 3 else token.replace(",", "")
+    elif token.count(".") == 1 and len(token.rpartition(".")[2]) == 3:
+        token = token.replace(".", "")  # '1.234' en una factura española son miles
+    elif token.count(".") > 1:
+        token = token.replace(".", "")
+    try:
+        return float(token)
+    except ValueError:
+        return None
+
+def parse_date(token: str) -> Optional[date]:
+    match = _DATE_TOKEN_RE.search(token)
+    if not match:
+        return None
+    try:
+        if match.group(4):
+            return date(int(match.group(4)), int(match.group(5)), int(match.group(6)))
+        return date(int(match.group(3)), int(match.group(2)), int(match.group(1)))
+    except ValueError:
+        return None
+
+def _anchor_before(line: str, start: int) -> Optional[str]:
+    """
+    Regex de la etiqueta que precede a un valor ('Total factura:', 'IVA 21%:').
+
+    Tomamos las palabras justo antes del valor hasta reunir al menos dos palabras y
+    tres letras. Los dígitos de la etiqueta se generalizan a \\d+ (el tipo de IVA o
+    una fecha previa en la misma línea pueden cambiar de una factura a otra).
+    """
+    tokens = line[:start].split()
+    label = []
+    while tokens and len(label) < 4:
+        label.insert(0, tokens.pop())
+        letters = sum(ch.isalpha() for token in label for ch in token)
+        if letters >= 3 and (len(label) >= 2 or not tokens):
+            break
+    if sum(ch.isalpha() for token in label for ch in token) < 3:
+        return None
+    return r"\s+".join(re.sub(r"\d+", r"\\d+", re.escape(token)) for token in label)
+
+def _anchor_regex(anchor: str, value_pattern: str) -> str:
+    return anchor + r"[\s:.\-]*" + value_pattern
+
+def _trailing_numbers(line: str) -> Tuple[str, List[float]]:
+    """Separa una línea en (descripción, números finales)."""
+    tokens = line.split()
+    numbers = []
+    while tokens:
+        token = tokens[-1]
+        if token.lower() in _CURRENCY_TOKENS:
+            tokens.pop()
+            continue
+        value = parse_amount(token)
+        if value is None:
+            break
+        numbers.append(value)
+        tokens.pop()
+    return " ".join(tokens), list(reversed(numbers))
+
+def _close(a: float, b: float) -> bool:
+    return abs(a - b) <= 0.005
+
+# -----------------------------------------------------------------------------
+# APRENDIZAJE
+# -----------------------------------------------------------------------------
+
+def learn_template(text: str, factura: Factura) -> Optional[dict]:
+    """Deduce una plantilla a partir del texto y de la factura correcta. None si no se puede."""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    fields: Dict[str, str] = {}
+
+    for line in lines:
+        # Número de factura: aparece literal
+        if "numero_factura" not in fields and factura.numero_factura:
+            pos = line.find(factura.numero_factura)
+            anchor = _anchor_before(line, pos) if pos >= 0 else None
+            if anchor:
+                fields["numero_factura"] = _anchor_regex(anchor, _VALUE_PATTERNS["numero_factura"])
+
+        # Fecha: cualquier formato habitual que se parsee a la misma fecha
+        if "fecha_emision" not in fields and factura.fecha_emision:
+            for match in _DATE_TOKEN_RE.finditer(line):
+                if parse_date(match.group(0)) == factura.fecha_emision:
+                    anchor = _anchor_before(line, match.start())
+                    if anchor:
+                        fields["fecha_emision"] = _anchor_regex(anchor, _VALUE_PATTERNS["fecha_emision"])
+                    break
+
+        # Importes: el primer número de la línea que vale lo mismo
+        for name in _AMOUNT_FIELDS:
+            if name in fields:
+                continue
+            target = getattr(factura, name)
+            for match in _NUMBER_TOKEN_RE.finditer(line):
+                value = parse_amount(match.group(0))
+                if value is not None and _close(value, target):
+                    anchor = _anchor_before(line, match.start())
+                    if anchor:
+                        fields[name] = _anchor_regex(anchor, _VALUE_PATTERNS["amount"])
+                    break
+
+    # Sin total ni base no hay plantilla que valga
+    if "total_factura" not in fields or "base_imponible" not in fields:
+        return None
+
+    layout = _learn_item_layout(lines, factura.items)
+    if layout is None:
+        return None
+
+    return {
+        "fields": fields,
+        "item_layout": layout,
+        "nombre_proveedor": factura.nombre_proveedor,
+        "cif_proveedor": factura.cif_proveedor,
+        "moneda": factura.moneda,
+    }
+
+def _learn_item_layout(lines: List[str], items: List[ItemFactura]) -> Optional[List[Optional[str]]]:
+    """
+    Aprende el orden de las columnas numéricas de las líneas de detalle.
+    Ej: ['cantidad', None, 'precio_unitario', 'total_linea'] (None = columna ignorada, p.ej. IVA %).
+    """
+    if not items:
+        return None
+
+    layout = None
+    for item in items:
+        found = None
+        for line in lines:
+            description, numbers = _trailing_numbers(line)
+            if not description or len(numbers) < 3:
+                continue
+            candidate = []
+            for number in numbers:
+                match = next((f for f in _ITEM_FIELDS if f not in candidate and _close(number, getattr(item, f))), None)
+                candidate.append(match)
+            if all(f in candidate for f in _ITEM_FIELDS):
+                found = candidate
+                break
+        if found is None or (layout is not None and found != layout):
+            return None
+        layout = found
+    return layout
+
+# -----------------------------------------------------------------------------
+# APLICACIÓN
+# -----------------------------------------------------------------------------
+
+def apply_template(text: str, template: dict) -> Optional[Factura]:
+    """Parsea el texto con la plantilla. None si falta algún campo aprendido."""
+    values = {}
+    for name, pattern in template["fields"].items():
+        match = re.search(pattern, text, flags=re.IGNORECASE)
+        if not match:
+            return None
+        raw = match.group(1)
+        if name == "fecha_emision":
+            values[name] = parse_date(raw)
+        elif name in _AMOUNT_FIELDS:
+            values[name] = parse_amount(raw)
+        else:
+            values[name] = raw
+        if values[name] is None:
+            return None
+
+    layout = template["item_layout"]
+    items = []
+    for line in text.splitlines():
+        description, numbers = _trailing_numbers(line.strip())
+        if not description or len(numbers) != len(layout):
+            continue
+        item = {field: number for field, number in zip(layout, numbers) if field}
+        items.append(ItemFactura(descripcion=description, **item))
+
+    return Factura(
+        nombre_proveedor=template["nombre_proveedor"],
+        cif_proveedor=template["cif_proveedor"],
+        moneda=template["moneda"],
+        items=items,
+        **values,
+    )
+
+class SupplierTemplateEngine:
+    """Plantillas por proveedor (clave = CIF normalizado), persistidas en SQLite."""
+
+    def __init__(self, db_path: str = "data/supplier_templates.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._init_db()
+        self._templates = self._load_templates()
+        # Último texto leído: `learn` suele llegar justo después de `try_parse` del mismo doc
+        self._last_text: Tuple[Optional[str], Optional[str]] = (None, None)
+        # Contadores de esta ejecución (los históricos viven en la tabla)
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path)
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS supplier_templates (
+                    cif TEXT PRIMARY KEY,
+                    nombre_proveedor TEXT,
+                    template TEXT NOT NULL,
+                    samples INTEGER DEFAULT 0,
+                    hits INTEGER DEFAULT 0,
+                    misses INTEGER DEFAULT 0,
+                    updated_at TIMESTAMP
+                )
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _load_templates(self) -> Dict[str, dict]:
+        conn = self._connect()
+        try:
+            return {cif: json.loads(raw) for cif, raw in conn.execute("SELECT cif, template FROM supplier_templates")}
+        finally:
+            conn.close()
+
+    def _document_text(self, document: Document) -> Optional[str]:
+        if not document.filename.lower().endswith(".pdf"):
+            return None
+        if self._last_text[0] == document.id:
+            return self._last_text[1]
+        pages = extract_pdf_text(document.filepath)
+        text = "\n".join(pages) if has_usable_text(pages) else None
+        self._last_text = (document.id, text)
+        return text
+
+    def _find_supplier(self, text: str) -> Optional[str]:
+        """Busca en el texto el CIF de algún proveedor con plantilla."""
+        compact = normalize_tax_id(text)
+        for cif in self._templates:
+            if cif and cif in compact:
+                return cif
+        return None
+
+    def try_parse(self, document: Document) -> Optional[Factura]:
+        """Intenta extraer la factura con una plantilla. None → hay que usar el LLM."""
+        if not self._templates:
+            return None
+        text = self._document_text(document)
+        if text is None:
+            return None
+        cif = self._find_supplier(text)
+        if cif is None:
+            return None
+
+        try:
+            factura = apply_template(text, self._templates[cif])
+        except Exception:
+            factura = None
+
+        accepted = False
+        if factura is not None:
+            result = validate_invoice(factura)
+            accepted = result.is_valid and not result.warnings
+
+        self._record(cif, hit=accepted)
+        return factura if accepted else None
+
+    def learn(self, document: Document, factura: Factura):
+        """Aprende (o actualiza) la plantilla del proveedor con una extracción aceptada."""
+        cif = normalize_tax_id(factura.cif_proveedor)
+        if not cif:
+            return
+        # Solo aprendemos de extracciones que habrían quedado en estado OK
+        result = validate_invoice(factura)
+        if not result.is_valid or result.warnings:
+            return
+        text = self._document_text(document)
+        if text is None or cif not in normalize_tax_id(text):
+            return
+        template = learn_template(text, factura)
+        if template is None:
+            return
+
+        with self._lock:
+            self._templates[cif] = template
+            conn = self._connect()
+            try:
+                conn.execute("""
+                    INSERT INTO supplier_templates (cif, nombre_proveedor, template, samples, updated_at)
+                    VALUES (?, ?, ?, 1, ?)
+                    ON CONFLICT(cif) DO UPDATE SET
+                        nombre_proveedor = excluded.nombre_proveedor,
+                        template = excluded.template,
+                        samples = samples + 1,
+                        updated_at = excluded.updated_at
+                """, (cif, factura.nombre_proveedor, json.dumps(template, ensure_ascii=False), datetime.now()))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _record(self, cif: str, hit: bool):
+        column = "hits" if hit else "misses"
+        with self._lock:
+            setattr(self, column, getattr(self, column) + 1)
+            conn = self._connect()
+            try:
+                conn.execute(f"UPDATE supplier_templates SET {column} = {column} + 1 WHERE cif = ?", (cif,))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def stats(self) -> List[dict]:
+        """Aciertos y fallos por proveedor (ordenado por volumen)."""
+        conn = self._connect()
+        try:
+            rows = conn.execute("""
+                SELECT cif, nombre_proveedor, samples, hits, misses
+                FROM supplier_templates ORDER BY hits + misses DESC
+            """).fetchall()
+        finally:
+            conn.close()
+        return [
+            {
+                "cif": cif, "nombre_proveedor": nombre, "samples": samples, "hits": hits, "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            }
+            for cif, nombre, samples, hits, misses in rows
+        ]
@@ -1,6 +1,11 @@
-from dataclasses import dataclass
-from typing import List
+import time
+import threading
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 from .models import Factura
+from .duplicates import normalise_cif
+from .supplier_registry import get_supplier_registry, is_spanish_tax_id, valid_tax_id
 
 # -----------------------------------------------------------------------------
 # 4. VALIDADOR DE NEGOCIO
@@ -16,46 +21,230 @@ from .models import Factura
 #    (ej: "¿Existe este proveedor en mi ERP?", "¿La fecha es del ejercicio fiscal abierto?").
 # 3. Confianza: Si el LLM se inventa un número, la validación matemática (Total = Suma items)
 #    lo detectará y marcará la factura para revisión humana (REVIEW).
+# 4. Reglas como datos: Cada regla (`Rule`) declara qué campos lee, su tolerancia
+#    y su gravedad. `RuleEngine` las compila UNA vez al arrancar (comprueba que los
+#    campos existen, fija la tolerancia y construye el índice campo → reglas).
+# 5. Revalidación incremental: Si un revisor corrige un campo en el dashboard,
+#    `revalidate` solo repite las reglas que leen ese campo; el resto se reutiliza.
+# 6. Tiempos por regla: El motor mide cada regla. Una regla lenta (ej: consultar
+#    un maestro de proveedores del ERP) aparece en `timings()` en cuanto se añade.
+# 7. Proveedor: El CIF debe tener un carácter de control válido y, si hay maestro
+#    de proveedores (src/supplier_registry.py), el proveedor debe estar en él.
 # -----------------------------------------------------------------------------
 
+# Márgenes de las reglas (también los usa la revalidación masiva, src/bulk_validation.py)
+TOLERANCIA_TOTALES = 0.05  # Redondeos entre Base + Impuestos y Total
+TOLERANCIA_LINEAS = 1.0    # Suma de líneas frente a Base o Total
+
+# Mensajes de las reglas (idénticos en la validación fila a fila y en la masiva)
+MSG_TOTALES = "Error matemático: Base ({base}) + Impuestos ({impuestos}) != Total ({total}). Dif: {diferencia:.2f}"
+MSG_SIN_NUMERO = "Falta el número de factura. Se ha extraído vacío."
+MSG_SIN_FECHA = "Falta la fecha de emisión."
+MSG_SIN_LINEAS = "La factura no tiene líneas de detalle (items)."
+MSG_SUMA_LINEAS = "La suma de líneas ({suma:.2f}) no coincide ni con Base ni con Total."
+MSG_CIF_INVALIDO = "El CIF/NIF del proveedor ({cif}) no tiene un carácter de control válido."
+MSG_PROVEEDOR_DESCONOCIDO = "El proveedor no está en el maestro de proveedores."
+
+# Gravedad de una regla incumplida
+ERROR = "error"        # La factura no cuadra: estado ERROR
+WARNING = "warning"    # Aviso: estado REVIEW
+CRITICAL = "critical"  # Aviso grave: REVIEW y, además, justifica escalar de modelo
+SEVERITIES = (ERROR, WARNING, CRITICAL)
+
 @dataclass
 class ValidationResult:
     is_valid: bool
     errors: List[str]
     warnings: List[str]
+    # Avisos graves (también están en `warnings`): justifican repetir con un modelo mejor
+    critical: List[str] = field(default_factory=list)
+    # Resultado de cada regla (None = se cumple): punto de partida de `RuleEngine.revalidate`
+    outcomes: Dict[str, Optional[str]] = field(default_factory=dict)
+    # Reglas que se ejecutaron para obtener este resultado (todas o solo las afectadas)
+    evaluated: List[str] = field(default_factory=list)
 
-def validate_invoice(factura: Factura) -> ValidationResult:
-    errors = []
-    warnings = []
+    @property
+    def status(self) -> str:
+        """Estado que se guarda en la DB: ERROR (no cuadra), REVIEW (avisos) u OK."""
+        if self.errors:
+            return "ERROR"
+        return "REVIEW" if self.warnings else "OK"
 
-    # 1. Validación de Totales (Matemáticas)
+    @property
+    def notes(self) -> str:
+        """Notas que acompañan al estado: los errores o, si no hay, los avisos."""
+        return "; ".join(self.errors or self.warnings)
+
+    @property
+    def needs_escalation(self) -> bool:
+        """¿Merece la pena repetir la extracción con el siguiente modelo de la cascada?"""
+        return not self.is_valid or bool(self.critical)
+
+# --- Reglas ------------------------------------------------------------------
+# Cada comprobación recibe (factura, tolerancia) y devuelve el mensaje si se incumple.
+
+def _check_totales(factura: Factura, tolerance: float) -> Optional[str]:
     # Permitimos un pequeño margen de error por redondeos (0.05 céntimos)
-    calculado = factura.base_imponible + factura.total_impuestos
-    diferencia = abs(calculado - factura.total_factura)
-    
-    if diferencia > 0.05:
-        errors.append(f"Error matemático: Base ({factura.base_imponible}) + Impuestos ({factura.total_impuestos}) != Total ({factura.total_factura}). Dif: {diferencia:.2f}")
-
-    # 2. Validación de Campos Obligatorios Críticos (más allá del tipo)
-    if not factura.numero_factura:
-        warnings.append("Falta el número de factura. Se ha extraído vacío.")
-    
-    if not factura.fecha_emision:
-        warnings.append("Falta la fecha de emisión.")
-
-    # 3. Validación de Líneas
+    diferencia = abs(factura.base_imponible + factura.total_impuestos - factura.total_factura)
+    if diferencia > tolerance:
+        return MSG_TOTALES.format(base=factura.base_imponible, impuestos=factura.total_impuestos,
+                                  total=factura.total_factura, diferencia=diferencia)
+    return None
+
+def _check_numero(factura: Factura, tolerance: Optional[float]) -> Optional[str]:
+    return None if factura.numero_factura else MSG_SIN_NUMERO
+
+def _check_fecha(factura: Factura, tolerance: Optional[float]) -> Optional[str]:
+    return None if factura.fecha_emision else MSG_SIN_FECHA
+
+def _check_lineas(factura: Factura, tolerance: Optional[float]) -> Optional[str]:
+    return None if factura.items else MSG_SIN_LINEAS
+
+def _check_suma_lineas(factura: Factura, tolerance: float) -> Optional[str]:
     if not factura.items:
-        warnings.append("La factura no tiene líneas de detalle (items).")
-    else:
-        # Comprobar que la suma de las líneas cuadra con la base imponible
-        suma_lineas = sum(item.total_linea for item in factura.items)
-        # Esto es delicado porque a veces total_linea incluye IVA y a veces no.
-        # Lo ponemos como warning si la diferencia es muy grande.
-        if abs(suma_lineas - factura.base_imponible) > 1.0 and abs(suma_lineas - factura.total_factura) > 1.0:
-            warnings.append(f"La suma de líneas ({suma_lineas:.2f}) no coincide ni con Base ni con Total.")
-
-    return ValidationResult(
-        is_valid=(len(errors) == 0),
-        errors=errors,
-        warnings=warnings
-    )
+        return None  # Ya lo avisa la regla "lineas"
+    # Esto es delicado porque a veces total_linea incluye IVA y a veces no.
+    # Solo avisamos si no cuadra ni con la Base ni con el Total.
+    suma_lineas = sum(item.total_linea for item in factura.items)
+    if (abs(suma_lineas - factura.base_imponible) > tolerance
+            and abs(suma_lineas - factura.total_factura) > tolerance):
+        return MSG_SUMA_LINEAS.format(suma=suma_lineas)
+    return None
+
+def _check_cif(factura: Factura, tolerance: Optional[float]) -> Optional[str]:
+    cif = normalise_cif(factura.cif_proveedor)
+    if not cif or not is_spanish_tax_id(cif):
+        return None  # Sin CIF o con VAT extranjero: no hay control que comprobar
+    return None if valid_tax_id(cif) else MSG_CIF_INVALIDO.format(cif=factura.cif_proveedor)
+
+def _check_proveedor(factura: Factura, tolerance: Optional[float]) -> Optional[str]:
+    registry = get_supplier_registry()
+    if not registry.available:
+        return None  # Sin maestro configurado no se puede saber
+    found = registry.lookup(factura.cif_proveedor, factura.nombre_proveedor)
+    return None if found else MSG_PROVEEDOR_DESCONOCIDO
+
+@dataclass(frozen=True)
+class Rule:
+    """Declaración de una regla de negocio."""
+    name: str
+    fields: Tuple[str, ...]   # Campos de Factura que lee
+    severity: str             # ERROR | WARNING | CRITICAL
+    check: Callable[[Factura, Optional[float]], Optional[str]]
+    tolerance: Optional[float] = None
+
+# El orden de declaración es el orden de los mensajes en las notas
+RULES: Tuple[Rule, ...] = (
+    Rule("totales", ("base_imponible", "total_impuestos", "total_factura"), ERROR,
+         _check_totales, TOLERANCIA_TOTALES),
+    Rule("numero_factura", ("numero_factura",), CRITICAL, _check_numero),
+    Rule("fecha_emision", ("fecha_emision",), WARNING, _check_fecha),
+    Rule("lineas", ("items",), WARNING, _check_lineas),
+    Rule("suma_lineas", ("items", "base_imponible", "total_factura"), CRITICAL,
+         _check_suma_lineas, TOLERANCIA_LINEAS),
+    # Un dígito mal leído del CIF: merece repetir con el modelo mayor
+    Rule("cif_proveedor", ("cif_proveedor",), CRITICAL, _check_cif),
+    Rule("proveedor_conocido", ("cif_proveedor", "nombre_proveedor"), WARNING, _check_proveedor),
+)
+
+@dataclass
+class RuleTiming:
+    """Tiempo acumulado de una regla."""
+    calls: int = 0
+    total_s: float = 0.0
+    max_s: float = 0.0
+
+class RuleEngine:
+    """Reglas compiladas: validación completa, incremental y tiempos por regla."""
+
+    def __init__(self, rules: Iterable[Rule] = RULES):
+        self.rules = tuple(rules)
+        # Fallar al arrancar, no con la primera factura
+        known_fields = set(Factura.model_fields)
+        names = set()
+        for rule in self.rules:
+            if rule.name in names:
+                raise ValueError(f"Regla duplicada: {rule.name}")
+            if rule.severity not in SEVERITIES:
+                raise ValueError(f"Regla {rule.name}: gravedad desconocida '{rule.severity}'")
+            unknown = set(rule.fields) - known_fields
+            if unknown:
+                raise ValueError(f"Regla {rule.name}: campos que no existen en Factura: {sorted(unknown)}")
+            names.add(rule.name)
+
+        # Compilación: la tolerancia queda fijada en cada comprobación
+        self._compiled = [(rule, partial(rule.check, tolerance=rule.tolerance)) for rule in self.rules]
+        self._by_field: Dict[str, List[str]] = {}
+        for rule in self.rules:
+            for name in rule.fields:
+                self._by_field.setdefault(name, []).append(rule.name)
+        self._timings: Dict[str, RuleTiming] = {rule.name: RuleTiming() for rule in self.rules}
+        self._lock = threading.Lock()
+
+    def rule(self, name: str) -> Rule:
+        for rule in self.rules:
+            if rule.name == name:
+                return rule
+        raise KeyError(name)
+
+    def rules_for(self, changed_fields: Iterable[str]) -> List[str]:
+        """Reglas que leen alguno de los campos indicados (en orden de declaración)."""
+        affected = {name for field_name in changed_fields for name in self._by_field.get(field_name, ())}
+        return [rule.name for rule in self.rules if rule.name in affected]
+
+    def validate(self, factura: Factura) -> ValidationResult:
+        """Ejecuta todas las reglas."""
+        return self._evaluate(factura, {rule.name for rule in self.rules}, {})
+
+    def revalidate(self, factura: Factura, previous: ValidationResult,
+                   changed_fields: Iterable[str]) -> ValidationResult:
+        """Repite solo las reglas que leen `changed_fields`; el resto sale de `previous`."""
+        to_run = set(self.rules_for(changed_fields))
+        # Las reglas sin resultado previo (ej: añadidas después) también se ejecutan
+        to_run |= {rule.name for rule in self.rules if rule.name not in previous.outcomes}
+        return self._evaluate(factura, to_run, previous.outcomes)
+
+    def _evaluate(self, factura: Factura, to_run: set, previous: Dict[str, Optional[str]]) -> ValidationResult:
+        errors, warnings, critical = [], [], []
+        outcomes: Dict[str, Optional[str]] = {}
+        evaluated = []
+        for rule, check in self._compiled:
+            if rule.name in to_run:
+                started = time.perf_counter()
+                message = check(factura)
+                self._record(rule.name, time.perf_counter() - started)
+                evaluated.append(rule.name)
+            else:
+                message = previous.get(rule.name)
+            outcomes[rule.name] = message
+            if message is None:
+                continue
+            if rule.severity == ERROR:
+                errors.append(message)
+            else:
+                warnings.append(message)
+                if rule.severity == CRITICAL:
+                    critical.append(message)
+        return ValidationResult(is_valid=not errors, errors=errors, warnings=warnings, critical=critical,
+                                outcomes=outcomes, evaluated=evaluated)
+
+    def _record(self, name: str, seconds: float):
+        with self._lock:  # Se valida desde varios hilos (workers, watcher)
+            timing = self._timings[name]
+            timing.calls += 1
+            timing.total_s += seconds
+            timing.max_s = max(timing.max_s, seconds)
+
+    def timings(self) -> List[dict]:
+        """Tiempo por regla, de la que más tiempo acumula a la que menos."""
+        with self._lock:
+            rows = [{"rule": name, "calls": t.calls, "total_s": t.total_s, "max_s": t.max_s,
+                     "avg_us": t.total_s / t.calls * 1e6 if t.calls else 0.0}
+                    for name, t in self._timings.items()]
+        return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+# Motor por defecto: se compila una vez, al importar el módulo
+DEFAULT_ENGINE = RuleEngine()
+
+def validate_invoice(factura: Factura) -> ValidationResult:
+    return DEFAULT_ENGINE.validate(factura)
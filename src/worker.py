@@ -0,0 +1,125 @@
+import os
+import threading
+import httpx
+from dataclasses import dataclass, field
+from typing import List, Optional
+from .llm_extractor import LLMExtractor, DEFAULT_MODELS, parse_models
+from .extraction_cache import ExtractionCache
+from .seen_index import SeenIndex
+from .rate_limiter import RateLimiter
+from .storage import DEFAULT_DB_URL, Storage
+from .export_sink import ExportSink
+from .supplier_templates import SupplierTemplateEngine
+from .replay import ExtractionBackend
+
+# -----------------------------------------------------------------------------
+# 13. CONTEXTO DE WORKER (Recursos de larga duración)
+# -----------------------------------------------------------------------------
+# ¿QUÉ ES ESTO?
+# Es la "caja de herramientas" de un proceso que procesa facturas sin parar (el
+# watcher). Contiene el extractor, el storage, los índices y la exportación (CSV y
+# Parquet en lote), creados UNA sola vez.
+#
+# ¿POR QUÉ ASÍ EN PRODUCCIÓN?
+# 1. Conexiones reutilizadas: Crear un `LLMExtractor` por factura significa un
+#    cliente OpenAI nuevo, un pool HTTP nuevo y un handshake TLS nuevo cada vez.
+#    Con un `httpx.Client` compartido, las conexiones keep-alive se reutilizan.
+# 2. Un solo engine: `Storage()` usa el engine del proceso (`get_engine`, en modo
+#    WAL) y ejecuta `create_all` (consultas al catálogo de la DB). Hacerlo por
+#    factura es trabajo tirado.
+# 3. Configurable: Los límites del pool se leen de variables de entorno, para
+#    ajustarlos a la cuota de la API sin tocar código.
+# 4. Backend enchufable: EXTRACTOR_BACKEND=replay sirve las respuestas desde una
+#    cassette grabada (ver `replay.py`) para medir el watcher sin red.
+#
+# Resultado: el coste por factura es solo la llamada a la API y el INSERT.
+# -----------------------------------------------------------------------------
+
+@dataclass
+class WorkerConfig:
+    """Límites de recursos del worker (por defecto razonables para un watcher)."""
+    max_connections: int = 10
+    max_keepalive_connections: int = 5
+    keepalive_expiry: float = 60.0
+    timeout: float = 120.0
+    db_path: str = DEFAULT_DB_URL
+    requests_per_minute: int = 500
+    tokens_per_minute: int = 30_000
+    models: List[str] = field(default_factory=lambda: list(DEFAULT_MODELS))
+
+    @classmethod
+    def from_env(cls) -> "WorkerConfig":
+        """Lee la configuración de las variables de entorno WORKER_*."""
+        defaults = cls()
+        return cls(
+            max_connections=int(os.getenv("WORKER_MAX_CONNECTIONS", defaults.max_connections)),
+            max_keepalive_connections=int(os.getenv("WORKER_MAX_KEEPALIVE", defaults.max_keepalive_connections)),
+            keepalive_expiry=float(os.getenv("WORKER_KEEPALIVE_EXPIRY", defaults.keepalive_expiry)),
+            timeout=float(os.getenv("WORKER_TIMEOUT", defaults.timeout)),
+            db_path=os.getenv("DATABASE_URL", defaults.db_path),
+            requests_per_minute=int(os.getenv("OPENAI_RPM", defaults.requests_per_minute)),
+            tokens_per_minute=int(os.getenv("OPENAI_TPM", defaults.tokens_per_minute)),
+            models=parse_models(os.getenv("OPENAI_MODELS")),
+        )
+
+class WorkerContext:
+    """Extractor, storage e índices compartidos durante toda la vida del proceso."""
+
+    def __init__(self, api_key: str, config: Optional[WorkerConfig] = None,
+                 backend: Optional[ExtractionBackend] = None):
+        self.config = config or WorkerConfig.from_env()
+        self.backend = backend or ExtractionBackend.from_env()
+
+        # Pool HTTP compartido: keep-alive entre facturas consecutivas
+        limits = httpx.Limits(
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+        self.http_client = httpx.Client(
+            transport=self.backend.transport(limits),
+            limits=limits,
+            timeout=self.config.timeout,
+        )
+        self.limiter = RateLimiter(
+            requests_per_minute=self.config.requests_per_minute,
+            tokens_per_minute=self.config.tokens_per_minute,
+        )
+        self.extractor = LLMExtractor(api_key, cache=ExtractionCache(), http_client=self.http_client,
+                                      limiter=self.limiter, templates=SupplierTemplateEngine(),
+                                      models=self.config.models)
+        self.storage = Storage(self.config.db_path)
+        self.seen_index = SeenIndex()
+        self.export = ExportSink.from_env()
+
+    def close(self):
+        """Vuelca la exportación pendiente y cierra el pool HTTP y las conexiones de la DB."""
+        self.export.close()
+        self.http_client.close()
+        self.storage.engine.dispose()
+
+_context: Optional[WorkerContext] = None
+_context_lock = threading.Lock()
+
+def get_worker_context() -> WorkerContext:
+    """Devuelve el contexto del proceso, creándolo la primera vez."""
+    global _context
+    if _context is None:
+        with _context_lock:
+            if _context is None:
+                backend = ExtractionBackend.from_env()
+                api_key = os.getenv("OPENAI_API_KEY")
+                if not api_key and backend.needs_api_key:
+                    # Mejor fallar aquí que con un 401 en la primera factura
+                    raise RuntimeError(f"Falta OPENAI_API_KEY (necesaria con EXTRACTOR_BACKEND={backend.kind})")
+                # En replay no hay red: cualquier clave sirve
+                _context = WorkerContext(api_key=api_key or "replay", backend=backend)
+    return _context
+
+def close_worker_context():
+    """Libera los recursos del contexto (al parar el servicio)."""
+    global _context
+    with _context_lock:
+        if _context is not None:
+            _context.close()
+            _context = None
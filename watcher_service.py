@@ -32,10 +32,10 @@ from dotenv import load_dotenv
 sys.path.insert(0, str(Path(__file__).parent))
 
 from src.folder_watcher import FolderWatcher
-from src.ingestor import Document
-from src.llm_extractor import LLMExtractor
+from src.ingestor import document_from_path
 from src.validator import validate_invoice
-from src.storage import Storage
+from src.supplier_registry import get_supplier_registry
+from src.worker import get_worker_context, close_worker_context
 
 # -----------------------------------------------------------------------------
 # CONFIGURACIÓN DE LOGGING PARA SERVICIOS
@@ -93,40 +93,53 @@ def process_invoice_file(file_path: str):
     - Reutilización: Esta misma lógica podría usarse desde una API, un email ingestor, etc.
     - Testing: Es más fácil testear una función pura que un servicio completo.
     - Manejo de Errores: Podemos capturar errores aquí sin que afecten al watcher.
+    
+    El extractor, el storage y el índice vienen del `WorkerContext` del proceso:
+    se crean una vez y se reutilizan (conexiones HTTP keep-alive, un solo engine).
     """
     try:
+        ctx = get_worker_context()
         logger.info(f"🚀 Procesando: {Path(file_path).name}")
         
-        # Crear documento
-        doc = Document(
-            id=f"watcher_{Path(file_path).name}",
-            filename=Path(file_path).name,
-            filepath=file_path,
-            source="folder_watcher"
-        )
+        # Crear documento (ID = hash del contenido)
+        doc = document_from_path(file_path, source="folder_watcher")
+        
+        # Si ya lo procesamos (aunque tuviera otro nombre), no pagamos otra extracción
+        if doc.id in ctx.seen_index:
+            logger.info(f"⏭️ {doc.filename} ya fue procesado (mismo contenido), se omite")
+            return
         
         # Extraer datos con LLM
         logger.info(f"🤖 Extrayendo datos de {doc.filename}...")
-        extractor = LLMExtractor(api_key=os.getenv("OPENAI_API_KEY"))
-        factura = extractor.extract(doc)
+        factura = ctx.extractor.extract(doc)
         
-        # Validar
+        # Validar (con el nombre oficial del proveedor si está en el maestro)
         logger.info(f"✅ Validando factura {factura.numero_factura}...")
+        factura = get_supplier_registry().canonicalise(factura)
         validation = validate_invoice(factura)
         
-        status = "OK" if validation.is_valid else "REVIEW"
-        notes = "\n".join(validation.errors + validation.warnings)
+        status, notes = validation.status, validation.notes
+        # ¿La misma factura ya llegó en otro archivo? (reenvío, escaneo de una copia)
+        status, notes, duplicate = ctx.storage.check_duplicate(factura, status, notes)
+        if duplicate:
+            logger.warning(f"🔁 {doc.filename} parece un duplicado de la factura #{duplicate.factura_id} "
+                           f"({duplicate.document_id})")
         
-        if not validation.is_valid:
+        if status != "OK":
             logger.warning(f"⚠️ Factura {factura.numero_factura} requiere revisión: {notes}")
         
         # Guardar en DB
-        storage = Storage()
-        saved = storage.save_invoice(doc.id, factura, status, notes)
+        saved = ctx.storage.save_invoice(doc.id, factura, status, notes, metrics=doc.metrics, duplicate=duplicate)
+        if doc.metrics is not None:
+            m = doc.metrics
+            logger.info(f"📈 {doc.filename}: {m.source}, {m.total_tokens} tokens, ${m.cost_usd:.4f}, "
+                        f"{m.wall_time_s:.1f}s, {m.validation_retries + m.network_retries} reintentos")
         
         if saved:
-            # Exportar a CSV
-            storage.export_to_csv(factura)
+            ctx.seen_index.add(doc.id, doc.filename)
+            
+            # Exportar a CSV/Parquet (en lote: se escribe al llenarse o a los pocos segundos)
+            ctx.export.add(doc.id, factura)
             logger.info(f"✅ Factura {factura.numero_factura} procesada correctamente")
             
             # PRODUCCIÓN: Aquí podrías mover el archivo a una carpeta "Procesados"
@@ -155,8 +168,8 @@ def main():
     # Cargar variables de entorno
     load_dotenv()
     
-    # Verificar API key
-    if not os.getenv("OPENAI_API_KEY"):
+    # Verificar API key (el backend de replay no la necesita)
+    if not os.getenv("OPENAI_API_KEY") and os.getenv("EXTRACTOR_BACKEND", "openai") != "replay":
         logger.error("❌ OPENAI_API_KEY no encontrada en .env")
         sys.exit(1)
     
@@ -168,10 +181,14 @@ def main():
     logger.info("=" * 60)
     logger.info(f"📁 Carpeta vigilada: {watch_folder}")
     logger.info(f"🔑 API Key configurada: {'Sí' if os.getenv('OPENAI_API_KEY') else 'No'}")
+    logger.info(f"🔌 Backend de extracción: {os.getenv('EXTRACTOR_BACKEND', 'openai')}")
     logger.info("=" * 60)
     
     # Crear y ejecutar el watcher
     try:
+        # Recursos compartidos (cliente HTTP, engine de DB): se crean una sola vez
+        get_worker_context()
+        
         watcher = FolderWatcher(
             watch_path=watch_folder,
             process_callback=process_invoice_file
@@ -186,6 +203,8 @@ def main():
     except Exception as e:
         logger.error(f"❌ Error fatal: {e}", exc_info=True)
         sys.exit(1)
+    finally:
+        close_worker_context()
 
 if __name__ == "__main__":
     main()